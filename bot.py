@@ -1,10 +1,20 @@
 import discord
-import aiosqlite
 import os
+import time
 from discord.ext import commands
 
 from dotenv import load_dotenv
 
+from utils.db_pool import ConnectionPool
+from utils.db_writer import DBWriter
+from utils.balance_cache import BalanceCache
+from utils.migrations import run_migrations, get_schema_version
+from utils.phash_index import PHashIndex
+from utils.content_index import ContentIndex
+from utils.message_index import MessageIndex
+from utils.reaction_rewards import ReactionRewards
+from utils.image_service import ImageService
+
 # -----------------------------------------------------------
 # 設定 (Configuration)
 # -----------------------------------------------------------
@@ -13,134 +23,79 @@ load_dotenv(override=True)
 TOKEN = os.getenv("DISCORD_TOKEN")
 HF_TOKEN = os.getenv("HF_TOKEN")
 DB_NAME = "economy.db"
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "10000"))
+BALANCE_CACHE_ENABLED = os.getenv("BALANCE_CACHE", "1") != "0"
+# Exact-duplicate Bloom filter (sized for this many listings before it is rebuilt larger)
+BLOOM_CAPACITY = int(os.getenv("BLOOM_CAPACITY", "100000"))
+# Seconds 🔥 rewards are accrued in memory before one batched write
+REACTION_FLUSH_SECS = float(os.getenv("REACTION_FLUSH_SECS", "5"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
 
 # -----------------------------------------------------------
 # Bank システム (Bank System)
 # -----------------------------------------------------------
 class BankSystem:
-    def __init__(self, db_path):
+    def __init__(self, db_path, readers=DB_READERS):
         self.db_path = db_path
+        self.balance_cache = BalanceCache(BALANCE_CACHE_SIZE, enabled=BALANCE_CACHE_ENABLED)
+        # Writes made on a writer checkout outside the DBWriter can't be
+        # followed commit-by-commit, so their keys are just invalidated.
+        self.pool = ConnectionPool(db_path, readers=readers, on_writer_release=self.balance_cache.rollback)
+        self.writer = DBWriter(self.pool, listener=self.balance_cache)
+
+    def acquire(self, write=False):
+        """Check out a pooled connection: `async with bot.bank.acquire() as db:`
+
+        Pass write=True for anything that modifies the database; there is a
+        single writer connection, so keep the block short.
+        """
+        return self.pool.acquire(write=write)
+
+    async def submit_write(self, op):
+        """Run `op(db)` on the single-writer task and return its result.
+
+        Several submitted operations share one commit; each one is isolated
+        by a savepoint, so an exception only undoes that caller's changes.
+        `op` must not commit or roll back itself.
+        """
+        return await self.writer.submit(op)
+
+    async def execute_write(self, sql, params=()) -> int:
+        """Queue a single statement on the writer and return its rowcount."""
+        async def op(db):
+            cursor = await db.execute(sql, params)
+            return cursor.rowcount
+        return await self.submit_write(op)
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def writer_stats(self):
+        return self.writer.stats()
+
+    def cache_stats(self):
+        return self.balance_cache.stats()
+
+    def invalidate_balances(self, user_id=None, guild_id=None):
+        """Drop cached balances after writing to `bank` with raw SQL."""
+        self.balance_cache.invalidate(None if user_id is None else (user_id, guild_id))
+
+    async def close(self):
+        await self.writer.stop()
+        await self.pool.close()
 
     async def initialize(self):
-        async with aiosqlite.connect(self.db_path, timeout=60.0) as db:
-            await db.execute("PRAGMA journal_mode=WAL")
-            # Bank table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS bank (
-                    user_id INTEGER,
-                    guild_id INTEGER,
-                    balance INTEGER DEFAULT 0,
-                    PRIMARY KEY (user_id, guild_id)
-                )
-            """)
-            # Market Items table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS market_items (
-                    item_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    seller_id INTEGER NOT NULL,
-                    image_url TEXT NOT NULL,
-                    image_hash TEXT,
-                    aesthetic_score REAL NOT NULL,
-                    price INTEGER NOT NULL,
-                    status TEXT DEFAULT 'on_sale',
-                    tags TEXT,
-                    grade TEXT,
-                    thread_id INTEGER,
-                    message_id INTEGER,
-                    buyer_id INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Indices for market_items
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_market_status ON market_items(status)")
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_market_buyer ON market_items(buyer_id)")
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_market_hash ON market_items(image_hash)")
-
-            # Market Trends table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS market_trends (
-                    tag_name TEXT PRIMARY KEY,
-                    current_price INTEGER DEFAULT 100,
-                    saturation INTEGER DEFAULT 0,
-                    trend_bonus INTEGER DEFAULT 0
-                )
-            """)
-            
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS user_galleries (
-                    user_id INTEGER PRIMARY KEY,
-                    thread_id INTEGER
-                )
-            """)
-            
-            # Daily Trends table removed
-
-            
-            # Tag Metadata table removed
-            
-            # Tag Stock Market table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS tag_stocks (
-                    tag_name TEXT PRIMARY KEY,
-                    current_price REAL DEFAULT 100.0,
-                    total_volume INTEGER DEFAULT 0
-                )
-            """)
-
-            # User Stocks table
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS user_stocks (
-                    user_id INTEGER,
-                    tag_name TEXT,
-                    amount INTEGER DEFAULT 0,
-                    average_cost REAL DEFAULT 0,
-                    PRIMARY KEY (user_id, tag_name)
-                )
-            """)
-            
-            # Migration check
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN image_hash TEXT")
-            except Exception:
-                pass 
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN tags TEXT")
-            except Exception:
-                pass
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN grade TEXT")
-            except Exception:
-                pass
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN thread_id INTEGER")
-            except Exception:
-                pass
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN message_id INTEGER")
-            except Exception:
-                pass
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN buyer_id INTEGER")
-            except Exception:
-                pass
-            
-            # Auction Columns
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN auction_end_time TEXT")
-            except Exception: pass
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN current_bid INTEGER DEFAULT 0")
-            except Exception: pass
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN top_bidder_id INTEGER")
-            except Exception: pass
-            
-            try:
-                await db.execute("ALTER TABLE market_items ADD COLUMN is_locked BOOLEAN DEFAULT 0")
-            except Exception: pass
-            
-            await db.commit()
+        await self.pool.open()
+        start = time.perf_counter()
+        async with self.acquire(write=True) as db:
+            timings = await run_migrations(db)
+            version = await get_schema_version(db)
+        for step_version, name, elapsed in timings:
+            print(f"マイグレーション適用: v{step_version} {name} ({elapsed * 1000:.1f} ms)")
+        print(f"データベース初期化: schema v{version} ({(time.perf_counter() - start) * 1000:.1f} ms)")
+
+        self.writer.start()
 
     async def get_balance(self, user: discord.Member, db_conn=None) -> int:
         if db_conn:
@@ -151,9 +106,15 @@ class BankSystem:
             row = await cursor.fetchone()
             return row[0] if row else 0
         else:
-            async with aiosqlite.connect(self.db_path, timeout=60.0) as db:
-                await db.execute("PRAGMA journal_mode=WAL")
-                return await self.get_balance(user, db)
+            key = (user.id, user.guild.id)
+            cached = self.balance_cache.get(key)
+            if cached is not None:
+                return cached
+            version = self.balance_cache.version
+            async with self.acquire() as db:
+                balance = await self.get_balance(user, db)
+            self.balance_cache.fill(key, balance, version)
+            return balance
 
     async def set_balance(self, user: discord.Member, amount: int, db_conn=None):
         if amount < 0: raise ValueError("残高は負の値にはできません。")
@@ -167,11 +128,9 @@ class BankSystem:
 
         if db_conn:
             await db_conn.execute(sql, params)
+            self.balance_cache.stage((user.id, user.guild.id), amount)
         else:
-            async with aiosqlite.connect(self.db_path, timeout=60.0) as db:
-                await db.execute("PRAGMA journal_mode=WAL")
-                await db.execute(sql, params)
-                await db.commit()
+            await self.submit_write(lambda db: self.set_balance(user, amount, db))
 
     async def deposit_credits(self, user: discord.Member, amount: int, db_conn=None):
         if amount <= 0: raise ValueError("支給額は0より大きくなければなりません。")
@@ -180,54 +139,78 @@ class BankSystem:
             INSERT INTO bank (user_id, guild_id, balance) 
             VALUES (?, ?, ?)
             ON CONFLICT(user_id, guild_id) DO UPDATE SET balance = balance + ?
+            RETURNING balance
         """
         params = (user.id, user.guild.id, amount, amount)
 
         if db_conn:
-            await db_conn.execute(sql, params)
+            cursor = await db_conn.execute(sql, params)
+            row = await cursor.fetchone()
+            self.balance_cache.stage((user.id, user.guild.id), row[0])
         else:
-            async with aiosqlite.connect(self.db_path, timeout=60.0) as db:
-                await db.execute("PRAGMA journal_mode=WAL")
-                await db.execute(sql, params)
-                await db.commit()
+            await self.submit_write(lambda db: self.deposit_credits(user, amount, db))
 
     async def withdraw_credits(self, user: discord.Member, amount: int, db_conn=None):
         if amount <= 0: raise ValueError("引き落とし額は0より大きくなければなりません。")
         
-        # Check balance logic need to use the same connection!
-        # Recursive call will handle opening new conn if needed, but here we must ensure atomicity.
-        
         if db_conn:
-            current_bal = await self.get_balance(user, db_conn)
-            if current_bal < amount: raise ValueError("残高不足です。")
-            await db_conn.execute(
-                "UPDATE bank SET balance = balance - ? WHERE user_id = ? AND guild_id = ?",
-                (amount, user.id, user.guild.id)
-            )
+            await self._debit(db_conn, user.id, user.guild.id, amount)
         else:
-            async with aiosqlite.connect(self.db_path, timeout=60.0) as db:
-                await db.execute("PRAGMA journal_mode=WAL")
-                # We pass 'db' to reuse this connection
-                await self.withdraw_credits(user, amount, db)
-                await db.commit()
+            await self.submit_write(lambda db: self.withdraw_credits(user, amount, db))
+
+    async def _debit(self, db, user_id, guild_id, amount):
+        # Guarded single-statement debit: the balance check and the update
+        # happen atomically, so two concurrent debits cannot both pass.
+        cursor = await db.execute(
+            "UPDATE bank SET balance = balance - ? WHERE user_id = ? AND guild_id = ? AND balance >= ? RETURNING balance",
+            (amount, user_id, guild_id, amount)
+        )
+        row = await cursor.fetchone()
+        if row is None: raise ValueError("残高不足です。")
+        self.balance_cache.stage((user_id, guild_id), row[0])
+
+    async def apply_transfers(self, legs, db_conn=None):
+        """Apply several balance changes atomically.
+
+        `legs` is a list of `(user_id, guild_id, delta)`. Negative deltas are
+        guarded debits; positive ones are credited with a single batched
+        UPSERT. Legs don't have to sum to zero (e.g. a resale tax is simply
+        not credited to anyone). If any debit fails a ValueError is raised
+        and, when run through the writer, none of the legs are applied.
+        """
+        legs = [(uid, gid, delta) for uid, gid, delta in legs if delta]
+        if not legs: return
+
+        if db_conn:
+            for uid, gid, delta in legs:
+                if delta < 0:
+                    await self._debit(db_conn, uid, gid, -delta)
+            credits = [(uid, gid, delta, delta) for uid, gid, delta in legs if delta > 0]
+            if credits:
+                await db_conn.executemany("""
+                    INSERT INTO bank (user_id, guild_id, balance) 
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(user_id, guild_id) DO UPDATE SET balance = balance + ?
+                """, credits)
+                # executemany can't return rows; re-read these on next access
+                for uid, gid, _, _ in credits:
+                    self.balance_cache.stage((uid, gid))
+        else:
+            await self.submit_write(lambda db: self.apply_transfers(legs, db))
 
     async def transfer_credits(self, sender: discord.Member, receiver: discord.Member, amount: int, db_conn=None):
         if amount <= 0: raise ValueError("送金額は0より大きくなければなりません。")
         if sender.id == receiver.id: raise ValueError("自分自身に送金することはできません。")
 
         if db_conn:
-             await self.withdraw_credits(sender, amount, db_conn)
-             await self.deposit_credits(receiver, amount, db_conn)
+             await self.apply_transfers([
+                 (sender.id, sender.guild.id, -amount),
+                 (receiver.id, receiver.guild.id, amount),
+             ], db_conn)
         else:
-            async with aiosqlite.connect(self.db_path, timeout=60.0) as db:
-                await db.execute("PRAGMA journal_mode=WAL")
-                await db.execute("BEGIN TRANSACTION")
-                try:
-                    await self.transfer_credits(sender, receiver, amount, db)
-                    await db.commit()
-                except Exception as e:
-                    await db.rollback()
-                    raise e
+            # Both legs run inside one writer savepoint: a failed withdraw
+            # leaves nothing behind.
+            await self.submit_write(lambda db: self.transfer_credits(sender, receiver, amount, db))
 
 # -----------------------------------------------------------
 # Bot クラス (Bot Class)
@@ -240,9 +223,38 @@ class EconomyBot(commands.Bot):
         super().__init__(command_prefix="!", intents=intents)
         self.bank = BankSystem(DB_NAME)
         self.hf_token = HF_TOKEN
+        # Shared near-duplicate index (BrokerCog / MarketCog)
+        self.phash_index = PHashIndex()
+        # Byte-identical re-uploads, checked before any image work
+        self.content_index = ContentIndex(f"{DB_NAME}.bloom", BLOOM_CAPACITY)
+        # Gallery message -> item, for buy buttons and reactions
+        self.message_index = MessageIndex()
+        # 🔥 rewards, written in batches (MarketCog)
+        self.reaction_rewards = ReactionRewards(self.bank, interval=REACTION_FLUSH_SECS)
+        # Decode / hash uploads in worker processes (BrokerCog / MarketCog)
+        self.image_service = ImageService(IMAGE_WORKERS)
+        # Seconds from construction to each startup milestone
+        self.started_at = time.perf_counter()
+        self.startup_timings = {}
+
+    def mark_startup(self, milestone):
+        if milestone not in self.startup_timings:
+            elapsed = time.perf_counter() - self.started_at
+            self.startup_timings[milestone] = elapsed
+            print(f"起動計測: {milestone} {elapsed:.2f}s")
 
     async def setup_hook(self):
         await self.bank.initialize()
+        async with self.bank.acquire() as db:
+            await self.phash_index.load(db)
+            mode, added, secs = await self.content_index.load(db)
+            await self.message_index.load(db)
+        print(f"pHashインデックス: {len(self.phash_index)} 件")
+        print(f"SHA-256 Bloom filter: {len(self.content_index)} 件 ({mode}, +{added} 件, {secs:.2f}s)")
+        print(f"メッセージインデックス: {len(self.message_index)} 件")
+        self.reaction_rewards.start()
+        self.mark_startup("bank")
+        await self.image_service.start()
         
         self.initial_extensions = [
             "cogs.bank",
@@ -257,12 +269,23 @@ class EconomyBot(commands.Bot):
                 print(f"ロード成功: {extension}")
             except Exception as e:
                 print(f"ロード失敗 {extension}: {e}")
+        self.mark_startup("extensions")
+
+    async def close(self):
+        await super().close()
+        await self.image_service.close()
+        self.content_index.save()
+        # Pending rewards go out before the writer stops (never raises)
+        await self.reaction_rewards.stop()
+        await self.bank.close()
 
 if __name__ == "__main__":
     bot = EconomyBot()
     
     @bot.event
     async def on_ready():
+        # Commands such as !balance are served from here on
+        bot.mark_startup("gateway")
         print(f'{bot.user} 準備完了！')
         print(f'データベース: {DB_NAME}')
 
@@ -47,6 +47,51 @@ class BankCog(commands.Cog):
         except ValueError as e:
             await ctx.send(f"❌ {str(e)}")
 
+    @commands.command(name="db_stats")
+    @commands.has_permissions(administrator=True)
+    async def db_stats(self, ctx):
+        """(管理者) DBコネクションプール・書き込みキュー・残高キャッシュ・メッセージインデックス・リアクション報酬の統計"""
+        stats = self.bot.bank.pool_stats()
+        embed = discord.Embed(title="DB Pool", color=discord.Color.dark_grey())
+        embed.add_field(name="Readers", value=f"{stats['idle_readers']}/{stats['readers']} idle", inline=True)
+        embed.add_field(name="Writer", value="busy" if stats['writer_busy'] else "idle", inline=True)
+        for side in ("reader", "writer"):
+            s = stats[side]
+            embed.add_field(
+                name=f"{side} checkouts",
+                value=(f"{s['checkouts']:,} (waits: {s['waits']:,})\n"
+                       f"avg {s['avg_checkout_ms']:.2f} ms / max {s['max_checkout_ms']:.2f} ms"),
+                inline=False
+            )
+        w = self.bot.bank.writer_stats()
+        embed.add_field(
+            name="writer queue",
+            value=(f"commits: {w['commits']:,} ({w['commits_per_sec']:.2f}/s), ops/commit: {w['ops_per_commit']:.1f} (max {w['max_batch']})\n"
+                   f"queued: {w['queued']}, failed ops: {w['failed_ops']:,}, avg commit {w['avg_commit_ms']:.2f} ms"),
+            inline=False
+        )
+        c = self.bot.bank.cache_stats()
+        embed.add_field(
+            name="balance cache",
+            value=(f"{'on' if c['enabled'] else 'off'}, {c['size']:,}/{c['maxsize']:,} entries\n"
+                   f"hits: {c['hits']:,} / misses: {c['misses']:,} ({c['hit_rate']:.1%})"),
+            inline=False
+        )
+        m = self.bot.message_index.stats()
+        embed.add_field(
+            name="message index",
+            value=(f"{m['items']:,} items, {m['negative']:,}/{m['negative_max']:,} non-item ids\n"
+                   f"hits: {m['hits']:,} / negative: {m['negative_hits']:,} / DB: {m['db_lookups']:,} ({m['db_rate']:.1%})"),
+            inline=False
+        )
+        r = self.bot.reaction_rewards.stats()
+        embed.add_field(
+            name="reaction rewards",
+            value=(f"pending: {r['pending']:,} (flush every {r['interval']:g}s), rewarded: {r['rewarded']:,}, duplicates: {r['duplicates']:,}\n"
+                   f"flushes: {r['flushes']:,} ({r['reactions_per_commit']:.1f} rewards/flush, last {r['last_flush_ms']:.2f} ms), failed: {r['failed_flushes']:,}"),
+            inline=False
+        )
+        await ctx.send(embed=embed)
 
     @commands.command(name="daily")
     async def daily(self, ctx):
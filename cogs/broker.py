@@ -1,41 +1,87 @@
 import discord
 from discord.ext import commands, tasks
-from gradio_client import Client, handle_file
 import asyncio
-import aiosqlite
 import os
 import aiohttp
 import uuid
 import traceback
-import imagehash
 from PIL import Image
 import random
 import csv
 import json
 import math
+import re
+import io
+import hashlib
 from datetime import datetime, time, timedelta
-# from utils.bloom_filter import BloomFilter # Removed
+from time import perf_counter
+from utils.phash_index import DUPLICATE_DISTANCE, to_db
+from utils.dup_audit import run_audit, write_clusters
+from utils.content_index import backfill, write_backfill
+from utils.tag_index import write_item_tags
+from utils.pagination import KeysetPager
+from utils.inference_pool import InferenceBusy, InferencePool
+from utils.circuit_breaker import CircuitBreaker, CircuitOpen
+from utils.rate_limit import RateLimiter
+from utils.inference_cache import InferenceCache
+from utils.inference_backend import create_backend
+from utils.image_io import image_suffix
+from utils.image_service import PayloadStats
+
+# Workers per model (the two Spaces are independent) and queued jobs each
+TAGGER_CONCURRENCY = int(os.getenv("TAGGER_CONCURRENCY", "2"))
+SCORER_CONCURRENCY = int(os.getenv("SCORER_CONCURRENCY", "2"))
+AI_QUEUE_SIZE = int(os.getenv("AI_QUEUE_SIZE", "16"))
+# Micro-batching: jobs per dispatch (1 = off) and how long to wait for more
+AI_MAX_BATCH = int(os.getenv("AI_MAX_BATCH", "1"))
+AI_BATCH_WAIT_MS = float(os.getenv("AI_BATCH_WAIT_MS", "5"))
+# Attachments larger than this are refused before download
+MAX_IMAGE_MB = float(os.getenv("MAX_IMAGE_MB", "20"))
+MAX_IMAGE_BYTES = int(MAX_IMAGE_MB * 1024 * 1024)
+# Per-model upload preprocessing: (input size, side it applies to); 0 = send
+# the original. wd-tagger pads to a 448 square, the CLIP scorer resizes the
+# short side to 224 and center-crops.
+AI_PREPROCESS = {
+    'tag': (int(os.getenv("TAGGER_INPUT_SIZE", "448")), "long"),
+    'score': (int(os.getenv("SCORER_INPUT_SIZE", "224")), "short"),
+}
+AI_UPLOAD_QUALITY = int(os.getenv("AI_UPLOAD_QUALITY", "90"))
+AI_UPLINK_MBPS = float(os.getenv("AI_UPLINK_MBPS", "20"))
+# How long !sell waits for the backend to finish warming up
+AI_READY_WAIT = float(os.getenv("AI_READY_WAIT", "30"))
+AI_WARMUP_RETRY_MAX = 300
+# Circuit breaker per model: consecutive failures before it opens, and the
+# first / longest wait before a half-open probe
+AI_BREAKER_THRESHOLD = int(os.getenv("AI_BREAKER_THRESHOLD", "5"))
+AI_BREAKER_BACKOFF = float(os.getenv("AI_BREAKER_BACKOFF", "15"))
+AI_BREAKER_BACKOFF_MAX = float(os.getenv("AI_BREAKER_BACKOFF_MAX", "300"))
+# Appraisals per user per minute (0 = unlimited) and how many may be used at once
+AI_USER_RATE_PER_MIN = float(os.getenv("AI_USER_RATE_PER_MIN", "6"))
+AI_USER_BURST = float(os.getenv("AI_USER_BURST", "3"))
+# Administrators skip the rate limit and the fair queue
+AI_ADMIN_PRIORITY = os.getenv("AI_ADMIN_PRIORITY", "1") != "0"
+
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "1024"))
+AI_CACHE_MAX_AGE_DAYS = float(os.getenv("AI_CACHE_MAX_AGE_DAYS", "30"))
+AI_CACHE_MAX_ROWS = int(os.getenv("AI_CACHE_MAX_ROWS", "100000"))
 
 class InventoryView(discord.ui.View):
-    def __init__(self, ctx, items, per_page=5):
+    def __init__(self, ctx, pager):
         super().__init__(timeout=60)
         self.ctx = ctx
-        self.items = items
-        self.per_page = per_page
+        self.pager = pager
         self.current_page = 0
-        self.max_page = max(0, (len(items) - 1) // per_page)
         self.update_buttons()
 
     def update_buttons(self):
         self.prev_btn.disabled = self.current_page == 0
-        self.next_btn.disabled = self.current_page == self.max_page
+        self.next_btn.disabled = not self.pager.has_next(self.current_page)
 
-    def get_embed(self):
-        start = self.current_page * self.per_page
-        end = start + self.per_page
-        batch = self.items[start:end]
+    async def get_embed(self):
+        batch = await self.pager.page(self.current_page)
+        self.update_buttons()
         
-        embed = discord.Embed(title=f"{self.ctx.author.display_name}の所持品 ({self.current_page + 1}/{self.max_page + 1})", color=discord.Color.gold())
+        embed = discord.Embed(title=f"{self.ctx.author.display_name}の所持品 ({self.current_page + 1}/{self.pager.max_page + 1})", color=discord.Color.gold())
         if not batch:
              embed.description = "表示するアイテムがありません。"
              return embed
@@ -47,7 +93,7 @@ class InventoryView(discord.ui.View):
             description += f"**ID: {item_id}** | {tag_summary} (Score: {score:.1f}) | {thread_link}\n"
         
         embed.description = description
-        embed.set_footer(text=f"Total: {len(self.items)} items")
+        embed.set_footer(text=f"Total: {self.pager.total} items")
         return embed
 
     @discord.ui.button(label="◀️", style=discord.ButtonStyle.blurple)
@@ -58,8 +104,7 @@ class InventoryView(discord.ui.View):
 
         if self.current_page > 0:
             self.current_page -= 1
-            self.update_buttons()
-            await interaction.response.edit_message(embed=self.get_embed(), view=self)
+            await interaction.response.edit_message(embed=await self.get_embed(), view=self)
         else:
             await interaction.response.defer()
 
@@ -69,10 +114,9 @@ class InventoryView(discord.ui.View):
             await interaction.response.send_message("他人のインベントリは操作できません。", ephemeral=True)
             return
 
-        if self.current_page < self.max_page:
+        if self.pager.has_next(self.current_page):
             self.current_page += 1
-            self.update_buttons()
-            await interaction.response.edit_message(embed=self.get_embed(), view=self)
+            await interaction.response.edit_message(embed=await self.get_embed(), view=self)
         else:
              await interaction.response.defer()
 
@@ -97,19 +141,15 @@ class ResellPriceModal(discord.ui.Modal, title="再販価格の設定"):
              await interaction.response.send_message("❌ 価格は100以上の整数で入力してください。", ephemeral=True)
              return
 
-        async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db:
+        async def relist(db):
             # Re-verify ownership
             cursor = await db.execute("""
                 SELECT thread_id, message_id, tags, aesthetic_score FROM market_items 
                 WHERE item_id = ? AND buyer_id = ? AND status IN ('sold', 'owned')
             """, (self.item_id, interaction.user.id))
             row = await cursor.fetchone()
-            
             if not row:
-                await interaction.response.send_message("❌ エラー: アイテムを所有していないか、既に販売中です。", ephemeral=True)
-                return
-            
-            thread_id, message_id, tags, score = row
+                return None
             
             # Update DB
             await db.execute("""
@@ -117,48 +157,56 @@ class ResellPriceModal(discord.ui.Modal, title="再販価格の設定"):
                 SET status = 'on_sale', price = ?, seller_id = ?, buyer_id = NULL 
                 WHERE item_id = ?
             """, (price, interaction.user.id, self.item_id))
-            await db.commit()
-            
-            # Update Gallery Message
-            try:
-                guild = interaction.guild
-                thread = guild.get_thread(thread_id)
-                if not thread:
-                     try: thread = await guild.fetch_channel(thread_id)
-                     except: pass
-                
-                if thread:
-                     try:
-                         msg = await thread.fetch_message(message_id)
-                         
-                         # Edit Embed
-                         embed = msg.embeds[0]
-                         embed.clear_fields()
-                         embed.title = "🔄 再販中 (Resale)"
-                         embed.color = discord.Color.orange()
-                         
-                         tags_str = tags if tags else "None"
-                         grade = "B"
-                         if score >= 9.0: grade = "S"
-                         elif score >= 7.0: grade = "A"
-                         
-                         embed.add_field(name="ID", value=f"**#{self.item_id}**", inline=True)
-                         embed.add_field(name="販売者", value=interaction.user.mention, inline=True)
-                         embed.add_field(name="価格", value=f"💰 {price:,}", inline=True)
-                         embed.add_field(name="グレード", value=f"**{grade}** ({score:.2f})", inline=True)
-                         embed.add_field(name="特徴 (Tags)", value=tags_str, inline=False)
-                         
-                         from cogs.market import BuyView
-                         await msg.edit(content=f"📢 **再販中!** (ID: {self.item_id})", embed=embed, view=BuyView(self.bot))
-                         
-                         await interaction.response.send_message(f"✅ **再販設定完了！** (ID: {self.item_id}, Price: {price:,})\n🔗 {msg.jump_url}")
-                         return
-                     except Exception as e:
-                         print(f"Failed to edit msg: {e}")
-            except Exception as e:
-                print(f"Resell Error: {e}")
+            return row
+
+        row = await self.bot.bank.submit_write(relist)
+        if not row:
+            await interaction.response.send_message("❌ エラー: アイテムを所有していないか、既に販売中です。", ephemeral=True)
+            return
+        
+        thread_id, message_id, tags, score = row
+        self.bot.message_index.set(self.item_id, message_id)
+
+        # Update Gallery Message
+        try:
+            guild = interaction.guild
+            thread = guild.get_thread(thread_id)
+            if not thread:
+                 try: thread = await guild.fetch_channel(thread_id)
+                 except: pass
             
-            await interaction.response.send_message(f"✅ **再販設定完了(DBのみ)**: 元のメッセージが見つかりませんでしたが、販売リストには追加されました。")
+            if thread:
+                 try:
+                     msg = await thread.fetch_message(message_id)
+                     
+                     # Edit Embed
+                     embed = msg.embeds[0]
+                     embed.clear_fields()
+                     embed.title = "🔄 再販中 (Resale)"
+                     embed.color = discord.Color.orange()
+                     
+                     tags_str = tags if tags else "None"
+                     grade = "B"
+                     if score >= 9.0: grade = "S"
+                     elif score >= 7.0: grade = "A"
+                     
+                     embed.add_field(name="ID", value=f"**#{self.item_id}**", inline=True)
+                     embed.add_field(name="販売者", value=interaction.user.mention, inline=True)
+                     embed.add_field(name="価格", value=f"💰 {price:,}", inline=True)
+                     embed.add_field(name="グレード", value=f"**{grade}** ({score:.2f})", inline=True)
+                     embed.add_field(name="特徴 (Tags)", value=tags_str, inline=False)
+                     
+                     from cogs.market import BuyView
+                     await msg.edit(content=f"📢 **再販中!** (ID: {self.item_id})", embed=embed, view=BuyView(self.bot))
+                     
+                     await interaction.response.send_message(f"✅ **再販設定完了！** (ID: {self.item_id}, Price: {price:,})\n🔗 {msg.jump_url}")
+                     return
+                 except Exception as e:
+                     print(f"Failed to edit msg: {e}")
+        except Exception as e:
+            print(f"Resell Error: {e}")
+        
+        await interaction.response.send_message(f"✅ **再販設定完了(DBのみ)**: 元のメッセージが見つかりませんでしたが、販売リストには追加されました。")
 
 class ResellSelect(discord.ui.Select):
     def __init__(self, bot, items):
@@ -186,98 +234,234 @@ class ResellSelectView(discord.ui.View):
 class BrokerCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.ai_client_score = None
-        self.ai_client_tag = None
-        self.setup_clients()
+        # Gradio Spaces / local ONNX / mock, chosen by INFERENCE_BACKEND
+        self.backend = create_backend(hf_token=getattr(self.bot, 'hf_token', None))
+        # Warmed up in the background (cog_load) so loading the cog never
+        # waits on Hugging Face; state: loading -> ready / failed (retrying)
+        self.ai_state = "loading"
+        self.ai_error = None
+        self.ai_ready = asyncio.Event()
+        self.ai_warmup_secs = None
+        self._warmup_task = None
         
-        # AI Queue System
-        self.ai_queue = asyncio.Queue()
-        self.ai_worker_task = self.bot.loop.create_task(self.ai_worker())
+        # AI worker pool: bounded queue + workers per model, so the tagger
+        # and scorer run side by side and a slow model only backs up itself
+        self.ai_pool = InferencePool()
+        for task_type, workers in (('tag', TAGGER_CONCURRENCY), ('score', SCORER_CONCURRENCY)):
+            self.ai_pool.add_model(
+                task_type, workers=workers, queue_size=AI_QUEUE_SIZE,
+                max_batch=AI_MAX_BATCH, max_delay=AI_BATCH_WAIT_MS / 1000,
+                batch_fn=self._batch_fn(task_type) if self.backend.supports_batch else None,
+                timeout=self.backend.timeout
+            )
+        # A sleeping or broken Space fails fast instead of tying up workers;
+        # a full queue is our own backpressure, not a model failure
+        self.breakers = {
+            task_type: CircuitBreaker(
+                f"ai:{task_type}", threshold=AI_BREAKER_THRESHOLD, backoff=AI_BREAKER_BACKOFF,
+                max_backoff=AI_BREAKER_BACKOFF_MAX, ignore=(InferenceBusy,), probe_timeout=self.backend.timeout
+            )
+            for task_type in ('tag', 'score')
+        }
+        self.ai_rate_limit = RateLimiter(AI_USER_RATE_PER_MIN, AI_USER_BURST)
+        self.payload_stats = {task_type: PayloadStats(AI_UPLINK_MBPS) for task_type in AI_PREPROCESS}
+        # Raw predict() outputs by image SHA-256; hits never reach the pool
+        self.ai_cache = InferenceCache(
+            self.bot.bank, maxsize=AI_CACHE_SIZE,
+            max_age=AI_CACHE_MAX_AGE_DAYS * 86400, max_rows=AI_CACHE_MAX_ROWS
+        )
         
         # self.daily_task_loop.start() # Removed
 
-    def cog_unload(self):
-        # self.daily_task_loop.cancel() # Removed
-        self.ai_worker_task.cancel()
-
-    def setup_clients(self):
-        try:
-            token = getattr(self.bot, 'hf_token', None)
-            self.ai_client_score = Client("Eugeoter/waifu-scorer-v3", token=token)
-            self.ai_client_tag = Client("SmilingWolf/wd-tagger", token=token)
-            print("Broker AI Clients Loaded.")
-        except Exception as e:
-            print(f"Broker AI Clients Error: {e}")
-            self.ai_client_score = None
-            self.ai_client_tag = None
-
+    async def cog_load(self):
+        self.ai_pool.start()
+        self._warmup_task = asyncio.create_task(self.setup_clients())
 
-
-    async def ai_worker(self):
-        """Worker to process AI requests sequentially."""
-        print("AI Worker Started.")
+    async def cog_unload(self):
+        # self.daily_task_loop.cancel() # Removed
+        if self._warmup_task:
+            self._warmup_task.cancel()
+        await self.ai_pool.stop()
+        self.backend.close()
+
+    async def setup_clients(self):
+        """Background warm-up of the inference backend, retried with backoff."""
+        start = perf_counter()
+        delay = 5
         while True:
+            self.ai_state = "loading"
             try:
-                # task_type: 'tag' or 'score'
-                # future: asyncio.Future to set result
-                task_type, file_path, future = await self.ai_queue.get()
-                
-                try:
-                    res = None
-                    if task_type == 'tag':
-                        res = await asyncio.to_thread(self._run_predict_sync, self.ai_client_tag, file_path)
-                    elif task_type == 'score':
-                        res = await asyncio.to_thread(self._run_predict_sync, self.ai_client_score, file_path)
-                    
-                    if not future.done():
-                        future.set_result(res)
-                except Exception as e:
-                    if not future.done():
-                        future.set_exception(e)
-                finally:
-                    self.ai_queue.task_done()
-                    
-            except asyncio.CancelledError:
+                await asyncio.to_thread(self.backend.load)
                 break
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                print(f"AI Worker Error: {e}")
-
-
-
-    def _run_predict_sync(self, client, file_path):
-        """Run prediction in a separate thread"""
+                self.ai_state = "failed"
+                self.ai_error = str(e)
+                print(f"Broker AI Backend Error ({self.backend.name}): {e} (retry in {delay}s)")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, AI_WARMUP_RETRY_MAX)
+        self.ai_warmup_secs = perf_counter() - start
+        self.ai_state = "ready"
+        self.ai_error = None
+        self.ai_ready.set()
+        print(f"Broker AI Backend Loaded: {self.backend.name} ({self.ai_warmup_secs:.2f}s)")
+        if hasattr(self.bot, "mark_startup"):
+            self.bot.mark_startup("ai")
+
+    async def wait_until_ai_ready(self, ctx):
+        """True once the backend is usable; tells the user if it has to wait or gives up."""
+        if self.ai_ready.is_set():
+            return True
+        if self.ai_state == "failed":
+            await ctx.send(f"⚠️ 鑑定AIに接続できません。再接続を試行中です。しばらくしてから再度お試しください。\n(`{self.ai_error}`)")
+            return False
+        await ctx.send("⏳ 鑑定AIを準備中です。少々お待ちください...")
         try:
-             return client.predict(handle_file(file_path), api_name="/predict")
-        except Exception as e:
-             print(f"Prediction Error: {e}")
-             raise e
-
-    def calculate_phash(self, image_path):
-        with Image.open(image_path) as img:
-            return str(imagehash.phash(img))
-
-    async def get_risk_factor(self, current_hash):
-        if not current_hash:
+            await asyncio.wait_for(self.ai_ready.wait(), AI_READY_WAIT)
+        except asyncio.TimeoutError:
+            await ctx.send("⚠️ 鑑定AIの準備が間に合いませんでした。しばらくしてから再度お試しください。")
+            return False
+        return True
+
+    def ai_retry_in(self):
+        """Seconds until the AI path takes new work again (0 = available now)."""
+        return max((b.retry_in() for b in self.breakers.values() if not b.available()), default=0.0)
+
+    def _batch_fn(self, task_type):
+        """Pool batch callback: one backend call for a batch of (task_type, image bytes) jobs."""
+        def run(arg_list):
+            return self.backend.predict_batch(task_type, [data for _, data in arg_list])
+        return run
+
+
+
+    def _cache_id(self, task_type):
+        """`(model, version)` the inference cache keys this model's results on."""
+        model, version = self.backend.model_id(task_type)
+        size, fit = AI_PREPROCESS[task_type]
+        if size:
+            # Preprocessed inputs can score slightly differently
+            version = f"{version}@{fit}{size}"
+        return model, version
+
+    async def _cached(self, task_type, digest):
+        """Cached result of `task_type` for the image with SHA-256 `digest`, or None."""
+        if not digest:
+            return None
+        return await self.ai_cache.get(digest, *self._cache_id(task_type))
+
+    async def _predict(self, task_type, payload, digest=None, key=None, priority=False, cached=None):
+        """Runs one model call on that model's worker pool (InferenceBusy if full).
+
+        `payload` is the image already shrunk for this model (see
+        `_prepare_upload`). `cached` is the result of an earlier `_cached`
+        lookup; when given, no call is made. With `digest` (SHA-256 of the
+        original bytes) a fresh result is stored to the inference cache.
+        `key` is the `(guild_id, user_id)` the job is queued fairly under;
+        `priority` puts it ahead of the queue.
+        """
+        if cached is not None:
+            return cached
+
+        stats = self.payload_stats[task_type]
+        start = perf_counter()
+        with self.breakers[task_type]:
+            result = await self.ai_pool.run(
+                task_type, self.backend.predict, task_type, payload, key=key, priority=priority
+            )
+        stats.record_call(perf_counter() - start)
+        if digest:
+            await self.ai_cache.put(digest, *self._cache_id(task_type), result)
+        return result
+
+    @staticmethod
+    def _label_names(label):
+        """Names from a gradio Label output ({"confidences": [...]}) or a plain dict."""
+        if isinstance(label, dict):
+            if "confidences" in label:
+                return [c["label"] for c in label["confidences"] if c.get("label")]
+            return list(label.keys())
+        return []
+
+    async def _run_tagger(self, payload, digest=None, key=None, priority=False, cached=None):
+        """wd-tagger -> (tag_list, tags_str, character_list).
+
+        Backends return (general tags as "a, b, c", rating, characters, general).
+        """
+        result = await self._predict('tag', payload, digest, key, priority, cached)
+        if not isinstance(result, (list, tuple)):
+            result = [result]
+
+        tags_str = result[0] if result and isinstance(result[0], str) else ""
+        tag_list = [t.strip() for t in tags_str.split(",") if t.strip()]
+        character_list = self._label_names(result[2]) if len(result) > 2 else []
+        return tag_list, ", ".join(tag_list), character_list
+
+    async def _run_scorer(self, payload, digest=None, key=None, priority=False, cached=None):
+        """waifu-scorer -> aesthetic score (float)."""
+        result = await self._predict('score', payload, digest, key, priority, cached)
+        if isinstance(result, (list, tuple)):
+            result = result[0]
+        if isinstance(result, (int, float)):
+            return float(result)
+        match = re.search(r"-?\d+(?:\.\d+)?", str(result))
+        if not match:
+            raise ValueError(f"スコアを解析できません: {result}")
+        return float(match.group())
+
+    async def _prepare_upload(self, data):
+        """pHash and per-model payloads from one decode in the image service.
+
+        Returns `(phash, {task_type: payload})`; a model with no input size
+        gets the original bytes.
+        """
+        targets = {task_type: (size, fit) for task_type, (size, fit) in AI_PREPROCESS.items() if size}
+        img_hash, prepared = await self.bot.image_service.analyze(data, targets, AI_UPLOAD_QUALITY)
+        payloads = {}
+        for task_type in AI_PREPROCESS:
+            payload, secs = prepared.get(task_type, (data, 0.0))
+            if task_type in prepared:
+                self.payload_stats[task_type].record_prepare(len(data), len(payload), secs)
+            payloads[task_type] = payload
+        return img_hash, payloads
+
+    async def _read_attachment(self, attachment):
+        """Reads the attachment into memory (size-capped).
+
+        Returns `(bytes, sha256 hex)`; raises ValueError with a
+        user-facing message when the image is too large.
+        """
+        limit = f"画像サイズが大きすぎます (上限 {MAX_IMAGE_MB:g} MB)。"
+        if attachment.size and attachment.size > MAX_IMAGE_BYTES:
+            raise ValueError(limit)
+        data = await attachment.read()
+        if len(data) > MAX_IMAGE_BYTES:
+            raise ValueError(limit)
+        return data, hashlib.sha256(data).hexdigest()
+
+    async def get_risk_factor(self, current_hash, digest=None):
+        # Byte-identical re-upload: Bloom filter, then one index lookup
+        if digest is not None:
+            async with self.bot.bank.acquire() as db:
+                item_id = await self.bot.content_index.find(db, digest)
+            if item_id is not None:
+                return 100, f"同一画像あり (#{item_id})", 0
+            if current_hash is None:
+                return 0, "OK", None
+
+        if current_hash is None:
             return 10, "Unknown Error", 0
         
-        async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db:
-            cursor = await db.execute("SELECT image_hash FROM market_items WHERE image_hash IS NOT NULL")
-            rows = await cursor.fetchall()
-
-        current_hash_obj = imagehash.hex_to_hash(current_hash)
-        min_dist = 100
+        # One vectorized Hamming scan over the whole catalog
+        closest = self.bot.phash_index.closest(current_hash, k=3)
+        if not closest:
+            return 0, "OK", 100
         
-        for (db_hash_str,) in rows:
-            try:
-                db_hash_obj = imagehash.hex_to_hash(db_hash_str)
-                dist = current_hash_obj - db_hash_obj
-                if dist < min_dist:
-                    min_dist = dist
-            except:
-                continue
-
-        if min_dist <= 5:
-            return 100, f"類似画像あり (類似度: {min_dist})", min_dist
+        min_dist = closest[0][1]
+        if min_dist <= DUPLICATE_DISTANCE:
+            similar = ", ".join(f"#{item_id}" for item_id, dist in closest if dist <= DUPLICATE_DISTANCE)
+            return 100, f"類似画像あり (類似度: {min_dist}, {similar})", min_dist
         else:
             return 0, "OK", min_dist
 
@@ -324,25 +508,26 @@ class BrokerCog(commands.Cog):
         forum = discord.utils.get(ctx.guild.forums, name="ギャラリー")
         if not forum: forum = discord.utils.get(ctx.guild.forums, name="闇市ギャラリー")
 
-        async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db:
+        async with self.bot.bank.acquire() as db:
             # Check existing gallery registration
             cursor = await db.execute("SELECT thread_id FROM user_galleries WHERE user_id = ?", (ctx.author.id,))
             row = await cursor.fetchone()
             
-            if not row and forum:
-                try:
-                    thread_with_message = await forum.create_thread(
-                        name=f"Gallery: {ctx.author.display_name}",
-                        content=f"{ctx.author.mention} のギャラリー"
-                    )
-                    t = thread_with_message.thread if hasattr(thread_with_message, 'thread') else thread_with_message
-                    
+        if not row and forum:
+            try:
+                thread_with_message = await forum.create_thread(
+                    name=f"Gallery: {ctx.author.display_name}",
+                    content=f"{ctx.author.mention} のギャラリー"
+                )
+                t = thread_with_message.thread if hasattr(thread_with_message, 'thread') else thread_with_message
+                
+                async def register(db):
                     await db.execute("INSERT INTO user_galleries (user_id, thread_id) VALUES (?, ?)", (ctx.author.id, t.id))
                     # Bonus for new joining
                     await self.bot.bank.deposit_credits(ctx.author, 3000, db_conn=db)
-                    await db.commit()
-                except Exception as e:
-                    print(f"Gallery creation failed: {e}")
+                await self.bot.bank.submit_write(register)
+            except Exception as e:
+                print(f"Gallery creation failed: {e}")
 
         # 3. Private Room Setup
         try:
@@ -399,15 +584,37 @@ class BrokerCog(commands.Cog):
             return
 
         image_url = attachment.url
+        if not await self.wait_until_ai_ready(ctx):
+            return
+        retry_in = self.ai_retry_in()
+        if retry_in:
+            await ctx.send(f"⚠️ 鑑定AIが応答していません。約 {retry_in:.0f} 秒後に再度お試しください。")
+            return
+        # Fair share of the appraisal queue per user; admins go first
+        queue_key = (ctx.guild.id if ctx.guild else None, ctx.author.id)
+        priority = AI_ADMIN_PRIORITY and ctx.author.guild_permissions.administrator
         await ctx.send("処理中...")
 
-        # 1. Download & Hash
-        temp_path, img_hash = await self._download_and_hash(image_url)
-        if not temp_path:
+        # 1. Read (in memory)
+        try:
+            data, digest = await self._read_attachment(attachment)
+        except ValueError as e:
+            await ctx.send(f"❌ {e}")
+            return
+        except Exception as e:
+            print(f"Download Error: {e}")
             await ctx.send("ダウンロード失敗。")
             return
 
         try:
+            # Exact copies are turned away before any hashing or AI calls
+            is_dup, dup_msg, _ = await self.get_risk_factor(None, digest)
+            if is_dup >= 50:
+                 await ctx.send(f"エラー: {dup_msg}")
+                 return
+
+            # One decode: the pHash and both models' inputs
+            img_hash, payloads = await self._prepare_upload(data)
             is_dup, dup_msg, _ = await self.get_risk_factor(img_hash)
             
             if is_dup >= 50:
@@ -416,8 +623,31 @@ class BrokerCog(commands.Cog):
 
             await ctx.send(f"アップロード完了。鑑定中...")
             
-            tag_list, tags_str, character_list = await self._run_tagger(temp_path)
-            score = await self._run_scorer(temp_path)
+            # Cached results need no queue slot: look both up first, then make
+            # sure every model that missed has room before either is queued
+            cached = {task_type: await self._cached(task_type, digest) for task_type in AI_PREPROCESS}
+            missing = [task_type for task_type, result in cached.items() if result is None]
+            if missing:
+                # A breaker may have opened since the pre-check; don't run one
+                # model only to throw its result away because the other is down
+                down = [self.breakers[task_type] for task_type in missing if not self.breakers[task_type].available()]
+                if down:
+                    raise CircuitOpen(down[0].name, max(breaker.retry_in() for breaker in down))
+                self.ai_pool.check(*missing)
+                # Only appraisals that reach the models spend the user's budget
+                # (duplicates and fully cached images are free)
+                if not priority:
+                    wait = self.ai_rate_limit.take(queue_key)
+                    if wait:
+                        await ctx.send(f"⏳ 鑑定の依頼が多すぎます。約 {wait:.0f} 秒後に再度お試しください。")
+                        return
+            # Both models at once: latency is the slower call, not the sum
+            appraise_start = perf_counter()
+            (tag_list, tags_str, character_list), score = await asyncio.gather(
+                self._run_tagger(payloads['tag'], digest, queue_key, priority, cached['tag']),
+                self._run_scorer(payloads['score'], digest, queue_key, priority, cached['score']),
+            )
+            print(f"Appraisal: {perf_counter() - appraise_start:.2f}s")
             
             # 5. Pricing
             final_price, trend_bonus, matched_trends, char_bonus, rarity_mult, rare_tags = await self._calculate_price(score, tag_list, character_list)
@@ -427,50 +657,67 @@ class BrokerCog(commands.Cog):
             if score >= 9.0: grade = "S"
             elif score >= 7.0: grade = "A"
             
-            # 7. Post to Gallery & DB Insert
-            item_id = None
-            async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db:
+            # 7. DB Insert & Post to Gallery. The row stays 'pending' (not
+            # buyable or listed) until settle() links the gallery message.
+            async def insert_item(db):
                 cursor = await db.execute(
                     """
-                    INSERT INTO market_items (seller_id, image_url, aesthetic_score, price, status, image_hash, tags, grade, thread_id, message_id)
-                    VALUES (?, ?, ?, ?, 'on_sale', ?, ?, ?, 0, 0)
+                    INSERT INTO market_items (seller_id, image_url, aesthetic_score, price, status, phash, content_sha256, tags, characters, grade, thread_id, message_id)
+                    VALUES (?, ?, ?, ?, 'pending', ?, ?, ?, ?, ?, 0, 0)
                     """,
-                    (self.bot.user.id, image_url, score, int(final_price * 1.5), img_hash, str(tag_list), grade)
+                    (self.bot.user.id, image_url, score, int(final_price * 1.5), to_db(img_hash), digest, str(tag_list),
+                     ", ".join(character_list) or None, grade)
                 )
-                item_id = cursor.lastrowid
-                
-                embed = discord.Embed(title=f"📦 新規入荷 (ID: #{item_id})", color=discord.Color.blue())
-                embed.set_image(url=image_url)
-                embed.add_field(name="販売者", value=self.bot.user.mention, inline=True)
-                embed.add_field(name="価格", value=f"{int(final_price * 1.5):,} Credits", inline=True)
-                embed.add_field(name="グレード", value=f"**{grade}** ({score:.2f})", inline=True)
-                
-                if character_list:
-                    chars_str = ", ".join(character_list)
-                    embed.add_field(name="キャラクター", value=f"{chars_str}", inline=True)
-                embed.add_field(name="タグ", value=tags_str[:1000], inline=False)
-                
-                try:
-                    await self._post_to_gallery(ctx, embed, temp_path, tags_str, item_id, grade, final_price, tag_list, image_url, img_hash, db_conn=db)
-                    await db.commit()
-                except Exception as e:
-                    await ctx.send(f"エラー: {e}")
-                    traceback.print_exc()
-                    return
+                await write_item_tags(db, cursor.lastrowid, tag_list)
+                return cursor.lastrowid
+            item_id = await self.bot.bank.submit_write(insert_item)
+            self.bot.phash_index.add(item_id, img_hash)
+            self.bot.content_index.add(item_id, digest)
+            
+            embed = discord.Embed(title=f"📦 新規入荷 (ID: #{item_id})", color=discord.Color.blue())
+            embed.set_image(url=image_url)
+            embed.add_field(name="販売者", value=self.bot.user.mention, inline=True)
+            embed.add_field(name="価格", value=f"{int(final_price * 1.5):,} Credits", inline=True)
+            embed.add_field(name="グレード", value=f"**{grade}** ({score:.2f})", inline=True)
+            
+            if character_list:
+                chars_str = ", ".join(character_list)
+                embed.add_field(name="キャラクター", value=f"{chars_str}", inline=True)
+            embed.add_field(name="タグ", value=tags_str[:1000], inline=False)
+            
+            try:
+                await self._post_to_gallery(ctx, embed, data, tags_str, item_id, grade, final_price, tag_list, image_url, img_hash)
+            except Exception as e:
+                # The listing never went on sale; take the pending row back out
+                removed = await self.bot.bank.execute_write(
+                    "DELETE FROM market_items WHERE item_id = ? AND status = 'pending'", (item_id,)
+                )
+                if removed:
+                    self.bot.phash_index.remove(item_id)
+                    self.bot.message_index.remove_item(item_id)
+                await ctx.send(f"エラー: {e}")
+                traceback.print_exc()
+                return
 
+        except InferenceBusy as e:
+            await ctx.send(f"⏳ 鑑定所が混雑しています。約 {e.eta:.0f} 秒後に再度お試しください。")
+        except CircuitOpen as e:
+            await ctx.send(f"⚠️ 鑑定AIが応答していません。約 {e.retry_in:.0f} 秒後に再度お試しください。")
+        except TimeoutError as e:
+            await ctx.send("⌛ 鑑定AIが時間内に応答しませんでした。しばらくしてから再度お試しください。")
+            print(f"Appraisal timeout: {e}")
         except Exception as e:
             await ctx.send(f"エラーが発生しました: {e}")
             traceback.print_exc()
-        finally:
-             if os.path.exists(temp_path): os.remove(temp_path)
 
-    async def _post_to_gallery(self, ctx, embed, temp_path, tags_str, item_id, grade, final_price, tag_list, image_url, img_hash, db_conn):
+    async def _post_to_gallery(self, ctx, embed, data, tags_str, item_id, grade, final_price, tag_list, image_url, img_hash):
         """Handles posting to the appropriate thread or forum."""
         bot_thread = None
         
-        # 1. Fetch User Gallery (Using shared conn)
-        cursor = await db_conn.execute("SELECT thread_id FROM user_galleries WHERE user_id = ?", (self.bot.user.id,))
-        row = await cursor.fetchone()
+        # 1. Fetch User Gallery
+        async with self.bot.bank.acquire() as db:
+            cursor = await db.execute("SELECT thread_id FROM user_galleries WHERE user_id = ?", (self.bot.user.id,))
+            row = await cursor.fetchone()
         if row:
             bot_thread = ctx.guild.get_thread(row[0])
             if not bot_thread:
@@ -488,7 +735,7 @@ class BrokerCog(commands.Cog):
             message = await bot_thread.send(
                 content=f"**販売:** (ID: #{item_id})",
                 embed=embed,
-                file=discord.File(temp_path, filename="artifact.png"),
+                file=discord.File(io.BytesIO(data), filename=f"artifact{image_suffix(data)}"),
                 view=view
             )
             await ctx.send(f"✅ 出品完了 (ID: {item_id})\n{message.jump_url}")
@@ -504,7 +751,7 @@ class BrokerCog(commands.Cog):
                         name=title,
                         content=f"**販売:** (ID: #{item_id})",
                         embed=embed,
-                        file=discord.File(temp_path, filename="artifact.png"),
+                        file=discord.File(io.BytesIO(data), filename=f"artifact{image_suffix(data)}"),
                         view=view
                     )
                     thread_ref = thread_with_message.thread if hasattr(thread_with_message, 'thread') else thread_with_message
@@ -516,15 +763,18 @@ class BrokerCog(commands.Cog):
                     await ctx.send("フォーラムが見つかりません。")
                     raise Exception("Gallery Forum Not Found")
 
-        # DB Updates & Payment
-        await self.bot.bank.deposit_credits(ctx.author, final_price, db_conn=db_conn)
-
-        
-        # Link Update
-        await db_conn.execute(
-            "UPDATE market_items SET thread_id = ?, message_id = ? WHERE item_id = ?",
-            (thread_ref.id, message.id if message else 0, item_id)
-        )
+        # DB Updates & Payment (one writer operation): the item goes on sale
+        # together with its message link and the seller's payout
+        async def settle(db):
+            cursor = await db.execute(
+                "UPDATE market_items SET thread_id = ?, message_id = ?, status = 'on_sale' WHERE item_id = ? AND status = 'pending'",
+                (thread_ref.id, message.id if message else 0, item_id)
+            )
+            if cursor.rowcount == 0:
+                raise LookupError(f"item #{item_id} is no longer pending")
+            await self.bot.bank.deposit_credits(ctx.author, final_price, db_conn=db)
+        await self.bot.bank.submit_write(settle)
+        self.bot.message_index.set(item_id, message.id if message else 0)
         
         await ctx.send(f"💰 報酬: `{final_price:,} Credits`")
 
@@ -535,27 +785,38 @@ class BrokerCog(commands.Cog):
     @commands.command(name="inventory", aliases=["bag", "inv"])
     async def inventory(self, ctx):
         """自分が所有している(購入済み)アイテムを表示します。"""
-        async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db:
+        owner_id = ctx.author.id
+
+        # Pages are read on button press (keyset on item_id), never the whole bag
+        async def fetch(db, before_id, limit):
             cursor = await db.execute("""
                 SELECT item_id, tags, thread_id, aesthetic_score 
                 FROM market_items 
-                WHERE buyer_id = ? AND status IN ('sold', 'owned')
-            """, (ctx.author.id,))
-            rows = await cursor.fetchall()
-            
-        if not rows:
+                WHERE buyer_id = ? AND status IN ('sold', 'owned') AND item_id < ?
+                ORDER BY item_id DESC LIMIT ?
+            """, (owner_id, before_id, limit))
+            return await cursor.fetchall()
+
+        async def count(db):
+            cursor = await db.execute(
+                "SELECT COUNT(*) FROM market_items WHERE buyer_id = ? AND status IN ('sold', 'owned')", (owner_id,)
+            )
+            return (await cursor.fetchone())[0]
+
+        pager = KeysetPager(self.bot.bank, fetch, count, per_page=5)
+        if not await pager.refresh_count():
             await ctx.send("🎒 **持ち物:** 何も持っていません。ギャラリーで購入するか、密輸してください。")
             return
 
-        view = InventoryView(ctx, rows, per_page=5)
-        await ctx.send(embed=view.get_embed(), view=view)
+        view = InventoryView(ctx, pager)
+        await ctx.send(embed=await view.get_embed(), view=view)
 
 
 
     @commands.command(name="resell")
     async def resell(self, ctx):
         """所有しているアイテムを選択して再販します。"""
-        async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db:
+        async with self.bot.bank.acquire() as db:
             cursor = await db.execute("""
                 SELECT item_id, tags, aesthetic_score 
                 FROM market_items 
@@ -574,10 +835,149 @@ class BrokerCog(commands.Cog):
     @commands.command(name="reset_risk")
     async def reset_risk(self, ctx):
         """(Debug) Clears all image hashes from the database to reset pHash risk."""
-        async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db:
-            await db.execute("UPDATE market_items SET image_hash = NULL")
-            await db.commit()
+        await self.bot.bank.execute_write("UPDATE market_items SET image_hash = NULL, phash = NULL, content_sha256 = NULL")
+        self.bot.phash_index.clear()
+        self.bot.content_index.clear()
         await ctx.send("🔄 **記憶消去完了。** 当局は押収品に関するデータを失いました。\nこれで再び低リスクで密輸できます！")
 
+    @commands.command(name="dup_audit")
+    @commands.has_permissions(administrator=True)
+    async def dup_audit(self, ctx, distance: int = DUPLICATE_DISTANCE, mode: str = None):
+        """(管理者) 全カタログの重複クラスタ監査 (`!dup_audit [距離] [rehash]`)"""
+        rehash = mode == "rehash"
+        msg = await ctx.send("🔍 **重複監査中...**" + (" (ハッシュ消去済みの画像を再取得します)" if rehash else ""))
+
+        async with self.bot.bank.acquire() as db:
+            clusters, summary = await run_audit(db, distance, rehash=rehash, image_service=self.bot.image_service)
+
+        async def save(db):
+            await write_clusters(db, clusters, summary["max_distance"])
+        await self.bot.bank.submit_write(save)
+
+        embed = discord.Embed(title="🔍 重複クラスタ監査", color=discord.Color.orange())
+        embed.add_field(name="スキャン", value=f"{summary['scanned']:,} 件 (ハッシュなし: {summary['missing_hash']:,})", inline=True)
+        embed.add_field(name="クラスタ", value=f"{summary['clusters']:,} 個 / {summary['clustered_items']:,} 件", inline=True)
+        embed.add_field(name="所要時間", value=f"{summary['elapsed']:.2f}s", inline=True)
+        if summary["histogram"]:
+            sizes = "\n".join(f"{size}件: {count}" for size, count in sorted(summary["histogram"].items(), reverse=True)[:10])
+            embed.add_field(name="サイズ分布", value=sizes, inline=True)
+            largest = "\n".join(f"#{cluster_id}: {size}件" for cluster_id, size in summary["largest"])
+            embed.add_field(name="最大クラスタ", value=largest, inline=True)
+        footer = f"距離 ≤ {summary['max_distance']} / 結果は dup_clusters テーブルに保存"
+        if summary["capped"]:
+            footer += f" (距離 {distance} は処理が重いため {summary['max_distance']} に制限しました)"
+        embed.set_footer(text=footer)
+        await msg.edit(content=None, embed=embed)
+
+    @commands.command(name="sha_backfill")
+    @commands.has_permissions(administrator=True)
+    async def sha_backfill(self, ctx, limit: int = None):
+        """(管理者) SHA-256 が未登録の出品画像を再取得して登録 (`!sha_backfill [件数]`)"""
+        msg = await ctx.send("🔁 **SHA-256 バックフィル中...**")
+        start = perf_counter()
+        async with self.bot.bank.acquire() as db:
+            updates, failed = await backfill(db, limit)
+
+        async def save(db):
+            await write_backfill(db, updates)
+        await self.bot.bank.submit_write(save)
+        for digest, item_id in updates:
+            self.bot.content_index.add(item_id, digest)
+        self.bot.content_index.save()
+
+        s = self.bot.content_index.stats()
+        await msg.edit(content=(
+            f"✅ **SHA-256 バックフィル完了** ({perf_counter() - start:.1f}s)\n"
+            f"登録: {len(updates):,} 件 / 取得失敗: {failed:,} 件\n"
+            f"Bloom filter: {s['entries']:,}/{s['capacity']:,} 件, {s['size_kb']:.0f} KB, 誤検出率 {s['fp_rate']:.2%}"
+        ))
+
+    @commands.command(name="ai_queue")
+    @commands.has_permissions(administrator=True)
+    async def ai_queue(self, ctx, member: discord.Member = None):
+        """(管理者) 鑑定キューのユーザー別統計 (`!ai_queue [@user]`)"""
+        key = (ctx.guild.id, member.id) if member else None
+        embed = discord.Embed(title="AI Queue (per user)", color=discord.Color.dark_grey())
+        r = self.ai_rate_limit.stats()
+        limit = f"{r['per_minute']:g}/min, burst {r['burst']:g}" if r['enabled'] else "off"
+        embed.description = (
+            f"rate limit: {limit} / allowed {r['allowed']:,} / limited {r['limited']:,}\n"
+            f"admin priority: {'on' if AI_ADMIN_PRIORITY else 'off'}"
+        )
+        for model, users in self.ai_pool.user_stats(key).items():
+            lines = []
+            for (guild_id, user_id), s in users.items():
+                lines.append(
+                    f"<@{user_id}> queued {s['depth']} / done {s['completed']:,}/{s['submitted']:,} / rejected {s['rejected']:,}\n"
+                    f"　wait avg {s['avg_wait_ms']:.0f} ms, p99 {s['p99_wait_ms']:.0f} ms, max {s['max_wait_ms']:.0f} ms"
+                )
+            embed.add_field(name=model, value="\n".join(lines)[:1024] or "データなし", inline=False)
+        await ctx.send(embed=embed)
+
+    @commands.command(name="ai_stats")
+    @commands.has_permissions(administrator=True)
+    async def ai_stats(self, ctx):
+        """(管理者) AI推論プールのキュー長・待ち時間・処理時間"""
+        embed = discord.Embed(title="AI Inference Pool", color=discord.Color.dark_grey())
+        state = self.ai_state
+        if self.ai_warmup_secs is not None:
+            state += f" (warm-up {self.ai_warmup_secs:.2f}s)"
+        elif self.ai_error:
+            state += f": {self.ai_error[:200]}"
+        embed.add_field(name=f"backend: {self.backend.name}", value=state, inline=False)
+        timings = getattr(self.bot, "startup_timings", {})
+        if timings:
+            embed.add_field(
+                name="startup",
+                value=" / ".join(f"{name} {secs:.2f}s" for name, secs in timings.items()),
+                inline=False
+            )
+        for model, s in self.ai_pool.stats().items():
+            embed.add_field(
+                name=f"{model} ({s['busy']}/{s['workers']} busy)",
+                value=(f"queue: {s['depth']}/{s['queue_size']} (max {s['max_depth']}), ETA {s['eta']:.0f}s\n"
+                       f"done: {s['completed']:,} / failed: {s['failed']:,} / rejected: {s['rejected']:,} / timeouts: {s['timeouts']:,}\n"
+                       f"batches: {s['batches']:,} (avg {s['avg_batch']:.1f}, max {s['max_batch']})\n"
+                       f"wait avg {s['avg_wait_ms']:.0f} ms / p99 {s['p99_wait_ms']:.0f} ms / max {s['max_wait_ms']:.0f} ms\n"
+                       f"service avg {s['avg_service_ms']:.0f} ms / max {s['max_service_ms']:.0f} ms"),
+                inline=False
+            )
+        for b in self.breakers.values():
+            s = b.stats()
+            value = f"failures: {s['failures']} / trips: {s['trips']:,} / fast-failed: {s['rejected']:,}"
+            if s['state'] != "closed":
+                value += f"\nnext probe in {s['retry_in']:.0f}s (backoff {s['backoff']:.0f}s)"
+            if s['last_error']:
+                value += f"\nlast error: {s['last_error'][:150]}"
+            for at, old, new, reason in s['transitions'][-3:]:
+                value += f"\n<t:{int(at)}:T> {old} → {new} ({reason[:80]})"
+            embed.add_field(name=f"{b.name} breaker: {s['state']} (timeout {self.backend.timeout:.0f}s)", value=value, inline=False)
+        i = self.bot.image_service.stats()
+        embed.add_field(
+            name=f"image service ({i['processes']} processes)",
+            value=(f"jobs: {i['jobs']:,} / failed: {i['failed']:,}\n"
+                   + " / ".join(f"{stage} {i[stage]['avg_ms']:.1f} ms" for stage in ("decode", "downscale", "hash", "overhead"))),
+            inline=False
+        )
+        for task_type, stats in self.payload_stats.items():
+            p = stats.stats()
+            size, fit = AI_PREPROCESS[task_type]
+            embed.add_field(
+                name=f"{task_type} upload ({f'{fit} side {size}px' if size else 'original'})",
+                value=(f"{p['bytes_in'] / 1e6:,.1f} MB → {p['bytes_out'] / 1e6:,.1f} MB (-{p['saved_ratio']:.0%}), "
+                       f"shrunk {p['shrunk']:,}/{p['images']:,}, prep {p['prepare_ms']:.0f} ms\n"
+                       f"est. latency saved {p['latency_saved_s']:,.1f}s @ {AI_UPLINK_MBPS:g} Mbps, avg call {p['avg_call_ms']:.0f} ms"),
+                inline=False
+            )
+        c = self.ai_cache.stats()
+        embed.add_field(
+            name="inference cache",
+            value=(f"memory: {c['memory_entries']:,}/{c['memory_maxsize']:,}, hit rate {c['hit_rate']:.1%}\n"
+                   f"hits: {c['memory_hits']:,} (mem) + {c['disk_hits']:,} (disk) / misses: {c['misses']:,}\n"
+                   f"stored: {c['stores']:,} / evicted: {c['evicted']:,}"),
+            inline=False
+        )
+        await ctx.send(embed=embed)
+
 async def setup(bot):
     await bot.add_cog(BrokerCog(bot))
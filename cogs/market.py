@@ -1,15 +1,16 @@
 import discord
 from discord.ext import commands, tasks
-from gradio_client import Client, handle_file
 import asyncio
-import aiosqlite
 import os
 import aiohttp
 import uuid
 import traceback
-import imagehash
 from PIL import Image
 from datetime import datetime, timedelta
+from utils.phash_index import DUPLICATE_DISTANCE
+from utils.tag_index import parse_query, search_items
+from utils.item_search import find_items
+from utils.pagination import KeysetPager
 
 class BuyView(discord.ui.View):
     def __init__(self, bot):
@@ -23,125 +24,139 @@ class BuyView(discord.ui.View):
         message_id = interaction.message.id
         buyer = interaction.user
         
-        async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db:
-            cursor = await db.execute("SELECT item_id, price, seller_id, status, image_url, tags FROM market_items WHERE message_id = ?", (message_id,))
-            row = await cursor.fetchone()
-            
+        # Known non-item messages are answered from memory
+        item_id = await self.bot.message_index.resolve(self.bot.bank, message_id)
+        row = None
+        if item_id is not None:
+            async with self.bot.bank.acquire() as db:
+                cursor = await db.execute(
+                    "SELECT item_id, price, seller_id, status, image_url, tags FROM market_items WHERE item_id = ? AND message_id = ?",
+                    (item_id, message_id)
+                )
+                row = await cursor.fetchone()
             if not row:
-                await interaction.response.send_message("❌ データが見つかりません。", ephemeral=True)
-                return
+                # Stale map entry; the next press asks the table again
+                self.bot.message_index.forget(message_id)
             
-            item_id, price, seller_id, status, img_url, tags_str = row
-            img_url = img_url or ""
-            tags_str = tags_str or ""
+        if not row:
+            await interaction.response.send_message("❌ データが見つかりません。", ephemeral=True)
+            return
+        
+        item_id, price, seller_id, status, img_url, tags_str = row
+        img_url = img_url or ""
+        tags_str = tags_str or ""
+        
+        if status != 'on_sale':
+            await interaction.response.send_message("❌ 売り切れです。", ephemeral=True)
+            return
+        
+        if buyer.id == seller_id:
+            await interaction.response.send_message("❌ 自分の商品は購入できません。", ephemeral=True)
+            return
+
+        # Inflation Logic (10% increase)
+        new_price = int(price * 1.1)
+
+        # Pay Seller (With Tax Logic)
+        seller = interaction.guild.get_member(seller_id)
+        payout = 0  # apply_transfers skips zero legs
+        payout_msg = ""
+        if seller_id != self.bot.user.id and seller:
+            # User Resale: 20% Tax
+            tax_rate = 0.2
+            tax_amount = int(price * tax_rate)
+            payout = int(price - tax_amount)
+            payout_msg = f" (販売者へ `{payout:,}` 円送金)"
+
+        async def purchase(db):
+            # Update DB (Ownership transfer, New Price, Reset Lock).
+            # The status guard stops a second buyer who read the row before us.
+            cursor = await db.execute(
+                "UPDATE market_items SET status = 'owned', buyer_id = ?, seller_id = ?, price = ?, is_locked = 0 WHERE item_id = ? AND status = 'on_sale'",
+                (buyer.id, buyer.id, new_price, item_id)
+            )
+            if cursor.rowcount == 0:
+                raise LookupError("sold out")
+            # Buyer debit + seller payout; the tax is the part nobody is credited with
+            await self.bot.bank.apply_transfers([
+                (buyer.id, interaction.guild.id, -price),
+                (seller_id, interaction.guild.id, payout),
+            ], db_conn=db)
+
+        # 2. Check Balance & Process Transaction (ATOMIC, one writer savepoint)
+        try:
+            await self.bot.bank.submit_write(purchase)
+            await interaction.response.send_message(f"✅ 購入しました。\n`{price:,}` 円支払いました。{payout_msg}", ephemeral=True)
+        except ValueError:
+            await interaction.response.send_message(f"❌ 残高不足 ({price:,} 円必要)", ephemeral=True)
+            return
+        except LookupError:
+            await interaction.response.send_message("❌ 売り切れです。", ephemeral=True)
+            return
+        except Exception as e:
+            await interaction.response.send_message(f"❌ エラー: {e}", ephemeral=True)
+            return
             
-            if status != 'on_sale':
-                await interaction.response.send_message("❌ 売り切れです。", ephemeral=True)
-                return
+        # --- Visual Transfer & Logging ---
+        try:
+            # 1. Log to market-logs
+            log_channel = discord.utils.get(interaction.guild.text_channels, name="market-logs")
+            # Fallback
+            if not log_channel: log_channel = discord.utils.get(interaction.guild.text_channels, name="shadow-logs")
             
-            if buyer.id == seller_id:
-                await interaction.response.send_message("❌ 自分の商品は購入できません。", ephemeral=True)
-                return
+            if log_channel:
 
-            # 2. Check Balance & Process Transaction (ATOMIC)
-            try:
-                # Pass 'db' to withdraw_credits so it uses the SAME transaction
-                await self.bot.bank.withdraw_credits(buyer, price, db_conn=db)
-                
-                # Inflation Logic (10% increase)
-                new_price = int(price * 1.1)
+                log_embed = discord.Embed(title="Transaction Log", color=discord.Color.green())
+                log_embed.add_field(name="Item ID", value=f"#{item_id}", inline=True)
+                log_embed.add_field(name="Buyer", value=buyer.mention, inline=True)
+                log_embed.add_field(name="Seller", value=f"<@{seller_id}>" if seller_id else "Unknown", inline=True)
+                log_embed.add_field(name="Price", value=f"{price:,}", inline=True)
+                if img_url: log_embed.set_thumbnail(url=img_url)
+                await log_channel.send(embed=log_embed)
 
-                # Update DB (Ownership transfer, New Price, Reset Lock)
-                await db.execute("UPDATE market_items SET status = 'owned', buyer_id = ?, seller_id = ?, price = ?, is_locked = 0 WHERE item_id = ?", (buyer.id, buyer.id, new_price, item_id))
-                
-                # Pay Seller (With Tax Logic)
-                seller = interaction.guild.get_member(seller_id)
-                payout_msg = ""
-                
-                if seller_id == self.bot.user.id:
-                    # Bot Sale
-                    pass
-                elif seller:
-                    # User Resale: 20% Tax
-                    tax_rate = 0.2
-                    tax_amount = int(price * tax_rate)
-                    payout = int(price - tax_amount)
-                    # Pass 'db' to deposit
-                    await self.bot.bank.deposit_credits(seller, payout, db_conn=db)
-                    payout_msg = f" (販売者へ `{payout:,}` 円送金)"
-                
-                await db.commit() # Commit EVERYTHING together
-                
-                await interaction.response.send_message(f"✅ 購入しました。\n`{price:,}` 円支払いました。{payout_msg}", ephemeral=True)
+            # 2. Cleanup Seller Message
+            try:
+                await interaction.message.delete()
+            except:
+                # Could not delete, maybe edit
+                await interaction.message.edit(content=f"❌ **完売**", view=None, embed=None)
 
-            except ValueError:
-                await interaction.response.send_message(f"❌ 残高不足 ({price:,} 円必要)", ephemeral=True)
-                return
-            except Exception as e:
-                await interaction.response.send_message(f"❌ エラー: {e}", ephemeral=True)
-                return
+            # 3. Post to Buyer's Gallery
+            async with self.bot.bank.acquire() as db_gal:
+                cursor = await db_gal.execute("SELECT thread_id FROM user_galleries WHERE user_id = ?", (buyer.id,))
+                row = await cursor.fetchone()
             
-            # --- Visual Transfer & Logging ---
-            try:
-                # 1. Log to market-logs
-                log_channel = discord.utils.get(interaction.guild.text_channels, name="market-logs")
-                # Fallback
-                if not log_channel: log_channel = discord.utils.get(interaction.guild.text_channels, name="shadow-logs")
-                
-                if log_channel:
-
-                    log_embed = discord.Embed(title="Transaction Log", color=discord.Color.green())
-                    log_embed.add_field(name="Item ID", value=f"#{item_id}", inline=True)
-                    log_embed.add_field(name="Buyer", value=buyer.mention, inline=True)
-                    log_embed.add_field(name="Seller", value=f"<@{seller_id}>" if seller_id else "Unknown", inline=True)
-                    log_embed.add_field(name="Price", value=f"{price:,}", inline=True)
-                    if img_url: log_embed.set_thumbnail(url=img_url)
-                    await log_channel.send(embed=log_embed)
-
-                # 2. Cleanup Seller Message
-                try:
-                    await interaction.message.delete()
-                except:
-                    # Could not delete, maybe edit
-                    await interaction.message.edit(content=f"❌ **完売**", view=None, embed=None)
-
-                # 3. Post to Buyer's Gallery
-                async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db_gal:
-                    cursor = await db_gal.execute("SELECT thread_id FROM user_galleries WHERE user_id = ?", (buyer.id,))
-                    row = await cursor.fetchone()
-                
-                new_thread_id = 0
-                new_msg_id = 0
+            new_thread_id = 0
+            new_msg_id = 0
+            
+            if row:
+                buyer_thread = interaction.guild.get_thread(row[0])
+                if not buyer_thread:
+                     try: buyer_thread = await interaction.guild.fetch_channel(row[0])
+                     except: pass
                 
-                if row:
-                    buyer_thread = interaction.guild.get_thread(row[0])
-                    if not buyer_thread:
-                         try: buyer_thread = await interaction.guild.fetch_channel(row[0])
-                         except: pass
-                    
-                    if buyer_thread:
-                         gallery_embed = discord.Embed(title=f"所持品 (ID: #{item_id})", color=discord.Color.gold())
-                         if img_url: gallery_embed.set_image(url=img_url)
-                         gallery_embed.add_field(name="Tags", value=tags_str, inline=False)
-                         
-                         new_msg = await buyer_thread.send(content=f"**獲得:** {buyer.mention}", embed=gallery_embed)
-                         new_thread_id = buyer_thread.id
-                         new_msg_id = new_msg.id
-                    else:
-                         await interaction.followup.send("ギャラリーが見つかりません。`!join` してください。", ephemeral=True)
+                if buyer_thread:
+                     gallery_embed = discord.Embed(title=f"所持品 (ID: #{item_id})", color=discord.Color.gold())
+                     if img_url: gallery_embed.set_image(url=img_url)
+                     gallery_embed.add_field(name="Tags", value=tags_str, inline=False)
+                     
+                     new_msg = await buyer_thread.send(content=f"**獲得:** {buyer.mention}", embed=gallery_embed)
+                     new_thread_id = buyer_thread.id
+                     new_msg_id = new_msg.id
                 else:
-                     await interaction.followup.send("ギャラリー未登録のため、アイテムは倉庫に保管されました。", ephemeral=True)
-                
-                # Update DB with new location
-                if new_thread_id:
-                     async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db_upd:
-                        await db_upd.execute("UPDATE market_items SET thread_id = ?, message_id = ? WHERE item_id = ?", (new_thread_id, new_msg_id, item_id))
-                        await db_upd.commit()
+                     await interaction.followup.send("ギャラリーが見つかりません。`!join` してください。", ephemeral=True)
+            else:
+                 await interaction.followup.send("ギャラリー未登録のため、アイテムは倉庫に保管されました。", ephemeral=True)
+            
+            # Update DB with new location
+            if new_thread_id:
+                 await self.bot.bank.execute_write("UPDATE market_items SET thread_id = ?, message_id = ? WHERE item_id = ?", (new_thread_id, new_msg_id, item_id))
+                 self.bot.message_index.set(item_id, new_msg_id)
 
-            except Exception as e:
-                print(f"Failed transfer logic: {e}")
-                import traceback
-                traceback.print_exc()
+        except Exception as e:
+            print(f"Failed transfer logic: {e}")
+            import traceback
+            traceback.print_exc()
 
 class ConfirmView(discord.ui.View):
     def __init__(self, user):
@@ -161,10 +176,57 @@ class ConfirmView(discord.ui.View):
         self.value = False
         self.stop()
 
+class MarketView(discord.ui.View):
+    """Paged !market listing; each page is read from the DB on button press."""
+
+    def __init__(self, ctx, pager):
+        super().__init__(timeout=120)
+        self.ctx = ctx
+        self.pager = pager
+        self.current_page = 0
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.prev_btn.disabled = self.current_page == 0
+        self.next_btn.disabled = not self.pager.has_next(self.current_page)
+
+    async def get_embed(self):
+        items = await self.pager.page(self.current_page)
+        self.update_buttons()
+        embed = discord.Embed(title=f"販売リスト ({self.current_page + 1}/{self.pager.max_page + 1})", color=discord.Color.purple())
+        if not items:
+            embed.description = "販売中の作品がありません。"
+        for item_id, price, score, url in items:
+            embed.add_field(
+                name=f"ID: {item_id} (スコア: {score:.2f})",
+                value=f"価格: `{price:,} 円`\n[画像を見る]({url})",
+                inline=False
+            )
+        embed.set_footer(text=f"販売中: {self.pager.total:,} 件 / 購入するには '!購入 [番号]' を入力してください。")
+        return embed
+
+    async def _turn(self, interaction, step):
+        if interaction.user != self.ctx.author:
+            await interaction.response.send_message("コマンドを実行した本人のみ操作できます。", ephemeral=True)
+            return
+        target = self.current_page + step
+        if target < 0 or (step > 0 and not self.pager.has_next(self.current_page)):
+            await interaction.response.defer()
+            return
+        self.current_page = target
+        await interaction.response.edit_message(embed=await self.get_embed(), view=self)
+
+    @discord.ui.button(label="◀️", style=discord.ButtonStyle.blurple)
+    async def prev_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._turn(interaction, -1)
+
+    @discord.ui.button(label="▶️", style=discord.ButtonStyle.blurple)
+    async def next_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._turn(interaction, 1)
+
 class MarketCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.ai_client = None
 
     async def cog_load(self):
         # Register Persistent View
@@ -179,186 +241,226 @@ class MarketCog(commands.Cog):
         # self.bot.add_view(AuctionView(self.bot, 0))
         # self.auction_check_loop.start()
 
-    def setup_client(self):
-        try:
-            token = getattr(self.bot, 'hf_token', None)
-            if token and token != "YOUR_HUGGINGFACE_TOKEN_HERE":
-                print(f"HF Token 検知: {token[:4]}****")
-                self.ai_client = Client("Eugeoter/waifu-scorer-v3", token=token)
-            else:
-                print("HF Tokenが設定されていません。(匿名モードを試行)")
-                self.ai_client = Client("Eugeoter/waifu-scorer-v3")
-        except Exception as e:
-            print(f"AI Client 初期化失敗: {e}")
-            traceback.print_exc()
-            self.ai_client = None
-
-    def calculate_phash(self, image_path):
-        """画像のPerceptual Hashを計算します。"""
-        with Image.open(image_path) as img:
-            return str(imagehash.phash(img))
+    async def calculate_phash(self, data):
+        """画像のPerceptual Hashを計算します。(画像サービスのワーカープロセスで実行)"""
+        return await self.bot.image_service.phash(data)
 
     async def check_duplicate(self, current_hash):
-        """DBから全ハッシュを取得し、ハミング距離を比較します。"""
-        if not current_hash:
+        """共有pHashインデックスで類似画像(ハミング距離 5 以下)を検索します。"""
+        if current_hash is None:
             return False
 
-        async with aiosqlite.connect(self.bot.bank.db_path) as db:
-            cursor = await db.execute("SELECT image_hash FROM market_items WHERE image_hash IS NOT NULL")
-            rows = await cursor.fetchall()
-        
-        current_hash_obj = imagehash.hex_to_hash(current_hash)
-        
-        for (db_hash_str,) in rows:
-            try:
-                db_hash_obj = imagehash.hex_to_hash(db_hash_str)
-                distance = current_hash_obj - db_hash_obj
-                if distance <= 5: # 閾値 5
-                    return True
-            except:
-                continue
-        return False
+        item_id, _ = self.bot.phash_index.nearest(current_hash, DUPLICATE_DISTANCE)
+        return item_id is not None
 
 
     @commands.command(name="market", aliases=["gallery", "shop"])
     async def market(self, ctx):
         """現在販売中の美術品リストを見ます。"""
-        async with aiosqlite.connect(self.bot.bank.db_path) as db:
+        # Keyset pages on idx_market_status (status, item_id): each page is
+        # an index range read, however deep the user pages
+        async def fetch(db, before_id, limit):
             cursor = await db.execute(
-                "SELECT item_id, price, aesthetic_score, image_url FROM market_items WHERE status = 'on_sale' ORDER BY item_id DESC LIMIT 10"
+                "SELECT item_id, price, aesthetic_score, image_url FROM market_items "
+                "WHERE status = 'on_sale' AND item_id < ? ORDER BY item_id DESC LIMIT ?",
+                (before_id, limit)
             )
-            items = await cursor.fetchall()
-            
-        if not items:
+            return await cursor.fetchall()
+
+        async def count(db):
+            cursor = await db.execute("SELECT COUNT(*) FROM market_items WHERE status = 'on_sale'")
+            return (await cursor.fetchone())[0]
+
+        pager = KeysetPager(self.bot.bank, fetch, count, per_page=10)
+        if not await pager.refresh_count():
             await ctx.send("販売中の作品がありません。")
             return
 
-        embed = discord.Embed(title="販売リスト", color=discord.Color.purple())
-        for item_id, price, score, url in items:
+        view = MarketView(ctx, pager)
+        await ctx.send(embed=await view.get_embed(), view=view)
+
+    @commands.command(name="search")
+    async def search(self, ctx, *words):
+        """タグ・グレード・価格で販売中の作品を検索します。
+
+        例: `!search 1girl blue_hair|red_hair grade:S,A price:1000-50000`
+        (スペース区切り = AND, `|` = OR)
+        """
+        try:
+            query = parse_query(words)
+        except ValueError as e:
+            await ctx.send(f"❌ {e}")
+            return
+        if not (query["groups"] or query["grades"] or query["min_price"] is not None or query["max_price"] is not None):
+            await ctx.send("使い方: `!search タグ1 タグ2|タグ3 grade:S price:1000-50000`")
+            return
+
+        async with self.bot.bank.acquire() as db:
+            items = await search_items(db, **query)
+
+        conditions = " ".join(words)
+        if not items:
+            await ctx.send(f"🔍 `{conditions}` に一致する販売中の作品はありません。")
+            return
+
+        embed = discord.Embed(title=f"🔍 検索結果: {conditions}"[:256], color=discord.Color.purple())
+        for item_id, price, score, grade, url, _ in items:
             embed.add_field(
-                name=f"ID: {item_id} (スコア: {score:.2f})",
+                name=f"ID: {item_id} [{grade or '-'}] (スコア: {score:.2f})",
                 value=f"価格: `{price:,} 円`\n[画像を見る]({url})",
                 inline=False
             )
-        embed.set_footer(text="購入するには '!購入 [番号]' を入力してください。")
+        embed.set_footer(text=f"新しい順に最大 {len(items)} 件 / 購入: !buy [ID]")
+        await ctx.send(embed=embed)
+
+    @commands.command(name="find")
+    async def find(self, ctx, *, text: str = ""):
+        """タグ・キャラクター名のあいまい検索 (関連度順)。例: `!find blue hair maid`"""
+        if not text.strip():
+            await ctx.send("使い方: `!find キーワード` (例: `!find blue hair maid`, `!find miku`)")
+            return
+
+        async with self.bot.bank.acquire() as db:
+            items, matched_all = await find_items(db, text)
+        if not items:
+            await ctx.send(f"🔍 `{text}` に一致する販売中の作品はありません。")
+            return
+
+        embed = discord.Embed(title=f"🔍 {text}"[:256], color=discord.Color.purple())
+        if not matched_all:
+            embed.description = "すべてのキーワードに一致する作品がないため、いずれかに一致する作品を表示しています。"
+        for item_id, price, score, grade, url, _, characters in items:
+            name = f"ID: {item_id} [{grade or '-'}] (スコア: {score:.2f})"
+            if characters:
+                name += f" {characters}"
+            embed.add_field(name=name[:256], value=f"価格: `{price:,} 円`\n[画像を見る]({url})", inline=False)
+        embed.set_footer(text="関連度順 / 購入: !buy [ID]")
         await ctx.send(embed=embed)
 
     @commands.command(name="lock")
     async def lock(self, ctx, item_id: int):
         """所持品をロック/解除します。ロック中は価格が2倍になります。"""
-        async with aiosqlite.connect(self.bot.bank.db_path) as db:
+        async def toggle(db):
             cursor = await db.execute("SELECT is_locked, buyer_id FROM market_items WHERE item_id = ?", (item_id,))
             row = await cursor.fetchone()
-            
             if not row:
-                await ctx.send("❌ アイテムが見つかりません。")
-                return
-            
+                return None
             is_locked, owner_id = row
             if owner_id != ctx.author.id:
-                await ctx.send("❌ あなたの所有物ではありません。")
-                return
-            
+                return "not_owner"
             new_lock = not is_locked
             await db.execute("UPDATE market_items SET is_locked = ? WHERE item_id = ?", (new_lock, item_id))
-            await db.commit()
-            
-            status = "ロックしました (買収価格: 2倍)" if new_lock else "ロック解除しました"
-            await ctx.send(f"✅ {status}")
+            return new_lock
+
+        result = await self.bot.bank.submit_write(toggle)
+        if result is None:
+            await ctx.send("❌ アイテムが見つかりません。")
+            return
+        if result == "not_owner":
+            await ctx.send("❌ あなたの所有物ではありません。")
+            return
+        
+        status = "ロックしました (買収価格: 2倍)" if result else "ロック解除しました"
+        await ctx.send(f"✅ {status}")
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
+        # DMs carry no member / guild to credit
+        if payload.guild_id is None or payload.member is None: return
         if payload.member.bot: return
         
         if str(payload.emoji) != "🔥": return
 
-        async with aiosqlite.connect(self.bot.bank.db_path) as db:
-            cursor = await db.execute("SELECT seller_id, item_id, price FROM market_items WHERE message_id = ?", (payload.message_id,))
+        rewards = self.bot.reaction_rewards
+        if rewards.is_duplicate(payload.message_id, payload.user_id): return
+
+        # Most reacted messages are not listings; those never reach the DB
+        item_id = await self.bot.message_index.resolve(self.bot.bank, payload.message_id)
+        if item_id is None: return
+
+        async with self.bot.bank.acquire() as db:
+            cursor = await db.execute("SELECT seller_id FROM market_items WHERE item_id = ?", (item_id,))
             row = await cursor.fetchone()
             
-            if row:
-                seller_id, item_id, price = row
-                if seller_id and seller_id != payload.user_id:
-                     seller = self.bot.get_user(seller_id)
-                     if seller:
-                         await self.bot.bank.deposit_credits(seller, 100, db_conn=db)
-                         await db.commit()
+        if row:
+            seller_id = row[0]
+            if seller_id and seller_id != payload.user_id:
+                 # Credited by id in the payload's guild with the next batched flush
+                 rewards.add(payload.message_id, payload.user_id, item_id, seller_id, payload.guild_id)
 
     @commands.command(name="buy")
     async def buy(self, ctx, item_id: int):
         """ギャラリーにある絵を購入します。"""
-        async with aiosqlite.connect(self.bot.bank.db_path) as db:
+        async with self.bot.bank.acquire() as db:
             cursor = await db.execute(
                 "SELECT price, image_url, status, is_locked, buyer_id FROM market_items WHERE item_id = ?",
                 (item_id,)
             )
             row = await cursor.fetchone()
             
-            if not row:
-                await ctx.send("❌ アイテムが見つかりません。")
-                return
-            
-            price, image_url, status, is_locked, current_owner_id = row
+        # Pending rows are still being listed by !sell
+        if not row or row[2] == 'pending':
+            await ctx.send("❌ アイテムが見つかりません。")
+            return
+        
+        price, image_url, status, is_locked, current_owner_id = row
+        
+        if current_owner_id == ctx.author.id:
+             await ctx.send("❌ 自分の商品は購入できません。")
+             return
+
+        final_price = price
+        
+        # Lock Logic
+        if is_locked:
+            final_price = price * 2
+            embed = discord.Embed(title="ロックされています", description=f"所有者が販売を拒否しています。\n**{final_price:,} Credits** (2倍) で強制買収しますか？", color=discord.Color.red())
+            view = ConfirmView(ctx.author)
+            msg = await ctx.send(embed=embed, view=view)
+            await view.wait()
             
-            if current_owner_id == ctx.author.id:
-                 await ctx.send("❌ 自分の商品は購入できません。")
-                 return
+            if not view.value:
+                await msg.edit(content="キャンセルしました。", view=None, embed=None)
+                return
+        
+        # Inflation: +10%
+        new_base_price = int(price * 1.1)
+
+        async def purchase(db):
+            # Only succeeds if the item is exactly as we read it: not bought,
+            # repriced, locked/unlocked or relisted since
+            cursor = await db.execute(
+                "UPDATE market_items SET status = 'owned', buyer_id = ?, is_locked = 0, price = ? "
+                "WHERE item_id = ? AND price = ? AND buyer_id IS ? AND is_locked IS ? AND status IS ?",
+                (ctx.author.id, new_base_price, item_id, price, current_owner_id, is_locked, status)
+            )
+            if cursor.rowcount == 0:
+                raise LookupError("item changed")
 
-            final_price = price
+            # Withdraw from Buyer (guarded, no separate balance read) and pay
+            # the current owner the full amount (User: "Owner gets double")
+            legs = [(ctx.author.id, ctx.guild.id, -final_price)]
+            if current_owner_id:
+                legs.append((current_owner_id, ctx.guild.id, final_price))
+            await self.bot.bank.apply_transfers(legs, db_conn=db)
+
+        # Process Transaction (the confirmation above is done before queueing the write)
+        try:
+            await self.bot.bank.submit_write(purchase)
             
-            # Lock Logic
+            msg_text = f"購入完了。\n`{final_price:,} 円`を支払いました。"
             if is_locked:
-                final_price = price * 2
-                embed = discord.Embed(title="ロックされています", description=f"所有者が販売を拒否しています。\n**{final_price:,} Credits** (2倍) で強制買収しますか？", color=discord.Color.red())
-                view = ConfirmView(ctx.author)
-                msg = await ctx.send(embed=embed, view=view)
-                await view.wait()
-                
-                if not view.value:
-                    await msg.edit(content="キャンセルしました。", view=None, embed=None)
-                    return
+                 msg_text = f"買収成功。\n(2倍価格 `{final_price:,} 円`)"
             
-            # Check balance
-            buyer_balance = await self.bot.bank.get_balance(ctx.author)
-            if buyer_balance < final_price:
-                await ctx.send(f"❌ 残高不足 (必要: {final_price:,} 円)")
-                return
+            embed = discord.Embed(title="取引完了", description=msg_text, color=discord.Color.green())
+            embed.set_image(url=image_url)
+            embed.set_footer(text=f"新価格: {new_base_price:,} Credits")
+            await ctx.send(embed=embed)
             
-            # Process Transaction
-            try:
-                # Withdraw from Buyer
-                await self.bot.bank.withdraw_credits(ctx.author, final_price, db_conn=db)
-                
-                # Pay Seller (Current Owner)
-                if current_owner_id:
-                    owner = self.bot.get_user(current_owner_id)
-                    payout = final_price # Owner gets full amount (User: "Owner gets double")
-                    if owner:
-                        await self.bot.bank.deposit_credits(owner, payout, db_conn=db)
-                    else:
-                        # Offline deposit
-                        await db.execute("INSERT INTO bank (user_id, guild_id, balance) VALUES (?, ?, ?) ON CONFLICT(user_id, guild_id) DO UPDATE SET balance = balance + ?", (current_owner_id, ctx.guild.id, payout, payout))
-                
-                # Inflation: +10%
-                new_base_price = int(price * 1.1)
-                
-                await db.execute(
-                    "UPDATE market_items SET status = 'owned', buyer_id = ?, is_locked = 0, price = ? WHERE item_id = ?",
-                    (ctx.author.id, new_base_price, item_id,)
-                )
-                await db.commit()
-                
-                msg_text = f"購入完了。\n`{final_price:,} 円`を支払いました。"
-                if is_locked:
-                     msg_text = f"買収成功。\n(2倍価格 `{final_price:,} 円`)"
-                
-                embed = discord.Embed(title="取引完了", description=msg_text, color=discord.Color.green())
-                embed.set_image(url=image_url)
-                embed.set_footer(text=f"新価格: {new_base_price:,} Credits")
-                await ctx.send(embed=embed)
-                
-            except ValueError as e:
-                 await ctx.send(f"❌ 取引失敗: {e}")
+        except ValueError:
+             await ctx.send(f"❌ 残高不足 (必要: {final_price:,} 円)")
+        except LookupError:
+             await ctx.send("❌ 取引失敗: アイテムの状態が変わりました (購入・ロック・再出品など)。もう一度お試しください。")
 
 async def setup(bot):
     await bot.add_cog(MarketCog(bot))
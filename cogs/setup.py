@@ -1,7 +1,6 @@
 import discord
 from discord.ext import commands
 import asyncio
-import aiosqlite
 
 class SetupCog(commands.Cog):
     def __init__(self, bot):
@@ -183,16 +182,18 @@ class SetupCog(commands.Cog):
             
             # Bot Gallery Setup
             if forum:
-                async with aiosqlite.connect(self.bot.bank.db_path, timeout=60.0) as db:
+                async with self.bot.bank.acquire() as db:
                      cursor = await db.execute("SELECT thread_id FROM user_galleries WHERE user_id = ?", (self.bot.user.id,))
                      row = await cursor.fetchone()
-                     if not row:
-                         thread = await forum.create_thread(name="[Official] System Shop", content="公式ショップ")
-                         t = thread.thread if hasattr(thread, 'thread') else thread
-                         # Create record for bot
-                         await db.execute("INSERT OR REPLACE INTO user_galleries (user_id, thread_id) VALUES (?, ?)", (self.bot.user.id, t.id))
-                         await db.commit()
-                         await ctx.send("✅ 公式ショップ設立完了")
+                if not row:
+                     # No DB handle is held across the Discord API call
+                     thread = await forum.create_thread(name="[Official] System Shop", content="公式ショップ")
+                     t = thread.thread if hasattr(thread, 'thread') else thread
+                     # Create record for bot
+                     await self.bot.bank.execute_write(
+                         "INSERT OR REPLACE INTO user_galleries (user_id, thread_id) VALUES (?, ?)", (self.bot.user.id, t.id)
+                     )
+                     await ctx.send("✅ 公式ショップ設立完了")
 
             await ctx.send("セットアップ完了。")
 
@@ -247,14 +248,20 @@ class SetupCog(commands.Cog):
             except: pass
             
         # 3. Wipe DB Tables
-        async with aiosqlite.connect(self.bot.bank.db_path) as db:
+        async def wipe(db):
             await db.execute("DELETE FROM bank")
             await db.execute("DELETE FROM market_items")
             # await db.execute("DELETE FROM market_trends") # Table might not exist if removed, but good to ensure
             await db.execute("DELETE FROM user_galleries")
+            await db.execute("DELETE FROM reaction_rewards")
             # Reset SQLite Autoincrement
             await db.execute("DELETE FROM sqlite_sequence WHERE name='market_items'")
-            await db.commit()
+        await self.bot.bank.submit_write(wipe)
+        self.bot.bank.invalidate_balances()
+        self.bot.phash_index.clear()
+        self.bot.content_index.clear()
+        self.bot.message_index.clear()
+        self.bot.reaction_rewards.discard()
             
         await ctx.send("✨ **全データの消去が完了しました。**\n`!init_server` を実行して再構築してください。")
 
@@ -0,0 +1,79 @@
+from utils.lru import LRUCache
+
+
+class BalanceCache:
+    """Write-through cache of `(user_id, guild_id) -> balance`.
+
+    Mutations inside a write transaction are *staged* and only reach the
+    cache when the transaction commits; a rollback invalidates the keys it
+    touched instead. The DBWriter drives this through the savepoint /
+    rollback_to / commit / rollback hooks.
+
+    Readers fill the cache with `fill(key, value, version)` using the version
+    they saw before querying, so a read that raced with a commit never puts
+    a stale balance back.
+    """
+
+    def __init__(self, maxsize=10000, enabled=True):
+        self.enabled = enabled
+        self._lru = LRUCache(maxsize)
+        self._staged = []
+        self.version = 0
+
+    # Reads
+    def get(self, key):
+        if not self.enabled:
+            return None
+        return self._lru.get(key)
+
+    def fill(self, key, value, version):
+        if self.enabled and version == self.version:
+            self._lru.put(key, value)
+
+    # Staging (inside a write transaction)
+    def stage(self, key, value=None):
+        """Record a new balance; `None` means "unknown, invalidate on commit"."""
+        # Staged even while disabled, so re-enabling mid-transaction stays correct
+        self._staged.append((key, value))
+
+    def savepoint(self):
+        return len(self._staged)
+
+    def rollback_to(self, mark):
+        dropped = self._staged[mark:]
+        del self._staged[mark:]
+        # Earlier staged values for these keys may have been overwritten by
+        # the rolled-back part, so just forget them on commit.
+        for key, _ in dropped:
+            self._staged.append((key, None))
+
+    def commit(self):
+        staged, self._staged = self._staged, []
+        if not staged:
+            return
+        self.version += 1
+        for key, value in staged:
+            if value is None:
+                self._lru.pop(key)
+            else:
+                self._lru.put(key, value)
+
+    def rollback(self):
+        staged, self._staged = self._staged, []
+        if not staged:
+            return
+        self.version += 1
+        for key, _ in staged:
+            self._lru.pop(key)
+
+    def invalidate(self, key=None):
+        self.version += 1
+        if key is None:
+            self._lru.clear()
+        else:
+            self._lru.pop(key)
+
+    def stats(self):
+        stats = self._lru.stats()
+        stats["enabled"] = self.enabled
+        return stats
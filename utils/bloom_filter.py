@@ -0,0 +1,109 @@
+import math
+import os
+import struct
+
+import numpy as np
+
+_HEADER = struct.Struct("<4sQIQQq")
+_MAGIC = b"BLM1"
+_MASK64 = (1 << 64) - 1
+
+
+def _digest_bytes(digest):
+    """SHA-256 as bytes (accepts the hex form stored in the database)."""
+    return bytes.fromhex(digest) if isinstance(digest, str) else bytes(digest)
+
+
+class BloomFilter:
+    """Bloom filter over SHA-256 digests, saved to / loaded from a file.
+
+    The inputs are already uniform hashes, so the k bit positions come from
+    double hashing two 64-bit words of the digest instead of k separate
+    hash functions. `watermark` is the highest item_id added, so a filter
+    loaded from disk only needs the rows inserted after it was saved.
+    """
+
+    def __init__(self, capacity=100_000, error_rate=0.001):
+        self.capacity = max(1, int(capacity))
+        self.error_rate = error_rate
+        self.num_bits = max(64, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+        self.count = 0
+        self.watermark = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, digest):
+        data = _digest_bytes(digest)
+        h1 = int.from_bytes(data[:8], "little")
+        h2 = int.from_bytes(data[8:16], "little") | 1
+        return [((h1 + i * h2) & _MASK64) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, digest):
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def add_many(self, digests):
+        """Vectorized `add` for bulk (re)builds."""
+        if not digests:
+            return
+        words = np.frombuffer(b"".join(_digest_bytes(d)[:16] for d in digests), dtype="<u8").reshape(-1, 2)
+        h1 = words[:, 0]
+        h2 = words[:, 1] | np.uint64(1)
+        for i in range(self.num_hashes):
+            # uint64 arithmetic wraps exactly like the & _MASK64 in _positions
+            pos = (h1 + np.uint64(i) * h2) % np.uint64(self.num_bits)
+            np.bitwise_or.at(self.bits, (pos >> np.uint64(3)).astype(np.int64),
+                             (np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8)))
+        self.count += len(digests)
+
+    def __contains__(self, digest):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+
+    def saturated(self):
+        """More entries than sized for: the false-positive rate is climbing."""
+        return self.count > self.capacity
+
+    def false_positive_rate(self):
+        """Expected false-positive rate at the current fill."""
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+    def clear(self):
+        self.bits[:] = 0
+        self.count = 0
+        self.watermark = 0
+
+    def save(self, path):
+        """Write atomically (temp file + rename) so a crash never leaves half a filter."""
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, self.num_bits, self.num_hashes, self.capacity, self.count, self.watermark))
+            f.write(struct.pack("<d", self.error_rate))
+            f.write(self.bits.tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Filter saved at `path`, or None if it is missing or unreadable."""
+        try:
+            with open(path, "rb") as f:
+                header = f.read(_HEADER.size)
+                magic, num_bits, num_hashes, capacity, count, watermark = _HEADER.unpack(header)
+                (error_rate,) = struct.unpack("<d", f.read(8))
+                bits = np.frombuffer(f.read(), dtype=np.uint8).copy()
+        except (OSError, struct.error):
+            return None
+        if magic != _MAGIC or len(bits) != (num_bits + 7) // 8:
+            return None
+        bloom = cls.__new__(cls)
+        bloom.capacity = capacity
+        bloom.error_rate = error_rate
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom.bits = bits
+        bloom.count = count
+        bloom.watermark = watermark
+        return bloom
@@ -0,0 +1,140 @@
+import collections
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# Shortest wait reported while a half-open probe is still running
+MIN_RETRY = 1.0
+
+
+class CircuitOpen(Exception):
+    """The breaker is open; `retry_in` is the seconds until the next probe."""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} circuit is open (retry in {retry_in:.0f}s)")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with exponential backoff.
+
+    closed -> open after `threshold` failures in a row. While open every
+    call fails fast with CircuitOpen. Once the backoff has passed, one call
+    is let through as a half-open probe: success closes the circuit, failure
+    opens it again with the backoff doubled (up to `max_backoff`).
+
+    Use as a context manager around the protected call. Exceptions listed
+    in `ignore` (and cancellation) neither count as a failure nor a success.
+    `probe_timeout` (the protected call's own deadline) is how long callers
+    turned away during a probe are told to wait.
+    """
+
+    def __init__(self, name, threshold=5, backoff=15.0, max_backoff=300.0, ignore=(), probe_timeout=None):
+        self.name = name
+        self.probe_timeout = probe_timeout
+        self.threshold = max(1, threshold)
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.ignore = tuple(ignore)
+
+        self.state = CLOSED
+        self.failures = 0
+        self.backoff = backoff
+        self.opened_at = 0.0
+        self.last_error = None
+        self._probing = False
+        self._probe_started = 0.0
+
+        self.rejected = 0
+        self.trips = 0
+        self.transitions = collections.deque(maxlen=20)
+
+    def _transition(self, state, reason):
+        if state == self.state:
+            return
+        print(f"Circuit {self.name}: {self.state} -> {state} ({reason})")
+        self.transitions.append((time.time(), self.state, state, reason))
+        self.state = state
+
+    def retry_in(self):
+        if self.state == HALF_OPEN and self._probing:
+            # The probe decides; it finishes by its deadline at the latest
+            left = self._probe_started + (self.probe_timeout or 0.0) - time.monotonic()
+            return max(MIN_RETRY, left)
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.backoff - time.monotonic())
+
+    def available(self):
+        """Would a call be let through right now? (Doesn't claim the probe.)"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return self.retry_in() <= 0
+        return not self._probing
+
+    def allow(self):
+        """Claim permission for one call or raise CircuitOpen."""
+        if self.state == OPEN and self.retry_in() <= 0:
+            self._transition(HALF_OPEN, f"probing after {self.backoff:g}s")
+        if self.state == CLOSED:
+            return
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            self._probe_started = time.monotonic()
+            return
+        self.rejected += 1
+        raise CircuitOpen(self.name, self.retry_in())
+
+    def record_success(self):
+        self._probing = False
+        self.failures = 0
+        if self.state != CLOSED:
+            self.backoff = self.base_backoff
+            self._transition(CLOSED, "probe succeeded")
+
+    def record_failure(self, error=None):
+        self._probing = False
+        self.failures += 1
+        self.last_error = str(error) if error is not None else None
+        if self.state == HALF_OPEN:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self._open(f"probe failed: {self.last_error}")
+        elif self.state == CLOSED and self.failures >= self.threshold:
+            self.trips += 1
+            self._open(f"{self.failures} consecutive failures: {self.last_error}")
+
+    def _open(self, reason):
+        self.opened_at = time.monotonic()
+        self._transition(OPEN, reason)
+
+    def release(self):
+        """Give back a claimed call without a verdict."""
+        self._probing = False
+
+    def __enter__(self):
+        self.allow()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.record_success()
+        elif issubclass(exc_type, self.ignore) or not issubclass(exc_type, Exception):
+            self.release()
+        else:
+            self.record_failure(exc)
+        return False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": self.retry_in(),
+            "backoff": self.backoff,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "last_error": self.last_error,
+            "transitions": list(self.transitions),
+        }
@@ -0,0 +1,208 @@
+"""Exact-duplicate lookup by SHA-256 of the uploaded bytes.
+
+A persisted Bloom filter answers "never seen" without touching the
+database; a "maybe" is confirmed against the indexed
+market_items.content_sha256 column, so false positives (and deleted
+listings) cost one index lookup, never a wrong rejection.
+
+Rows sold before the column existed are backfilled by re-downloading
+their images, from the `!sha_backfill` admin command or:
+
+    python -m utils.content_index --db economy.db
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import time
+
+import aiohttp
+import aiosqlite
+
+from utils.bloom_filter import BloomFilter
+
+FETCH_SIZE = 5000
+BACKFILL_CONCURRENCY = 16
+
+
+class ContentIndex:
+    def __init__(self, path, capacity=100_000, error_rate=0.001):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bloom = BloomFilter(capacity, error_rate)
+        self._dirty = False
+
+        self.lookups = 0
+        self.bloom_negatives = 0
+        self.false_positives = 0
+        self.exact_hits = 0
+
+    def __len__(self):
+        return len(self.bloom)
+
+    async def load(self, db):
+        """Load the saved filter and add rows inserted since it was written.
+
+        Rebuilds from the table when there is no usable file, the settings
+        changed, or the filter has outgrown its capacity. Returns
+        `(mode, rows_added, seconds)`.
+        """
+        start = time.perf_counter()
+        bloom = BloomFilter.load(self.path) if self.path else None
+        mode = "incremental"
+        if bloom is None or bloom.capacity < self.capacity or bloom.error_rate != self.error_rate:
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            mode = "rebuild"
+        self.bloom = bloom
+        added = await self._add_rows(db, bloom.watermark)
+        if bloom.saturated():
+            # Grow ahead of the catalog instead of letting false positives climb
+            self.capacity = max(self.capacity, len(bloom) * 2)
+            self.bloom = BloomFilter(self.capacity, self.error_rate)
+            added = await self._add_rows(db, 0)
+            mode = "rebuild"
+        if added or mode == "rebuild":
+            self._dirty = True
+            self.save()
+        return mode, added, time.perf_counter() - start
+
+    async def _add_rows(self, db, after):
+        added = 0
+        cursor = await db.execute(
+            "SELECT item_id, content_sha256 FROM market_items WHERE item_id > ? AND content_sha256 IS NOT NULL ORDER BY item_id",
+            (after,)
+        )
+        try:
+            while True:
+                rows = await cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                self.bloom.add_many([digest for _, digest in rows])
+                self.bloom.watermark = max(self.bloom.watermark, rows[-1][0])
+                added += len(rows)
+        finally:
+            await cursor.close()
+        return added
+
+    def add(self, item_id, digest):
+        if not digest:
+            return
+        self.bloom.add(digest)
+        self.bloom.watermark = max(self.bloom.watermark, item_id)
+        self._dirty = True
+
+    async def find(self, db, digest):
+        """item_id of a listing with exactly these bytes, or None."""
+        self.lookups += 1
+        if digest not in self.bloom:
+            self.bloom_negatives += 1
+            return None
+        cursor = await db.execute("SELECT item_id FROM market_items WHERE content_sha256 = ? LIMIT 1", (digest,))
+        row = await cursor.fetchone()
+        if row is None:
+            self.false_positives += 1
+            return None
+        self.exact_hits += 1
+        return row[0]
+
+    def clear(self):
+        # Saved right away: item_ids restart after a wipe, and a stale file
+        # with a high watermark would skip them on the next load
+        self.bloom.clear()
+        self._dirty = True
+        self.save()
+
+    def save(self):
+        """Write the filter if it changed. Rows added after the last save are
+        picked up again by the next `load`, so a missed save only costs time."""
+        if not self._dirty or not self.path:
+            return
+        try:
+            self.bloom.save(self.path)
+            self._dirty = False
+        except OSError as e:
+            print(f"Bloom filter save failed: {e}")
+
+    def stats(self):
+        return {
+            "entries": len(self.bloom),
+            "capacity": self.bloom.capacity,
+            "size_kb": len(self.bloom.bits) / 1024,
+            "fp_rate": self.bloom.false_positive_rate(),
+            "lookups": self.lookups,
+            "bloom_negatives": self.bloom_negatives,
+            "false_positives": self.false_positives,
+            "exact_hits": self.exact_hits,
+        }
+
+
+async def _fetch_sha256(session, url):
+    try:
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                return None
+            data = await resp.read()
+    except Exception:
+        return None
+    return hashlib.sha256(data).hexdigest()
+
+
+async def backfill(db, limit=None):
+    """Download rows without content_sha256 and hash them.
+
+    Returns `(updates, failed)` where updates is `[(sha256, item_id), ...]`;
+    writing them is up to the caller. Expired attachment URLs count as
+    failed and stay NULL.
+    """
+    query = "SELECT item_id, image_url FROM market_items WHERE content_sha256 IS NULL AND image_url IS NOT NULL ORDER BY item_id"
+    if limit:
+        query += f" LIMIT {int(limit)}"
+    cursor = await db.execute(query)
+    rows = await cursor.fetchall()
+    sem = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+
+    async with aiohttp.ClientSession() as session:
+        async def one(item_id, url):
+            async with sem:
+                return item_id, await _fetch_sha256(session, url)
+
+        results = await asyncio.gather(*(one(item_id, url) for item_id, url in rows))
+
+    updates = [(digest, item_id) for item_id, digest in results if digest]
+    return updates, len(rows) - len(updates)
+
+
+async def write_backfill(db, updates):
+    """Store backfilled digests (no commit)."""
+    await db.executemany("UPDATE market_items SET content_sha256 = ? WHERE item_id = ?", updates)
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Backfill market_items.content_sha256 and rebuild the Bloom filter.")
+    parser.add_argument("--db", default="economy.db")
+    parser.add_argument("--bloom", default=None, help="filter file (default: <db>.bloom)")
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    from utils.migrations import run_migrations
+
+    async with aiosqlite.connect(args.db, timeout=60.0) as db:
+        await run_migrations(db)
+        start = time.perf_counter()
+        updates, failed = await backfill(db, args.limit)
+        await write_backfill(db, updates)
+        await db.commit()
+        print(f"backfilled {len(updates):,} items ({failed:,} failed) in {time.perf_counter() - start:.2f}s")
+
+        # Backfilled rows are older than the watermark; rebuild from scratch
+        path = args.bloom or f"{args.db}.bloom"
+        if os.path.exists(path):
+            os.remove(path)
+        index = ContentIndex(path)
+        mode, added, secs = await index.load(db)
+        print(f"bloom filter {mode}: {added:,} entries in {secs:.2f}s -> {path}")
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
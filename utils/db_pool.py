@@ -0,0 +1,137 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+# Applied once per connection when the pool opens it.
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=60000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class _CheckoutStats:
+    """Counters for one side (reader / writer) of the pool."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, waited, elapsed):
+        self.checkouts += 1
+        if waited:
+            self.waits += 1
+        self.total_wait += elapsed
+        if elapsed > self.max_wait:
+            self.max_wait = elapsed
+
+    def as_dict(self):
+        avg = self.total_wait / self.checkouts if self.checkouts else 0.0
+        return {
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "avg_checkout_ms": avg * 1000,
+            "max_checkout_ms": self.max_wait * 1000,
+        }
+
+
+class ConnectionPool:
+    """Long-lived aiosqlite connections: one writer plus N read-only readers.
+
+    SQLite only allows one writer at a time, so the writer connection is
+    handed out under a lock. Readers run concurrently thanks to WAL mode.
+    """
+
+    def __init__(self, db_path, readers=4, timeout=60.0, on_writer_release=None):
+        self.db_path = db_path
+        # Called after every writer checkout ends (e.g. to drop state staged
+        # by a transaction that was not committed through the DBWriter).
+        self.on_writer_release = on_writer_release
+        self.reader_count = max(1, readers)
+        self.timeout = timeout
+
+        self._writer = None
+        self._writer_lock = asyncio.Lock()
+        self._readers = []
+        self._idle_readers = asyncio.Queue()
+
+        self.reader_stats = _CheckoutStats()
+        self.writer_stats = _CheckoutStats()
+
+    @property
+    def is_open(self):
+        return self._writer is not None
+
+    async def _connect(self, read_only=False):
+        db = await aiosqlite.connect(self.db_path, timeout=self.timeout)
+        for pragma in CONNECTION_PRAGMAS:
+            await db.execute(pragma)
+        if read_only:
+            await db.execute("PRAGMA query_only=1")
+        return db
+
+    async def open(self):
+        if self.is_open:
+            return
+        self._writer = await self._connect()
+        for _ in range(self.reader_count):
+            db = await self._connect(read_only=True)
+            self._readers.append(db)
+            self._idle_readers.put_nowait(db)
+
+    async def close(self):
+        if not self.is_open:
+            return
+        async with self._writer_lock:
+            await self._writer.close()
+            self._writer = None
+        for db in self._readers:
+            await db.close()
+        self._readers.clear()
+        self._idle_readers = asyncio.Queue()
+
+    @asynccontextmanager
+    async def acquire(self, write=False):
+        """Check out a connection.
+
+        The writer is returned with any uncommitted transaction rolled back,
+        so a handler that raises half-way never leaks its changes.
+        """
+        if not self.is_open:
+            raise RuntimeError("Connection pool is not open.")
+
+        start = time.perf_counter()
+        if write:
+            waited = self._writer_lock.locked()
+            async with self._writer_lock:
+                self.writer_stats.record(waited, time.perf_counter() - start)
+                db = self._writer
+                try:
+                    yield db
+                finally:
+                    if db.in_transaction:
+                        await db.rollback()
+                    if self.on_writer_release:
+                        self.on_writer_release()
+        else:
+            waited = self._idle_readers.empty()
+            db = await self._idle_readers.get()
+            self.reader_stats.record(waited, time.perf_counter() - start)
+            try:
+                yield db
+            finally:
+                self._idle_readers.put_nowait(db)
+
+    def stats(self):
+        return {
+            "readers": self.reader_count,
+            "idle_readers": self._idle_readers.qsize(),
+            "writer_busy": self._writer_lock.locked(),
+            "reader": self.reader_stats.as_dict(),
+            "writer": self.writer_stats.as_dict(),
+        }
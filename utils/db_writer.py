@@ -0,0 +1,173 @@
+import asyncio
+import collections
+import time
+
+
+class DBWriter:
+    """Single writer task that serializes and group-commits writes.
+
+    Callers submit an async operation `op(db)`. The writer drains the queue,
+    runs up to `max_batch` operations inside one transaction (each under its
+    own SAVEPOINT) and commits once. Every caller still gets its own result
+    or exception: a failing operation is rolled back to its savepoint without
+    affecting the others in the batch.
+
+    Operations must not call `db.commit()` / `db.rollback()` themselves.
+
+    `listener`, if given, is told about transaction boundaries through
+    `savepoint() -> mark`, `rollback_to(mark)`, `commit()` and `rollback()`
+    so in-memory state (e.g. the balance cache) can follow the database.
+    """
+
+    def __init__(self, pool, max_batch=64, max_delay=0.002, listener=None):
+        self.pool = pool
+        self.listener = listener
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+
+        self._queue = asyncio.Queue()
+        self._task = None
+
+        self.commits = 0
+        self.ops = 0
+        self.failed_ops = 0
+        self.failed_commits = 0
+        self.max_batch_seen = 0
+        self.total_commit_time = 0.0
+        self._commit_times = collections.deque(maxlen=4096)
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Finish everything already queued, then stop the task."""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, op):
+        if not self.running:
+            raise RuntimeError("DB writer is not running.")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, future))
+        return await future
+
+    async def _collect(self, first):
+        batch = [first]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            batch.append(item)
+            if item is None:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = await self._collect(first)
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            try:
+                await self._execute(batch)
+            except Exception as e:
+                print(f"DB Writer Error: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            if stop:
+                return
+
+    async def _execute(self, batch):
+        batch = [(op, future) for op, future in batch if not future.cancelled()]
+        if not batch:
+            return
+
+        outcomes = []
+        async with self.pool.acquire(write=True) as db:
+            await db.execute("BEGIN")
+            for op, future in batch:
+                await db.execute("SAVEPOINT writer_op")
+                mark = self.listener.savepoint() if self.listener else None
+                try:
+                    result = await op(db)
+                except Exception as e:
+                    await db.execute("ROLLBACK TO writer_op")
+                    await db.execute("RELEASE writer_op")
+                    if self.listener:
+                        self.listener.rollback_to(mark)
+                    outcomes.append((future, None, e))
+                else:
+                    await db.execute("RELEASE writer_op")
+                    outcomes.append((future, result, None))
+
+            start = time.perf_counter()
+            try:
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                if self.listener:
+                    self.listener.rollback()
+                self.failed_commits += 1
+                for future, _, _ in outcomes:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            now = time.perf_counter()
+            if self.listener:
+                self.listener.commit()
+
+        self.commits += 1
+        self.ops += len(outcomes)
+        self.total_commit_time += now - start
+        self._commit_times.append(now)
+        self.max_batch_seen = max(self.max_batch_seen, len(outcomes))
+
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                self.failed_ops += 1
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def commits_per_second(self, window=60.0):
+        now = time.perf_counter()
+        recent = [t for t in self._commit_times if now - t <= window]
+        if len(recent) == self._commit_times.maxlen:
+            # History is saturated; measure over the span we still have.
+            window = max(now - recent[0], 1e-6)
+        return len(recent) / window
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "commits": self.commits,
+            "ops": self.ops,
+            "failed_ops": self.failed_ops,
+            "failed_commits": self.failed_commits,
+            "ops_per_commit": self.ops / self.commits if self.commits else 0.0,
+            "max_batch": self.max_batch_seen,
+            "avg_commit_ms": (self.total_commit_time / self.commits * 1000) if self.commits else 0.0,
+            "commits_per_sec": self.commits_per_second(),
+        }
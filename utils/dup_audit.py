@@ -0,0 +1,251 @@
+"""Catalog-wide near-duplicate clustering.
+
+Finds groups of market_items whose pHashes are within a Hamming distance of
+each other, e.g. items sold before a threshold change or while
+`!reset_risk` had wiped the hashes. Usable from the `!dup_audit` admin
+command or from the command line:
+
+    python -m utils.dup_audit --db economy.db --distance 5 [--rehash]
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+import aiosqlite
+import numpy as np
+
+from utils.image_service import _hash_image
+from utils.phash_index import (
+    CHUNK_BITS, CHUNK_MASK, CHUNKS, DUPLICATE_DISTANCE, PHashMatrix,
+    _masks_within, _popcount, from_db,
+)
+
+FETCH_SIZE = 5000
+REHASH_CONCURRENCY = 16
+# Up to 7 bits every 16-bit chunk is probed with at most one flipped bit (17
+# masks); at 8+ it is 137 masks and the candidate joins go near-quadratic
+# (~25s vs ~0.7s on 100k hashes), so larger requests are capped here.
+MAX_AUDIT_DISTANCE = 7
+
+
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        parent = self.parent
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            # Keep the smaller item_id as the root so cluster ids are stable
+            if rb < ra:
+                ra, rb = rb, ra
+            self.parent[rb] = ra
+
+    def groups(self):
+        clusters = {}
+        for x in self.parent:
+            clusters.setdefault(self.find(x), []).append(x)
+        return clusters
+
+
+def near_pairs(values, max_dist):
+    """Index pairs `(i, j)`, i < j, of hashes within `max_dist` bits.
+
+    Vectorized multi-index hashing: two hashes within d bits share some
+    16-bit chunk up to d // 4 flipped bits, so for every chunk and every
+    flip mask we join items through a bucket table of chunk values and only
+    popcount those candidate pairs.
+    """
+    n = len(values)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    masks = _masks_within(max_dist // CHUNKS)
+    found_i, found_j = [], []
+    rows = np.arange(n)
+    for c in range(CHUNKS):
+        keys = ((values >> np.uint64(c * CHUNK_BITS)) & np.uint64(CHUNK_MASK)).astype(np.int64)
+        # Rows grouped by chunk value: bucket k is order[start[k]:start[k] + size[k]]
+        order = np.argsort(keys, kind="stable")
+        size = np.bincount(keys, minlength=CHUNK_MASK + 1)
+        start = np.cumsum(size) - size
+        for mask in masks:
+            targets = keys ^ mask
+            counts = size[targets]
+            total = int(counts.sum())
+            if not total:
+                continue
+            src = np.repeat(rows, counts)
+            # Offset of each expanded pair inside its target bucket
+            offsets = np.repeat(start[targets] - np.cumsum(counts) + counts, counts)
+            dst = order[offsets + np.arange(total)]
+            keep = src < dst
+            src, dst = src[keep], dst[keep]
+            dist = _popcount(values[src] ^ values[dst])
+            close = dist <= max_dist
+            found_i.append(src[close])
+            found_j.append(dst[close])
+
+    if not found_i:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pairs = np.unique(np.stack([np.concatenate(found_i), np.concatenate(found_j)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+async def _fetch_phash(session, url, image_service=None):
+    try:
+        async with session.get(url) as resp:
+            if resp.status != 200:
+                return None
+            data = await resp.read()
+    except Exception:
+        return None
+
+    # Same decode path as !sell (draft decode + thumbnail), so the hashes match
+    try:
+        if image_service is not None:
+            return await image_service.phash(data)
+        value, _, _ = await asyncio.to_thread(_hash_image, data)
+        return value
+    except Exception:
+        return None
+
+
+async def load_hashes(db, rehash=False, image_service=None):
+    """Stream (item_id, phash) rows into a PHashMatrix.
+
+    With `rehash`, rows whose phash was wiped are re-downloaded and hashed
+    with the sell flow's hash function, on `image_service` if given (not
+    written back).
+    """
+    matrix = PHashMatrix()
+    missing = 0
+    rehashed = 0
+    cursor = await db.execute("SELECT item_id, phash, image_url FROM market_items ORDER BY item_id")
+    session = aiohttp.ClientSession() if rehash else None
+    sem = asyncio.Semaphore(REHASH_CONCURRENCY)
+
+    async def rehash_one(item_id, url):
+        async with sem:
+            return item_id, await _fetch_phash(session, url, image_service)
+
+    try:
+        while True:
+            rows = await cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            todo = []
+            for item_id, phash, image_url in rows:
+                if phash is not None:
+                    matrix.add(item_id, from_db(phash))
+                elif rehash and image_url:
+                    todo.append(rehash_one(item_id, image_url))
+                else:
+                    missing += 1
+            for item_id, value in await asyncio.gather(*todo):
+                if value is None:
+                    missing += 1
+                else:
+                    matrix.add(item_id, value)
+                    rehashed += 1
+    finally:
+        await cursor.close()
+        if session:
+            await session.close()
+    return matrix, missing, rehashed
+
+
+def cluster(matrix, max_dist=DUPLICATE_DISTANCE):
+    """`{cluster_id: [item_id, ...]}` for every group with 2+ items."""
+    values = matrix._values[:len(matrix)]
+    ids = matrix._ids[:len(matrix)]
+    src, dst = near_pairs(values, max_dist)
+    uf = UnionFind()
+    for a, b in zip(ids[src].tolist(), ids[dst].tolist()):
+        uf.union(a, b)
+    return {root: sorted(members) for root, members in uf.groups().items()}
+
+
+async def write_clusters(db, clusters, max_dist):
+    """Replace the dup_clusters table contents (no commit)."""
+    await db.execute("DELETE FROM dup_clusters")
+    rows = [
+        (item_id, cluster_id, len(members), max_dist)
+        for cluster_id, members in clusters.items()
+        for item_id in members
+    ]
+    await db.executemany(
+        "INSERT INTO dup_clusters (item_id, cluster_id, cluster_size, max_distance) VALUES (?, ?, ?, ?)",
+        rows
+    )
+
+
+def summarize(clusters, scanned, missing, elapsed):
+    sizes = sorted((len(m) for m in clusters.values()), reverse=True)
+    histogram = {}
+    for size in sizes:
+        histogram[size] = histogram.get(size, 0) + 1
+    largest = sorted(clusters.items(), key=lambda kv: len(kv[1]), reverse=True)[:5]
+    return {
+        "scanned": scanned,
+        "missing_hash": missing,
+        "clusters": len(sizes),
+        "clustered_items": sum(sizes),
+        "histogram": histogram,
+        "largest": [(cluster_id, len(members)) for cluster_id, members in largest],
+        "elapsed": elapsed,
+    }
+
+
+async def run_audit(read_db, max_dist=DUPLICATE_DISTANCE, rehash=False, image_service=None):
+    """Load + cluster. Returns `(clusters, summary)`; writing is up to the caller.
+
+    `max_dist` is clamped to `0..MAX_AUDIT_DISTANCE`; `summary["capped"]` is
+    True when that lowered the request.
+    """
+    requested = max_dist
+    max_dist = max(0, min(max_dist, MAX_AUDIT_DISTANCE))
+    start = time.perf_counter()
+    matrix, missing, _ = await load_hashes(read_db, rehash=rehash, image_service=image_service)
+    clusters = cluster(matrix, max_dist)
+    summary = summarize(clusters, len(matrix), missing, time.perf_counter() - start)
+    summary["max_distance"] = max_dist
+    summary["capped"] = requested > max_dist
+    return clusters, summary
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Cluster market_items by pHash distance.")
+    parser.add_argument("--db", default="economy.db")
+    parser.add_argument("--distance", type=int, default=DUPLICATE_DISTANCE)
+    parser.add_argument("--rehash", action="store_true", help="re-download items whose hash was wiped")
+    args = parser.parse_args()
+
+    from utils.migrations import run_migrations
+
+    async with aiosqlite.connect(args.db, timeout=60.0) as db:
+        await run_migrations(db)
+        clusters, summary = await run_audit(db, args.distance, args.rehash)
+        await write_clusters(db, clusters, summary["max_distance"])
+        await db.commit()
+
+    if summary["capped"]:
+        print(f"distance capped at {MAX_AUDIT_DISTANCE} (larger distances make the audit near-quadratic)")
+    print(f"scanned {summary['scanned']:,} items ({summary['missing_hash']:,} without hash) in {summary['elapsed']:.2f}s")
+    print(f"{summary['clusters']:,} clusters, {summary['clustered_items']:,} items")
+    for size, count in sorted(summary["histogram"].items(), reverse=True):
+        print(f"  size {size}: {count}")
+    for cluster_id, size in summary["largest"]:
+        print(f"  cluster #{cluster_id}: {size} items")
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
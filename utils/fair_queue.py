@@ -0,0 +1,108 @@
+import asyncio
+import collections
+
+
+class FairQueue:
+    """Bounded async queue that round-robins across guilds, then users.
+
+    Items are put with a `(guild_id, user_id)` key. `get` serves one item
+    from the next guild in turn and, within it, from the next user in turn,
+    so one user flooding the queue only ever delays others by one item per
+    round. Items put with `priority=True` (admins) are served before
+    everything else, in FIFO order.
+
+    Mirrors the parts of asyncio.Queue the InferencePool uses (`put_nowait`,
+    `get`, `get_nowait`, `qsize`, `full`, plus `put(None)` for the stop
+    sentinel, which is handed out only once no items are left).
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._priority = collections.deque()
+        # guild -> user -> deque of items; both levels rotate round-robin
+        self._guilds = collections.OrderedDict()
+        self._size = 0
+        self._sentinels = 0
+        self._getters = collections.deque()
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return self._size == 0 and self._sentinels == 0
+
+    def full(self):
+        return 0 < self.maxsize <= self._size
+
+    def depth(self, key):
+        guild_id, user_id = key if key is not None else (None, None)
+        users = self._guilds.get(guild_id)
+        items = users.get(user_id) if users else None
+        return len(items) if items else 0
+
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def put_nowait(self, item, key=None, priority=False):
+        if item is None:
+            self._sentinels += 1
+        elif self.full():
+            raise asyncio.QueueFull
+        elif priority:
+            self._priority.append(item)
+            self._size += 1
+        else:
+            guild_id, user_id = key if key is not None else (None, None)
+            users = self._guilds.setdefault(guild_id, collections.OrderedDict())
+            users.setdefault(user_id, collections.deque()).append(item)
+            self._size += 1
+        self._wakeup_next()
+
+    async def put(self, item, key=None, priority=False):
+        # Only the stop sentinel goes through here; it is never refused
+        self.put_nowait(item, key, priority)
+
+    def get_nowait(self):
+        if self._priority:
+            self._size -= 1
+            return self._priority.popleft()
+        if self._guilds:
+            guild_id, users = next(iter(self._guilds.items()))
+            user_id, items = next(iter(users.items()))
+            item = items.popleft()
+            self._size -= 1
+            if items:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if users:
+                self._guilds.move_to_end(guild_id)
+            else:
+                del self._guilds[guild_id]
+            return item
+        if self._sentinels:
+            self._sentinels -= 1
+            return None
+        raise asyncio.QueueEmpty
+
+    async def get(self):
+        while self.empty():
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except BaseException:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                # We may have been woken for an item we are no longer taking
+                if not self.empty() and not getter.cancelled():
+                    self._wakeup_next()
+                raise
+        return self.get_nowait()
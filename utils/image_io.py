@@ -0,0 +1,29 @@
+import io
+
+from PIL import Image
+
+# Magic bytes -> file suffix for the formats Discord shows inline
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+)
+
+
+def image_suffix(data, default=".png"):
+    """File suffix for encoded image bytes (sniffed, not trusted from the name)."""
+    head = bytes(data[:12])
+    for magic, suffix in _SIGNATURES:
+        if head.startswith(magic):
+            return suffix
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return default
+
+
+def decode_image(data):
+    """Decode bytes / memoryview into a fully loaded PIL image."""
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import io
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from utils.phash_index import image_phash
+
+# Decode JPEGs at a reduced DCT scale, but never below this size. pHash only
+# looks at a 32x32 thumbnail so this costs at most a bit or two of hash, and
+# it is large enough for the default model inputs, so one decode serves both.
+DRAFT_SIZE = (512, 512)
+# Longest side handed to the hash after downscaling
+HASH_MAX_SIDE = 512
+
+STAGES = ("decode", "downscale", "hash")
+PREPARE_STAGES = ("downscale", "encode")
+
+
+def _decode(data, request=DRAFT_SIZE):
+    """Open and load an image, in draft mode for JPEG.
+
+    Returns `(image, (width, height), format)`; width/height are the
+    original dimensions.
+    """
+    img = Image.open(io.BytesIO(data))
+    size, fmt = img.size, img.format
+    if fmt == "JPEG":
+        img.draft("RGB", request)
+    img.load()
+    return img, size, fmt
+
+
+def _phash(img, timings):
+    """Downscale (in place for L/RGB) and pHash an image decoded with DRAFT_SIZE."""
+    start = time.perf_counter()
+    if img.mode not in ("L", "RGB"):
+        # Pillow resizes P/1 with NEAREST whatever filter is asked for, and
+        # imagehash converts to L anyway; do it first so the thumbnail filters
+        img = img.convert("L")
+    if max(img.size) > HASH_MAX_SIDE:
+        img.thumbnail((HASH_MAX_SIDE, HASH_MAX_SIDE), Image.BILINEAR, reducing_gap=2.0)
+    now = time.perf_counter()
+    timings["downscale"] = now - start
+    value = image_phash(img)
+    timings["hash"] = time.perf_counter() - now
+    return value
+
+
+def _hash_image(data):
+    """Worker: decode (draft mode for JPEG) -> downscale -> pHash.
+
+    The sell flow's hash; `_analyze_image` computes the same value. Returns
+    `(phash, (width, height), {stage: seconds})`; width/height are the
+    original dimensions.
+    """
+    start = time.perf_counter()
+    img, size, _ = _decode(data)
+    timings = {"decode": time.perf_counter() - start}
+    return _phash(img, timings), size, timings
+
+
+def _payload(data, img, original, fmt, size, fit, quality):
+    """A model input from a decoded image: shrunk to `size` and re-encoded.
+
+    `fit="long"` scales the longest side to `size` (pad-to-square models such
+    as wd-tagger), `fit="short"` the shortest side (CLIP-style resize +
+    center crop). Returns `(bytes or None, {stage: seconds})`; None means the
+    original is already as small, so send it unchanged.
+    """
+    timings = {}
+    width, height = original
+    scale = size / (max(width, height) if fit == "long" else min(width, height))
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+    if scale >= 1 and fmt == "JPEG":
+        return None, timings
+    if scale < 1 and (img.size[0] < target[0] or img.size[1] < target[1]):
+        # Model input larger than DRAFT_SIZE: this one needs its own decode
+        img, _, _ = _decode(data, target)
+
+    start = time.perf_counter()
+    if img.mode in ("RGBA", "LA", "P"):
+        # Models composite transparency onto white; do it here so JPEG works
+        img = img.convert("RGBA")
+        canvas = Image.new("RGBA", img.size, (255, 255, 255, 255))
+        canvas.alpha_composite(img)
+        img = canvas
+    img = img.convert("RGB")
+    if scale < 1:
+        img = img.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    now = time.perf_counter()
+    timings["downscale"] = now - start
+
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality)
+    timings["encode"] = time.perf_counter() - now
+    if out.tell() >= len(data):
+        return None, timings
+    return out.getvalue(), timings
+
+
+def _analyze_image(data, targets, quality):
+    """Worker: decode once -> every model payload + the sell-flow pHash.
+
+    `targets` is `{name: (size, fit)}`. Returns
+    `(phash, {name: (bytes or None, {stage: seconds})}, {stage: seconds})`.
+    """
+    start = time.perf_counter()
+    img, original, fmt = _decode(data)
+    timings = {"decode": time.perf_counter() - start}
+    # Payloads first: the hash downscales the decoded image in place
+    payloads = {
+        name: _payload(data, img, original, fmt, size, fit, quality)
+        for name, (size, fit) in targets.items()
+    }
+    return _phash(img, timings), payloads, timings
+
+
+def _warm_up():
+    return True
+
+
+class _StageStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, secs):
+        self.count += 1
+        self.total += secs
+        self.max = max(self.max, secs)
+
+    def as_dict(self):
+        return {
+            "avg_ms": (self.total / self.count * 1000) if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+class ImageService:
+    """CPU-heavy image work (decode, downscale, pHash) in worker processes.
+
+    Keeps Pillow/imagehash off the event loop thread and off the GIL, so a
+    large PNG can't stall the gateway heartbeat and several uploads hash in
+    parallel across cores. `processes=0` falls back to a thread.
+    """
+
+    def __init__(self, processes=2):
+        self.processes = max(0, processes)
+        self._executor = None
+        self._warm_up = None
+        self.jobs = 0
+        self.failed = 0
+        self.stages = {name: _StageStats() for name in STAGES}
+        self.prepare_stages = {name: _StageStats() for name in PREPARE_STAGES}
+        # Wall time minus worker time: queueing + pickling overhead
+        self.overhead = _StageStats()
+
+    @property
+    def running(self):
+        return self._executor is not None or self.processes == 0
+
+    async def start(self):
+        """Create the pool and warm the workers up in the background."""
+        if self.processes == 0 or self._executor is not None:
+            return
+        # Forking a process that already runs an event loop and sqlite threads
+        # is unsafe; forkserver imports this module once and forks from there.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+        else:
+            context = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+        # Start the workers now rather than on the first upload, without
+        # holding up whoever called start()
+        loop = asyncio.get_running_loop()
+        self._warm_up = asyncio.gather(
+            *(loop.run_in_executor(self._executor, _warm_up) for _ in range(self.processes)),
+            return_exceptions=True
+        )
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, fn, *args):
+        if self._executor is None:
+            return await asyncio.to_thread(fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _record(self, timings, elapsed):
+        self.jobs += 1
+        for name, secs in timings.items():
+            self.stages[name].record(secs)
+        self.overhead.record(max(0.0, elapsed - sum(timings.values())))
+
+    async def phash(self, data):
+        """pHash (unsigned 64-bit int) of encoded image bytes."""
+        start = time.perf_counter()
+        try:
+            value, _, timings = await self._run(_hash_image, bytes(data))
+        except Exception:
+            self.failed += 1
+            raise
+        self._record(timings, time.perf_counter() - start)
+        return value
+
+    async def analyze(self, data, targets, quality=90):
+        """pHash plus model upload payloads from a single decode.
+
+        `targets` is `{name: (size, fit)}`; each payload is `data` shrunk to
+        `size` and re-encoded as JPEG, or `data` itself when that would not
+        make it smaller. Returns `(phash, {name: (payload, seconds)})`.
+        """
+        start = time.perf_counter()
+        try:
+            value, results, timings = await self._run(_analyze_image, bytes(data), dict(targets), quality)
+        except Exception:
+            self.failed += 1
+            raise
+        payloads = {}
+        for name, (out, prep) in results.items():
+            for stage, secs in prep.items():
+                self.prepare_stages[stage].record(secs)
+            payloads[name] = (data if out is None else out, sum(prep.values()))
+        prep_total = sum(secs for _, secs in payloads.values())
+        self._record(timings, time.perf_counter() - start - prep_total)
+        return value, payloads
+
+    def stats(self):
+        stats = {
+            "processes": self.processes,
+            "jobs": self.jobs,
+            "failed": self.failed,
+            "overhead": self.overhead.as_dict(),
+            "prepare": {name: stage.as_dict() for name, stage in self.prepare_stages.items()},
+        }
+        for name, stage in self.stages.items():
+            stats[name] = stage.as_dict()
+        return stats
+
+
+class PayloadStats:
+    """Upload size counters for one model's preprocessing stage.
+
+    Latency saved is an estimate: bytes not uploaded at `uplink_mbps`, minus
+    the time spent preprocessing.
+    """
+
+    def __init__(self, uplink_mbps=20.0):
+        self.uplink_mbps = uplink_mbps
+        self.images = 0
+        self.shrunk = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.prepare_secs = 0.0
+        self._call_secs = collections.deque(maxlen=256)
+
+    def record_prepare(self, size_in, size_out, secs):
+        self.images += 1
+        if size_out < size_in:
+            self.shrunk += 1
+        self.bytes_in += size_in
+        self.bytes_out += size_out
+        self.prepare_secs += secs
+
+    def record_call(self, secs):
+        self._call_secs.append(secs)
+
+    def stats(self):
+        saved = self.bytes_in - self.bytes_out
+        upload_secs = saved * 8 / (self.uplink_mbps * 1_000_000) if self.uplink_mbps else 0.0
+        calls = self._call_secs
+        return {
+            "images": self.images,
+            "shrunk": self.shrunk,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": saved,
+            "saved_ratio": saved / self.bytes_in if self.bytes_in else 0.0,
+            "prepare_ms": (self.prepare_secs / self.images * 1000) if self.images else 0.0,
+            "latency_saved_s": upload_secs - self.prepare_secs,
+            "avg_call_ms": (sum(calls) / len(calls) * 1000) if calls else 0.0,
+        }
@@ -0,0 +1,332 @@
+"""Inference backends for the tagger / scorer models.
+
+Every backend returns the same raw shapes the wd-tagger and waifu-scorer
+Spaces return, so BrokerCog parses them the same way:
+
+- 'tag':   (general tags "a, b, c", rating label, character label, general label)
+           where a label is {"label": top, "confidences": [{"label", "confidence"}]}
+- 'score': float aesthetic score (0-10)
+
+Inputs are the encoded image bytes (no temp files on our side); calls are
+blocking and the InferencePool runs them on its worker threads.
+Select one with INFERENCE_BACKEND=gradio|onnx|mock.
+"""
+import csv
+import hashlib
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import numpy as np
+from PIL import Image
+
+from utils.image_io import decode_image, image_suffix
+
+TASKS = ("tag", "score")
+# Per-call deadline in seconds; 0 = the backend's default
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "0"))
+
+
+def _label(confidences):
+    """{name: conf} -> gradio Label output."""
+    ordered = sorted(confidences.items(), key=lambda kv: kv[1], reverse=True)
+    return {
+        "label": ordered[0][0] if ordered else None,
+        "confidences": [{"label": name, "confidence": float(conf)} for name, conf in ordered],
+    }
+
+
+class InferenceBackend:
+    """Base class. Subclasses implement `predict`; batch-capable ones also
+    override `predict_batch` and set `supports_batch`."""
+
+    name = "base"
+    supports_batch = False
+    default_timeout = 60.0
+
+    @property
+    def timeout(self):
+        """Seconds one predict / predict_batch call may take."""
+        return AI_TIMEOUT or self.default_timeout
+
+    def load(self):
+        """Blocking setup (connect / load models). Safe to call again."""
+
+    def model_id(self, task_type):
+        """`(model, version)` used as the inference cache key."""
+        raise NotImplementedError
+
+    def predict(self, task_type, data):
+        """Run one model on encoded image bytes."""
+        raise NotImplementedError
+
+    def predict_batch(self, task_type, images):
+        return [self.predict(task_type, data) for data in images]
+
+    def close(self):
+        pass
+
+
+class GradioBackend(InferenceBackend):
+    """Hugging Face Spaces through gradio_client (one network call per image)."""
+
+    name = "gradio"
+    # A sleeping Space takes a while to wake up
+    default_timeout = 90.0
+    SPACES = {
+        "tag": ("SmilingWolf/wd-tagger", os.getenv("TAGGER_VERSION", "wd-swinv2-tagger-v3")),
+        "score": ("Eugeoter/waifu-scorer-v3", os.getenv("SCORER_VERSION", "v3")),
+    }
+
+    def __init__(self, hf_token=None):
+        self.hf_token = hf_token
+        self.clients = {}
+
+    def load(self):
+        from gradio_client import Client
+
+        for task_type in TASKS:
+            if task_type not in self.clients:
+                self.clients[task_type] = Client(self.SPACES[task_type][0], token=self.hf_token)
+
+    def model_id(self, task_type):
+        return self.SPACES[task_type]
+
+    def predict(self, task_type, data):
+        from gradio_client import handle_file
+
+        client = self.clients.get(task_type)
+        if client is None:
+            raise RuntimeError("AIクライアントが初期化されていません。")
+        # gradio_client uploads from a path, so the bytes hit disk only here
+        with tempfile.NamedTemporaryFile(suffix=image_suffix(data), delete=False) as f:
+            f.write(data)
+        job = None
+        try:
+            job = client.submit(handle_file(f.name), api_name="/predict")
+            return job.result(timeout=self.timeout)
+        except FutureTimeout:
+            job.cancel()
+            raise TimeoutError(f"{self.SPACES[task_type][0]} did not answer within {self.timeout:.0f}s") from None
+        except Exception as e:
+            print(f"Prediction Error: {e}")
+            raise
+        finally:
+            os.remove(f.name)
+
+
+# --- Local ONNX models (run in worker processes) ---------------------------
+
+# Per-process session cache: {model_path: InferenceSession}
+_sessions = {}
+
+
+def _session(model_path):
+    if model_path not in _sessions:
+        import onnxruntime
+
+        _sessions[model_path] = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+    return _sessions[model_path]
+
+
+def _load_rgb(data, fill):
+    img = decode_image(data).convert("RGBA")
+    canvas = Image.new("RGBA", img.size, fill + (255,))
+    canvas.alpha_composite(img)
+    return canvas.convert("RGB")
+
+
+def _load_square(data, size, fill=(255, 255, 255)):
+    img = _load_rgb(data, fill)
+    side = max(img.size)
+    square = Image.new("RGB", (side, side), fill)
+    square.paste(img, ((side - img.width) // 2, (side - img.height) // 2))
+    return square.resize((size, size), Image.BICUBIC)
+
+
+def _load_center_crop(data, size, fill=(0, 0, 0)):
+    # CLIP preprocessing: bicubic resize of the short side, then center crop
+    img = _load_rgb(data, fill)
+    scale = size / min(img.size)
+    width, height = max(size, round(img.width * scale)), max(size, round(img.height * scale))
+    img = img.resize((width, height), Image.BICUBIC)
+    left, top = (width - size) // 2, (height - size) // 2
+    return img.crop((left, top, left + size, top + size))
+
+
+def _onnx_tag(model_path, labels, images, general_thresh, character_thresh):
+    session = _session(model_path)
+    inp = session.get_inputs()[0]
+    size = inp.shape[1] if isinstance(inp.shape[1], int) else 448
+    # wd-tagger v3 models take NHWC float32 BGR in 0-255
+    batch = np.stack([np.asarray(_load_square(p, size), dtype=np.float32)[:, :, ::-1] for p in images])
+    probs = session.run(None, {inp.name: batch})[0]
+
+    results = []
+    for row in probs:
+        rating, character, general = {}, {}, {}
+        for (name, category), prob in zip(labels, row):
+            if category == 9:
+                rating[name] = prob
+            elif category == 4 and prob >= character_thresh:
+                character[name] = prob
+            elif category == 0 and prob >= general_thresh:
+                general[name] = prob
+        tags = sorted(general, key=general.get, reverse=True)
+        results.append((", ".join(t.replace("_", " ") for t in tags), _label(rating), _label(character), _label(general)))
+    return results
+
+
+_CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+_CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+
+def _onnx_score(model_path, images):
+    session = _session(model_path)
+    inp = session.get_inputs()[0]
+    # Expects an export of CLIP + MLP head: NCHW 224x224 CLIP-normalized -> score
+    batch = np.stack([
+        ((np.asarray(_load_center_crop(p, 224), dtype=np.float32) / 255.0 - _CLIP_MEAN) / _CLIP_STD).transpose(2, 0, 1)
+        for p in images
+    ])
+    scores = session.run(None, {inp.name: batch})[0]
+    return [float(s) for s in np.asarray(scores).reshape(len(images), -1)[:, 0]]
+
+
+class OnnxBackend(InferenceBackend):
+    """Local CPU inference with onnxruntime in a process pool.
+
+    Needs `onnxruntime` and the model files:
+    ONNX_TAGGER_MODEL + ONNX_TAGGER_LABELS (a wd-tagger model.onnx and its
+    selected_tags.csv) and ONNX_SCORER_MODEL (waifu-scorer exported to ONNX).
+    """
+
+    name = "onnx"
+    supports_batch = True
+    default_timeout = 30.0
+
+    def __init__(self, tagger_model=None, tagger_labels=None, scorer_model=None, processes=None):
+        self.tagger_model = tagger_model or os.getenv("ONNX_TAGGER_MODEL", "models/wd-tagger/model.onnx")
+        self.tagger_labels = tagger_labels or os.getenv("ONNX_TAGGER_LABELS", "models/wd-tagger/selected_tags.csv")
+        self.scorer_model = scorer_model or os.getenv("ONNX_SCORER_MODEL", "models/waifu-scorer/model.onnx")
+        self.processes = processes or int(os.getenv("ONNX_PROCESSES", "2"))
+        self.general_thresh = float(os.getenv("ONNX_GENERAL_THRESHOLD", "0.35"))
+        self.character_thresh = float(os.getenv("ONNX_CHARACTER_THRESHOLD", "0.85"))
+        self.labels = None
+        self._executor = None
+
+    def load(self):
+        try:
+            import onnxruntime  # noqa: F401
+        except ImportError:
+            raise RuntimeError("onnxruntime がインストールされていません。(pip install onnxruntime)")
+        for path in (self.tagger_model, self.tagger_labels, self.scorer_model):
+            if not os.path.exists(path):
+                raise RuntimeError(f"モデルファイルが見つかりません: {path}")
+        if self.labels is None:
+            with open(self.tagger_labels, newline="", encoding="utf-8") as f:
+                self.labels = [(row["name"], int(row["category"])) for row in csv.DictReader(f)]
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=max(1, self.processes))
+
+    def model_id(self, task_type):
+        path = self.tagger_model if task_type == "tag" else self.scorer_model
+        stat = os.stat(path) if os.path.exists(path) else None
+        # Replacing the model file changes the version
+        return f"onnx:{os.path.basename(os.path.dirname(path)) or path}", f"{stat.st_size}-{int(stat.st_mtime)}" if stat else "missing"
+
+    def predict(self, task_type, data):
+        return self.predict_batch(task_type, [data])[0]
+
+    def predict_batch(self, task_type, images):
+        if self._executor is None:
+            raise RuntimeError("ONNX backend is not loaded.")
+        # memoryviews don't pickle; worker processes need real bytes
+        images = [bytes(data) for data in images]
+        if task_type == "tag":
+            future = self._executor.submit(
+                _onnx_tag, self.tagger_model, self.labels, images, self.general_thresh, self.character_thresh
+            )
+        else:
+            future = self._executor.submit(_onnx_score, self.scorer_model, images)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise TimeoutError(f"ONNX {task_type} batch of {len(images)} exceeded {self.timeout:.0f}s") from None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+# --- Mock -------------------------------------------------------------------
+
+_MOCK_GENERAL = [
+    "1girl", "solo", "long hair", "smile", "blue eyes", "blush", "short hair", "open mouth",
+    "school uniform", "outdoors", "sky", "cat ears", "twintails", "hat", "flower", "night",
+]
+_MOCK_CHARACTERS = ["hatsune miku", "rem (re:zero)", "saber (fate)", "kirisame marisa"]
+
+
+class MockBackend(InferenceBackend):
+    """Deterministic fake models for offline runs and load tests.
+
+    Results are derived from the SHA-256 of the image bytes, so the same
+    image always gets the same tags and score. Each call (or batch) sleeps
+    MOCK_LATENCY_MS to imitate a remote model and fails with probability
+    MOCK_FAIL_RATE (0-1) to exercise the circuit breaker.
+    """
+
+    name = "mock"
+    supports_batch = True
+    default_timeout = 10.0
+
+    def __init__(self, latency=None, fail_rate=None):
+        self.latency = latency if latency is not None else float(os.getenv("MOCK_LATENCY_MS", "200")) / 1000
+        self.fail_rate = fail_rate if fail_rate is not None else float(os.getenv("MOCK_FAIL_RATE", "0"))
+
+    def model_id(self, task_type):
+        return f"mock:{task_type}", "1"
+
+    def _fake(self, task_type, digest):
+        if task_type == "score":
+            return int.from_bytes(digest[:4], "big") % 1001 / 100
+        bits = int.from_bytes(digest[4:8], "big")
+        general = {tag: 0.5 + (digest[8 + i] % 50) / 100 for i, tag in enumerate(_MOCK_GENERAL) if bits >> i & 1}
+        character = {}
+        if digest[30] % 4 == 0:
+            character[_MOCK_CHARACTERS[digest[31] % len(_MOCK_CHARACTERS)]] = 0.9
+        tags = ", ".join(sorted(general, key=general.get, reverse=True))
+        return tags, _label({"general": 0.9, "sensitive": 0.1}), _label(character), _label(general)
+
+    def predict(self, task_type, data):
+        return self.predict_batch(task_type, [data])[0]
+
+    def predict_batch(self, task_type, images):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise RuntimeError(f"mock {task_type} failure")
+        return [self._fake(task_type, hashlib.sha256(data).digest()) for data in images]
+
+
+BACKENDS = {
+    "gradio": GradioBackend,
+    "onnx": OnnxBackend,
+    "mock": MockBackend,
+}
+
+
+def create_backend(name=None, hf_token=None):
+    """Backend named by `name` or INFERENCE_BACKEND (default: gradio)."""
+    name = (name or os.getenv("INFERENCE_BACKEND", "gradio")).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND: {name} (choose from {', '.join(BACKENDS)})")
+    if name == "gradio":
+        return GradioBackend(hf_token)
+    return BACKENDS[name]()
@@ -0,0 +1,111 @@
+import json
+import time
+
+from utils.lru import LRUCache
+
+# Run age/size eviction after this many stores
+EVICT_EVERY = 100
+
+
+class InferenceCache:
+    """Persistent cache of raw model outputs keyed by image content.
+
+    Key is `(sha256 of the image bytes, model, model_version)`; bumping a
+    model's version makes its old entries unreachable (they age out). Hot
+    entries live in an in-memory LRU in front of the `inference_cache`
+    table. Reads use a pooled reader, stores go through the DB writer.
+
+    Eviction: rows older than `max_age` seconds are dropped, and the table
+    is trimmed to the newest `max_rows` entries.
+    """
+
+    def __init__(self, bank, maxsize=1024, max_age=30 * 86400, max_rows=100000):
+        self.bank = bank
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self._lru = LRUCache(maxsize)
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evicted = 0
+
+    def _expired(self, created_at):
+        return bool(self.max_age) and time.time() - created_at > self.max_age
+
+    async def get(self, digest, model, version):
+        """Cached result, or None."""
+        key = (digest, model, version)
+        entry = self._lru.get(key)
+        if entry is not None:
+            value, created_at = entry
+            if not self._expired(created_at):
+                self.memory_hits += 1
+                return value
+            self._lru.pop(key)
+
+        async with self.bank.acquire() as db:
+            cursor = await db.execute(
+                "SELECT result, created_at FROM inference_cache WHERE content_sha256 = ? AND model = ? AND model_version = ?",
+                key
+            )
+            row = await cursor.fetchone()
+        if row is None or self._expired(row[1]):
+            self.misses += 1
+            return None
+
+        value = json.loads(row[0])
+        self._lru.put(key, (value, row[1]))
+        self.disk_hits += 1
+        return value
+
+    async def put(self, digest, model, version, result):
+        key = (digest, model, version)
+        payload = json.dumps(result, ensure_ascii=False, default=str)
+        created_at = time.time()
+        # Store the JSON round-trip so memory and disk hits look the same
+        self._lru.put(key, (json.loads(payload), created_at))
+
+        async def store(db):
+            await db.execute(
+                "INSERT OR REPLACE INTO inference_cache (content_sha256, model, model_version, result, created_at) VALUES (?, ?, ?, ?, ?)",
+                (digest, model, version, payload, created_at)
+            )
+        await self.bank.submit_write(store)
+
+        self.stores += 1
+        if self.stores % EVICT_EVERY == 0:
+            await self.evict()
+
+    async def evict(self):
+        """Apply the age and size limits; returns the number of rows removed."""
+        async def trim(db):
+            removed = 0
+            if self.max_age:
+                cursor = await db.execute("DELETE FROM inference_cache WHERE created_at < ?", (time.time() - self.max_age,))
+                removed += cursor.rowcount
+            if self.max_rows:
+                cursor = await db.execute("""
+                    DELETE FROM inference_cache WHERE created_at < (
+                        SELECT created_at FROM inference_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?
+                    )
+                """, (self.max_rows - 1,))
+                removed += cursor.rowcount
+            return removed
+        removed = await self.bank.submit_write(trim)
+        self.evicted += removed
+        return removed
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self._lru),
+            "memory_maxsize": self._lru.maxsize,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evicted": self.evicted,
+        }
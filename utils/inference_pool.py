@@ -0,0 +1,347 @@
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.fair_queue import FairQueue
+from utils.lru import LRUCache
+
+# ETA guess per job before a model has completed anything
+DEFAULT_SERVICE_TIME = 10.0
+# Users with per-user queue stats kept (least recently active dropped first)
+USER_STATS_SIZE = 1024
+
+
+class InferenceBusy(Exception):
+    """A model's queue is full; `eta` is the estimated seconds until it drains."""
+
+    def __init__(self, model, eta):
+        super().__init__(f"{model} inference queue is full (ETA {eta:.0f}s)")
+        self.model = model
+        self.eta = eta
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+class _UserStats:
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.waits = collections.deque(maxlen=128)
+
+    def as_dict(self, depth):
+        done = len(self.waits)
+        return {
+            "depth": depth,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": (self.total_wait / self.completed * 1000) if self.completed else 0.0,
+            "p99_wait_ms": _percentile(self.waits, 0.99) * 1000 if done else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+        }
+
+
+class _ModelLane:
+    """Bounded queue + worker tasks + counters for one model."""
+
+    def __init__(self, name, workers, queue_size, max_batch=1, max_delay=0.005, batch_fn=None, fanout=None, timeout=None):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.batch_fn = batch_fn
+        # Concurrent calls per batch when the model has no batch_fn
+        self.fanout = max(1, fanout or self.max_batch)
+        self.timeout = timeout
+        self.queue = FairQueue(maxsize=self.queue_size)
+        self.users = LRUCache(USER_STATS_SIZE)
+        self.tasks = []
+        self.executor = None
+        self.busy = 0
+
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.max_depth = 0
+        self.batches = 0
+        self.batched_jobs = 0
+        self.max_batch_seen = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.max_service = 0.0
+        self._recent_service = collections.deque(maxlen=64)
+        self._recent_wait = collections.deque(maxlen=512)
+
+    def avg_service(self):
+        if not self._recent_service:
+            return DEFAULT_SERVICE_TIME
+        return sum(self._recent_service) / len(self._recent_service)
+
+    def eta(self):
+        """Seconds until a job submitted now would finish."""
+        ahead = self.queue.qsize() + self.busy
+        return (ahead // (self.workers * self.max_batch) + 1) * self.avg_service()
+
+    def threads(self):
+        return self.workers * (1 if self.batch_fn else self.fanout)
+
+    def user(self, key):
+        stats = self.users.get(key)
+        if stats is None:
+            stats = _UserStats()
+            self.users.put(key, stats)
+        return stats
+
+    def record(self, wait, service, ok, key=None):
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self._recent_wait.append(wait)
+        if key is not None:
+            user = self.user(key)
+            user.completed += 1
+            user.total_wait += wait
+            user.max_wait = max(user.max_wait, wait)
+            user.waits.append(wait)
+        self.total_service += service
+        self.max_service = max(self.max_service, service)
+        self._recent_service.append(service)
+
+    def stats(self):
+        done = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "depth": self.queue.qsize(),
+            "queue_size": self.queue_size,
+            "max_depth": self.max_depth,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "batches": self.batches,
+            "avg_batch": self.batched_jobs / self.batches if self.batches else 0.0,
+            "max_batch": self.max_batch_seen,
+            "avg_wait_ms": (self.total_wait / done * 1000) if done else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "p99_wait_ms": _percentile(self._recent_wait, 0.99) * 1000,
+            "avg_service_ms": (self.total_service / done * 1000) if done else 0.0,
+            "max_service_ms": self.max_service * 1000,
+            "eta": self.eta(),
+        }
+
+
+class InferencePool:
+    """Per-model worker pools for blocking inference calls.
+
+    Each model gets its own bounded queue and `workers` tasks that run the
+    blocking call on that model's own thread pool, so one slow model (or one
+    hung call) only holds up that model's threads. When a queue is
+    full, `submit` raises InferenceBusy with an ETA instead of queueing.
+
+    Micro-batching: with `max_batch > 1` a worker collects up to that many
+    queued jobs (waiting at most `max_delay` seconds for more) and runs them
+    together. Models with a `batch_fn(list_of_args) -> list_of_results`
+    get one call per batch; the rest fan out with at most `fanout` calls in
+    flight. Every job's future is still resolved on its own.
+
+    Queues are fair: jobs submitted with a `(guild_id, user_id)` key are
+    served round-robin across guilds and users (see FairQueue), so one
+    user's backlog doesn't hold everyone else up; `priority=True` jobs
+    (admins) jump ahead.
+
+    With a `timeout`, a call (or batch) that runs longer fails its jobs
+    with TimeoutError and frees the worker. The blocking call itself can't
+    be interrupted, so backends should enforce their own deadline too.
+    """
+
+    def __init__(self):
+        self._lanes = {}
+        self._running = False
+
+    def add_model(self, name, workers=1, queue_size=16, max_batch=1, max_delay=0.005, batch_fn=None, fanout=None, timeout=None):
+        if self.running:
+            raise RuntimeError("Add models before starting the pool.")
+        self._lanes[name] = _ModelLane(name, workers, queue_size, max_batch, max_delay, batch_fn, fanout, timeout)
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self.running:
+            return
+        loop = asyncio.get_running_loop()
+        for lane in self._lanes.values():
+            # Per-lane threads: a call stuck past its timeout keeps its
+            # thread, but only this model runs short of them
+            lane.executor = ThreadPoolExecutor(max_workers=lane.threads(), thread_name_prefix=f"inference-{lane.name}")
+            lane.tasks = [loop.create_task(self._worker(lane)) for _ in range(lane.workers)]
+        self._running = True
+
+    async def stop(self):
+        """Finish queued jobs, then stop the workers."""
+        if not self.running:
+            return
+        for lane in self._lanes.values():
+            for _ in lane.tasks:
+                await lane.queue.put(None)
+        for lane in self._lanes.values():
+            await asyncio.gather(*lane.tasks, return_exceptions=True)
+            lane.tasks = []
+            lane.executor.shutdown(wait=False)
+            lane.executor = None
+        self._running = False
+
+    def check(self, *models):
+        """Raise InferenceBusy if any of `models` can't take another job.
+
+        Call before submitting to several models for one request, so a full
+        queue on one doesn't leave a lone job running on the others.
+        """
+        for name in models:
+            lane = self._lanes[name]
+            if lane.queue.full():
+                lane.rejected += 1
+                raise InferenceBusy(name, lane.eta())
+
+    def submit(self, model, fn, *args, key=None, priority=False):
+        """Queue `fn(*args)` on `model`'s workers and return a future.
+
+        `key` is the `(guild_id, user_id)` the job is scheduled fairly under.
+        """
+        if not self.running:
+            raise RuntimeError("Inference pool is not running.")
+        lane = self._lanes[model]
+        user = lane.user(key) if key is not None else None
+        future = asyncio.get_running_loop().create_future()
+        try:
+            lane.queue.put_nowait((fn, args, future, time.perf_counter(), key), key, priority)
+        except asyncio.QueueFull:
+            lane.rejected += 1
+            if user:
+                user.rejected += 1
+            raise InferenceBusy(model, lane.eta()) from None
+        if user:
+            user.submitted += 1
+        lane.max_depth = max(lane.max_depth, lane.queue.qsize())
+        return future
+
+    async def run(self, model, fn, *args, key=None, priority=False):
+        return await self.submit(model, fn, *args, key=key, priority=priority)
+
+    async def _collect(self, lane, first):
+        batch = [first]
+        deadline = time.perf_counter() + lane.max_delay
+        while len(batch) < lane.max_batch:
+            try:
+                job = lane.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    job = await asyncio.wait_for(lane.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            batch.append(job)
+            if job is None:
+                break
+        return batch
+
+    async def _worker(self, lane):
+        while True:
+            first = await lane.queue.get()
+            if first is None:
+                return
+            batch = await self._collect(lane, first) if lane.max_batch > 1 else [first]
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            batch = [job for job in batch if not job[2].cancelled()]
+            if batch:
+                await self._dispatch(lane, batch)
+            if stop:
+                return
+
+    async def _call(self, lane, fn, *args):
+        call = asyncio.get_running_loop().run_in_executor(lane.executor, fn, *args)
+        if not lane.timeout:
+            return await call
+        try:
+            return await asyncio.wait_for(call, lane.timeout)
+        except asyncio.TimeoutError:
+            lane.timeouts += 1
+            raise TimeoutError(f"{lane.name} call exceeded {lane.timeout:g}s") from None
+
+    async def _dispatch(self, lane, batch):
+        started = time.perf_counter()
+        lane.busy += 1
+        lane.batches += 1
+        lane.batched_jobs += len(batch)
+        lane.max_batch_seen = max(lane.max_batch_seen, len(batch))
+        try:
+            if lane.batch_fn and len(batch) > 1:
+                try:
+                    results = await self._call(lane, lane.batch_fn, [args for _, args, _, _, _ in batch])
+                    if len(results) != len(batch):
+                        raise RuntimeError(f"{lane.name} batch returned {len(results)} results for {len(batch)} inputs")
+                except Exception as e:
+                    results = [e] * len(batch)
+            else:
+                limit = asyncio.Semaphore(lane.fanout)
+
+                async def call(fn, args):
+                    async with limit:
+                        return await self._call(lane, fn, *args)
+
+                results = await asyncio.gather(
+                    *(call(fn, args) for fn, args, _, _, _ in batch), return_exceptions=True
+                )
+        finally:
+            lane.busy -= 1
+
+        service = time.perf_counter() - started
+        for (_, _, future, queued_at, key), result in zip(batch, results):
+            ok = not isinstance(result, BaseException)
+            lane.record(started - queued_at, service, ok, key)
+            if future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self._lanes.items()}
+
+    def user_stats(self, key=None, limit=10):
+        """Per-user queue stats per model: `{model: {key: stats}}`.
+
+        With `key`, just that user; otherwise the `limit` users with the
+        most submissions.
+        """
+        result = {}
+        for name, lane in self._lanes.items():
+            users = lane.users.items()
+            if key is not None:
+                users = [(k, stats) for k, stats in users if k == key]
+            else:
+                users = sorted(users, key=lambda kv: kv[1].submitted, reverse=True)[:limit]
+            result[name] = {k: stats.as_dict(lane.queue.depth(k)) for k, stats in users}
+        return result
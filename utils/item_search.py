@@ -0,0 +1,167 @@
+"""Ranked full-text lookup over item tags and characters (SQLite FTS5).
+
+item_search is an external-content FTS5 table over market_items(tags,
+characters), kept in sync by triggers (migration 7). `find_items` does a
+prefix match on every word, BM25-ranked with character hits weighted
+above tag hits; `scan_items` is the LIKE scan it replaces, kept as the
+fallback for SQLite builds without FTS5 and for comparison:
+
+    python -m utils.item_search --bench --items 100000
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import tempfile
+import time
+
+import aiosqlite
+
+FIND_LIMIT = 10
+# bm25() column weights: tags, characters
+TAG_WEIGHT = 1.0
+CHARACTER_WEIGHT = 2.0
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def query_terms(text):
+    """Search words, split the way the unicode61 tokenizer splits (so
+    "blue_hair" and "blue hair" are the same query)."""
+    return [w.lower() for w in _WORD.findall(text.replace("_", " "))]
+
+
+def build_match(terms, any_term=False):
+    """FTS5 MATCH expression: every term as a quoted prefix query."""
+    joiner = " OR " if any_term else " "
+    return joiner.join(f'"{term}"*' for term in terms)
+
+
+async def fts_available(db):
+    cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'item_search'")
+    return await cursor.fetchone() is not None
+
+
+async def find_items(db, text, limit=FIND_LIMIT):
+    """On-sale items best matching `text`, best first.
+
+    All words must match (as prefixes); if nothing does, any word may.
+    Returns `(rows, matched_all)`; rows are
+    `(item_id, price, aesthetic_score, grade, image_url, tags, characters)`.
+    """
+    terms = query_terms(text)
+    if not terms:
+        return [], True
+    if not await fts_available(db):
+        return await scan_items(db, terms, limit), True
+
+    sql = (
+        "SELECT m.item_id, m.price, m.aesthetic_score, m.grade, m.image_url, m.tags, m.characters "
+        "FROM item_search s JOIN market_items m ON m.item_id = s.rowid "
+        "WHERE item_search MATCH ? AND m.status = 'on_sale' "
+        f"ORDER BY bm25(item_search, {TAG_WEIGHT}, {CHARACTER_WEIGHT}) LIMIT ?"
+    )
+    cursor = await db.execute(sql, (build_match(terms), limit))
+    rows = await cursor.fetchall()
+    if rows or len(terms) == 1:
+        return rows, True
+    cursor = await db.execute(sql, (build_match(terms, any_term=True), limit))
+    return await cursor.fetchall(), False
+
+
+async def scan_items(db, terms, limit=FIND_LIMIT):
+    """LIKE scan over every on-sale row (no ranking; newest first)."""
+    where = ["m.status = 'on_sale'"]
+    params = []
+    for term in terms:
+        where.append("(m.tags LIKE ? OR m.characters LIKE ?)")
+        params.extend([f"%{term}%"] * 2)
+    cursor = await db.execute(
+        "SELECT m.item_id, m.price, m.aesthetic_score, m.grade, m.image_url, m.tags, m.characters "
+        f"FROM market_items m WHERE {' AND '.join(where)} ORDER BY m.item_id DESC LIMIT ?",
+        params + [limit]
+    )
+    return await cursor.fetchall()
+
+
+async def rebuild_index(db):
+    """Re-read the whole FTS index from market_items (no commit)."""
+    await db.execute("INSERT INTO item_search(item_search) VALUES ('rebuild')")
+
+
+# --- Benchmark ---------------------------------------------------------------
+
+_BENCH_TAGS = [
+    "1girl", "solo", "long_hair", "short_hair", "smile", "blush", "blue_eyes", "red_eyes",
+    "blue_hair", "blonde_hair", "maid", "maid_headdress", "school_uniform", "cat_ears",
+    "twintails", "hat", "flower", "night", "sky", "outdoors", "open_mouth", "dress",
+]
+_BENCH_CHARACTERS = ["hatsune miku", "rem (re:zero)", "saber (fate)", "kirisame marisa", "hakurei reimu"]
+_BENCH_QUERIES = ["blue hair maid", "miku", "rem", "cat ear twin", "saber dress night", "zzz nothing"]
+
+
+async def _bench(items, repeat):
+    from utils.migrations import run_migrations
+
+    rnd = random.Random(0)
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    async with aiosqlite.connect(path) as db:
+        await run_migrations(db)
+        rows = []
+        for _ in range(items):
+            tags = [t for t in _BENCH_TAGS if rnd.random() < 0.15] + [f"rare_tag_{rnd.randrange(2000)}"]
+            chars = ", ".join(rnd.sample(_BENCH_CHARACTERS, 1)) if rnd.random() < 0.2 else None
+            status = "on_sale" if rnd.random() < 0.5 else "sold"
+            rows.append((0, "https://example.invalid/x.png", 5.0, rnd.randrange(100, 100000), status, str(tags), chars, "B"))
+        start = time.perf_counter()
+        await db.executemany(
+            "INSERT INTO market_items (seller_id, image_url, aesthetic_score, price, status, tags, characters, grade) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        await db.commit()
+        print(f"{items:,} items inserted (triggers included) in {time.perf_counter() - start:.2f}s")
+
+        # "scan" stops at the first 10 rows in id order (unranked); ranking
+        # with a scan means reading every match ("scan all")
+        print(f"{'query':24s} {'fts ms':>8s} {'scan ms':>8s} {'scan all':>9s} {'hits':>5s}")
+        for text in _BENCH_QUERIES:
+            terms = query_terms(text)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                found, _ = await find_items(db, text)
+            fts_ms = (time.perf_counter() - start) / repeat * 1000
+            start = time.perf_counter()
+            for _ in range(repeat):
+                await scan_items(db, terms)
+            scan_ms = (time.perf_counter() - start) / repeat * 1000
+            start = time.perf_counter()
+            for _ in range(repeat):
+                await scan_items(db, terms, limit=-1)
+            all_ms = (time.perf_counter() - start) / repeat * 1000
+            print(f"{text:24s} {fts_ms:8.2f} {scan_ms:8.2f} {all_ms:9.2f} {len(found):5d}")
+    os.remove(path)
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="FTS5 item search tools.")
+    parser.add_argument("--bench", action="store_true", help="compare FTS5 with the LIKE scan on a synthetic catalog")
+    parser.add_argument("--items", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--db", default=None, help="rebuild the FTS index of this database")
+    args = parser.parse_args()
+
+    async def run():
+        if args.db:
+            async with aiosqlite.connect(args.db, timeout=60.0) as db:
+                await rebuild_index(db)
+                await db.commit()
+            print(f"rebuilt item_search in {args.db}")
+        if args.bench:
+            await _bench(args.items, args.repeat)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,93 @@
+from utils.lru import LRUCache
+
+# Non-item message ids remembered after one indexed lookup
+NEGATIVE_CACHE_SIZE = 4096
+
+
+class MessageIndex:
+    """Gallery message_id -> item_id, so button and reaction handlers can
+    tell item messages from everything else without going to SQLite.
+
+    The map is loaded once at startup and kept current by the paths that
+    post or move a listing (`set` / `remove_item`). A message id the map
+    does not know is looked up once on idx_market_message (it may have been
+    written outside this process) and, if it is not an item, remembered in
+    a bounded negative cache; reactions on chat messages then cost a dict
+    and an LRU probe.
+    """
+
+    def __init__(self, negative_size=NEGATIVE_CACHE_SIZE):
+        self._items = {}
+        self._messages = {}
+        self._negative = LRUCache(negative_size)
+        self.hits = 0
+        self.negative_hits = 0
+        self.db_lookups = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    async def load(self, db):
+        self.clear()
+        cursor = await db.execute("SELECT item_id, message_id FROM market_items WHERE message_id != 0")
+        for item_id, message_id in await cursor.fetchall():
+            self.set(item_id, message_id)
+
+    def set(self, item_id, message_id):
+        """Record that `item_id` is shown on `message_id` (0 = nowhere)."""
+        old = self._messages.pop(item_id, None)
+        if old is not None:
+            self._items.pop(old, None)
+        if message_id:
+            self._items[message_id] = item_id
+            self._messages[item_id] = message_id
+            self._negative.pop(message_id)
+
+    def remove_item(self, item_id):
+        self.set(item_id, 0)
+
+    def forget(self, message_id):
+        """Drop whatever is known about `message_id` (stale map entry)."""
+        item_id = self._items.pop(message_id, None)
+        if item_id is not None:
+            self._messages.pop(item_id, None)
+        self._negative.pop(message_id)
+
+    def clear(self):
+        self._items.clear()
+        self._messages.clear()
+        self._negative.clear()
+
+    async def resolve(self, bank, message_id):
+        """item_id shown on `message_id`, or None if it is not an item message."""
+        item_id = self._items.get(message_id)
+        if item_id is not None:
+            self.hits += 1
+            return item_id
+        if message_id in self._negative:
+            self.negative_hits += 1
+            self._negative.get(message_id)
+            return None
+        self.db_lookups += 1
+        async with bank.acquire() as db:
+            cursor = await db.execute(
+                "SELECT item_id FROM market_items WHERE message_id = ? ORDER BY item_id DESC LIMIT 1", (message_id,)
+            )
+            row = await cursor.fetchone()
+        if row:
+            self.set(row[0], message_id)
+            return row[0]
+        self._negative.put(message_id, True)
+        return None
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.db_lookups
+        return {
+            "items": len(self._items),
+            "negative": len(self._negative),
+            "negative_max": self._negative.maxsize,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "db_lookups": self.db_lookups,
+            "db_rate": self.db_lookups / lookups if lookups else 0.0,
+        }
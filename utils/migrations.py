@@ -0,0 +1,304 @@
+import sqlite3
+import time
+from collections import namedtuple
+
+from utils.phash_index import hash_to_int, to_db
+from utils.tag_index import backfill_item_tags
+
+# Ordered schema steps keyed on PRAGMA user_version. Each step runs once;
+# a warm start with an up-to-date database only reads user_version.
+Migration = namedtuple("Migration", ["version", "name", "apply"])
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(fn):
+        if MIGRATIONS and version <= MIGRATIONS[-1].version:
+            raise ValueError(f"Migration {version} registered out of order")
+        MIGRATIONS.append(Migration(version, name, fn))
+        return fn
+    return register
+
+
+async def get_columns(db, table):
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in await cursor.fetchall()}
+
+
+async def add_column(db, table, column, decl):
+    """ALTER TABLE ... ADD COLUMN, skipped when the column already exists."""
+    if column not in await get_columns(db, table):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+@migration(1, "baseline schema")
+async def _baseline(db):
+    # Bank table
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS bank (
+            user_id INTEGER,
+            guild_id INTEGER,
+            balance INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, guild_id)
+        )
+    """)
+    # Market Items table
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS market_items (
+            item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seller_id INTEGER NOT NULL,
+            image_url TEXT NOT NULL,
+            image_hash TEXT,
+            aesthetic_score REAL NOT NULL,
+            price INTEGER NOT NULL,
+            status TEXT DEFAULT 'on_sale',
+            tags TEXT,
+            grade TEXT,
+            thread_id INTEGER,
+            message_id INTEGER,
+            buyer_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            auction_end_time TEXT,
+            current_bid INTEGER DEFAULT 0,
+            top_bidder_id INTEGER,
+            is_locked BOOLEAN DEFAULT 0
+        )
+    """)
+
+    # Databases created before these features lack the columns (the same
+    # list the pre-migration init_db patched in)
+    await add_column(db, "market_items", "image_hash", "TEXT")
+    await add_column(db, "market_items", "tags", "TEXT")
+    await add_column(db, "market_items", "grade", "TEXT")
+    await add_column(db, "market_items", "thread_id", "INTEGER")
+    await add_column(db, "market_items", "message_id", "INTEGER")
+    await add_column(db, "market_items", "buyer_id", "INTEGER")
+    await add_column(db, "market_items", "auction_end_time", "TEXT")
+    await add_column(db, "market_items", "current_bid", "INTEGER DEFAULT 0")
+    await add_column(db, "market_items", "top_bidder_id", "INTEGER")
+    await add_column(db, "market_items", "is_locked", "BOOLEAN DEFAULT 0")
+
+    # Indices for market_items
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_market_status ON market_items(status)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_market_buyer ON market_items(buyer_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_market_hash ON market_items(image_hash)")
+
+    # Market Trends table
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS market_trends (
+            tag_name TEXT PRIMARY KEY,
+            current_price INTEGER DEFAULT 100,
+            saturation INTEGER DEFAULT 0,
+            trend_bonus INTEGER DEFAULT 0
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_galleries (
+            user_id INTEGER PRIMARY KEY,
+            thread_id INTEGER
+        )
+    """)
+
+    # Tag Stock Market table
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS tag_stocks (
+            tag_name TEXT PRIMARY KEY,
+            current_price REAL DEFAULT 100.0,
+            total_volume INTEGER DEFAULT 0
+        )
+    """)
+
+    # User Stocks table
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_stocks (
+            user_id INTEGER,
+            tag_name TEXT,
+            amount INTEGER DEFAULT 0,
+            average_cost REAL DEFAULT 0,
+            PRIMARY KEY (user_id, tag_name)
+        )
+    """)
+
+
+@migration(2, "integer phash column")
+async def _integer_phash(db):
+    # Hashes are compared as 64-bit ints; store them that way (signed, to
+    # fit SQLite INTEGER). image_hash (hex TEXT) is kept for old rows only.
+    await add_column(db, "market_items", "phash", "INTEGER")
+    cursor = await db.execute("SELECT item_id, image_hash FROM market_items WHERE image_hash IS NOT NULL AND phash IS NULL")
+    updates = []
+    for item_id, image_hash in await cursor.fetchall():
+        try:
+            updates.append((to_db(hash_to_int(image_hash)), item_id))
+        except ValueError:
+            continue
+    await db.executemany("UPDATE market_items SET phash = ? WHERE item_id = ?", updates)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_market_phash ON market_items(phash)")
+
+
+@migration(3, "duplicate cluster audit table")
+async def _dup_clusters(db):
+    # Rewritten wholesale by utils.dup_audit; cluster_id is the smallest
+    # item_id in the cluster.
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS dup_clusters (
+            item_id INTEGER PRIMARY KEY,
+            cluster_id INTEGER NOT NULL,
+            cluster_size INTEGER NOT NULL,
+            max_distance INTEGER NOT NULL,
+            audited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_dup_clusters_cluster ON dup_clusters(cluster_id)")
+
+
+@migration(4, "inference result cache")
+async def _inference_cache(db):
+    # Raw predict() output (JSON) per image content + model + model version
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS inference_cache (
+            content_sha256 TEXT NOT NULL,
+            model TEXT NOT NULL,
+            model_version TEXT NOT NULL,
+            result TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (content_sha256, model, model_version)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_inference_cache_created ON inference_cache(created_at)")
+
+
+@migration(5, "content sha256 column")
+async def _content_sha256(db):
+    # Exact-duplicate lookups (utils.content_index). Existing rows stay NULL
+    # until backfilled, since that needs the image bytes.
+    await add_column(db, "market_items", "content_sha256", "TEXT")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_market_sha256 ON market_items(content_sha256)")
+
+
+@migration(6, "normalized item tags")
+async def _item_tags(db):
+    # One row per (item, tag) so tag filters are index lookups instead of
+    # LIKE scans over market_items.tags
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS item_tags (
+            item_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (item_id, tag)
+        ) WITHOUT ROWID
+    """)
+    # Rows go away with their item, whichever code path deletes it
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_market_items_delete_tags
+        AFTER DELETE ON market_items
+        BEGIN
+            DELETE FROM item_tags WHERE item_id = old.item_id;
+        END
+    """)
+    await backfill_item_tags(db)
+    # Built after the backfill: one sort instead of random inserts
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_item_tags_tag ON item_tags(tag, item_id)")
+
+
+@migration(7, "full-text search over tags and characters")
+async def _item_search(db):
+    await add_column(db, "market_items", "characters", "TEXT")
+    # External content: the index stores tokens only and reads the text
+    # back from market_items, so the triggers below must pass old values.
+    # prefix= keeps short-prefix queries ("mi"*) from expanding term by term.
+    try:
+        await db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS item_search USING fts5(
+                tags, characters,
+                content='market_items', content_rowid='item_id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5: !find falls back to a LIKE scan
+        print(f"FTS5 unavailable, skipping item_search: {e}")
+        return
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_insert AFTER INSERT ON market_items
+        BEGIN
+            INSERT INTO item_search(rowid, tags, characters) VALUES (new.item_id, new.tags, new.characters);
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_delete AFTER DELETE ON market_items
+        BEGIN
+            INSERT INTO item_search(item_search, rowid, tags, characters) VALUES ('delete', old.item_id, old.tags, old.characters);
+        END
+    """)
+    # Resales only touch price/status/owner, which are read from
+    # market_items at query time; only text changes need re-indexing
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_item_search_update AFTER UPDATE OF tags, characters ON market_items
+        BEGIN
+            INSERT INTO item_search(item_search, rowid, tags, characters) VALUES ('delete', old.item_id, old.tags, old.characters);
+            INSERT INTO item_search(rowid, tags, characters) VALUES (new.item_id, new.tags, new.characters);
+        END
+    """)
+    await db.execute("INSERT INTO item_search(item_search) VALUES ('rebuild')")
+
+
+@migration(8, "inventory index")
+async def _inventory_index(db):
+    # Owner + status covers the inventory COUNT(*) without touching the table
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_market_buyer_status ON market_items(buyer_id, status)")
+
+
+@migration(9, "message index")
+async def _message_index(db):
+    # Buy buttons and reactions find their item by gallery message id
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_market_message ON market_items(message_id)")
+
+
+@migration(10, "reaction reward dedupe")
+async def _reaction_rewards(db):
+    # One reward per reactor per gallery message, however often they re-react
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS reaction_rewards (
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (message_id, user_id)
+        ) WITHOUT ROWID
+    """)
+
+
+async def get_schema_version(db):
+    cursor = await db.execute("PRAGMA user_version")
+    row = await cursor.fetchone()
+    return row[0]
+
+
+async def run_migrations(db):
+    """Apply pending migrations in one transaction.
+
+    Returns `[(version, name, seconds), ...]` for the steps that ran; an
+    empty list means the schema was already current.
+    """
+    current = await get_schema_version(db)
+    pending = [m for m in MIGRATIONS if m.version > current]
+    if not pending:
+        return []
+
+    timings = []
+    await db.execute("BEGIN")
+    try:
+        for step in pending:
+            start = time.perf_counter()
+            await step.apply(db)
+            timings.append((step.version, step.name, time.perf_counter() - start))
+        # PRAGMA doesn't take bound parameters; the version is our own int
+        await db.execute(f"PRAGMA user_version = {int(pending[-1].version)}")
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return timings
@@ -0,0 +1,64 @@
+from utils.lru import LRUCache
+
+# Pages kept per open view (current + neighbours for back/forward)
+PAGE_CACHE_SIZE = 3
+# Upper bound for the first page (largest SQLite INTEGER)
+FIRST_PAGE = (1 << 63) - 1
+
+
+class KeysetPager:
+    """Newest-first pages of rows fetched on demand by item_id keyset.
+
+    `fetch(db, before_id, limit)` returns rows whose first column is the
+    item_id, `WHERE item_id < before_id ORDER BY item_id DESC LIMIT limit`
+    (before_id is FIRST_PAGE for the first page); `count(db)` returns the
+    total.
+    Only the last few pages and one boundary id per visited page are held,
+    so memory stays O(page size) however large the result set is.
+    """
+
+    def __init__(self, bank, fetch, count, per_page=5, cache_size=PAGE_CACHE_SIZE):
+        self.bank = bank
+        self.fetch = fetch
+        self.count = count
+        self.per_page = per_page
+        self.total = 0
+        # _cursors[n] = item_id page n starts below
+        self._cursors = [FIRST_PAGE]
+        self._pages = LRUCache(cache_size)
+
+    @property
+    def max_page(self):
+        return max(0, (self.total - 1) // self.per_page)
+
+    async def refresh_count(self):
+        async with self.bank.acquire() as db:
+            self.total = await self.count(db)
+        return self.total
+
+    async def page(self, number):
+        """Rows of page `number`; pages are reached one step at a time."""
+        rows = self._pages.get(number)
+        if rows is not None:
+            return rows
+        if number >= len(self._cursors):
+            raise IndexError(f"page {number} has not been reached yet")
+        async with self.bank.acquire() as db:
+            # One extra row tells whether another page follows
+            rows = await self.fetch(db, self._cursors[number], self.per_page + 1)
+        has_next = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if has_next:
+            if number + 1 == len(self._cursors):
+                self._cursors.append(rows[-1][0])
+            self.total = max(self.total, (number + 1) * self.per_page + 1)
+        else:
+            # Last page: the exact total is known now, even if rows were
+            # bought or listed since the count
+            del self._cursors[number + 1:]
+            self.total = number * self.per_page + len(rows)
+        self._pages.put(number, rows)
+        return rows
+
+    def has_next(self, number):
+        return number + 1 < len(self._cursors)
@@ -0,0 +1,237 @@
+from itertools import combinations
+
+import imagehash
+import numpy as np
+
+# Hamming distance at or below which two images count as duplicates
+DUPLICATE_DISTANCE = 5
+
+HASH_BITS = 64
+CHUNK_BITS = 16
+CHUNKS = HASH_BITS // CHUNK_BITS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def image_phash(img):
+    """pHash of a PIL image as an unsigned 64-bit int."""
+    return hash_to_int(str(imagehash.phash(img)))
+
+
+def hash_to_int(image_hash):
+    """Hex string from imagehash (or an int) -> unsigned 64-bit int."""
+    if image_hash is None:
+        return None
+    if isinstance(image_hash, (int, np.integer)):
+        return int(image_hash) & HASH_MASK
+    return int(str(image_hash), 16)
+
+
+def to_db(value):
+    """Unsigned 64-bit hash -> signed value that fits an SQLite INTEGER."""
+    if value is None:
+        return None
+    return value - (1 << HASH_BITS) if value >= (1 << (HASH_BITS - 1)) else value
+
+
+def from_db(value):
+    """Signed SQLite INTEGER -> unsigned 64-bit hash."""
+    if value is None:
+        return None
+    return value & HASH_MASK
+
+
+_flip_masks = {}
+
+
+def _masks_within(radius):
+    """All CHUNK_BITS-wide XOR masks with at most `radius` bits set."""
+    if radius not in _flip_masks:
+        masks = [0]
+        for r in range(1, radius + 1):
+            for bits in combinations(range(CHUNK_BITS), r):
+                mask = 0
+                for b in bits:
+                    mask |= 1 << b
+                masks.append(mask)
+        _flip_masks[radius] = masks
+    return _flip_masks[radius]
+
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(values):
+        return np.bitwise_count(values)
+else:
+    _BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values):
+        return _BYTE_POPCOUNT[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+class PHashMatrix:
+    """All hashes in one growable uint64 array for vectorized Hamming scans.
+
+    Costs 8 bytes per hash (+8 for the item_id column) instead of a Python
+    object per item. A scan XORs the whole array with the query and
+    popcounts it in one NumPy call.
+    """
+
+    def __init__(self, capacity=1024):
+        self._values = np.zeros(capacity, dtype=np.uint64)
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self):
+        capacity = max(1024, len(self._values) * 2)
+        self._values = np.resize(self._values, capacity)
+        self._ids = np.resize(self._ids, capacity)
+
+    def add(self, item_id, value):
+        if self._size == len(self._values):
+            self._grow()
+        self._values[self._size] = np.uint64(value)
+        self._ids[self._size] = item_id
+        self._size += 1
+
+    def rows_of(self, item_id):
+        return np.flatnonzero(self._ids[:self._size] == item_id)
+
+    def remove_row(self, row):
+        """Drop `row` by moving the last row into its place."""
+        last = self._size - 1
+        self._values[row] = self._values[last]
+        self._ids[row] = self._ids[last]
+        self._size -= 1
+
+    def remove(self, item_id):
+        for row in self.rows_of(item_id)[::-1]:
+            self.remove_row(row)
+
+    def clear(self):
+        self._size = 0
+
+    def distances(self, value):
+        return _popcount(self._values[:self._size] ^ np.uint64(value))
+
+    def closest(self, value, k=1):
+        """Top-k `(item_id, distance)` pairs, closest first."""
+        if not self._size:
+            return []
+        dists = self.distances(value)
+        k = min(k, self._size)
+        rows = np.argpartition(dists, k - 1)[:k]
+        rows = rows[np.argsort(dists[rows], kind="stable")]
+        return [(int(self._ids[r]), int(dists[r])) for r in rows]
+
+
+class PHashIndex:
+    """Near-duplicate index over 64-bit pHashes (multi-index hashing).
+
+    Each hash is split into four 16-bit chunks with one lookup table per
+    chunk. If two hashes are within distance d, by pigeonhole at least one
+    chunk differs by at most d // 4 bits, so a query only probes the chunk
+    values within that radius instead of scanning the catalog.
+
+    The hashes themselves live only in a PHashMatrix (8 bytes per hash +
+    8 for the item_id); the chunk tables hold matrix row numbers, and
+    candidate distances are read from the array in one vectorized call.
+    Threshold queries (`search` / `nearest`) use the tables; `closest`
+    scans the matrix for the true top-k.
+    """
+
+    def __init__(self):
+        self._tables = [{} for _ in range(CHUNKS)]
+        self.matrix = PHashMatrix()
+
+    def __len__(self):
+        return len(self.matrix)
+
+    @staticmethod
+    def _chunks(value):
+        return [(value >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNKS)]
+
+    def _link(self, row, value):
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            table.setdefault(chunk, set()).add(row)
+
+    def _unlink(self, row, value):
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            rows = table.get(chunk)
+            if rows:
+                rows.discard(row)
+                if not rows:
+                    del table[chunk]
+
+    def add(self, item_id, image_hash):
+        value = hash_to_int(image_hash)
+        if value is None:
+            return
+        self.remove(item_id)
+        self._link(len(self.matrix), value)
+        self.matrix.add(item_id, value)
+
+    def remove(self, item_id):
+        matrix = self.matrix
+        for row in matrix.rows_of(item_id)[::-1]:
+            last = len(matrix) - 1
+            self._unlink(row, int(matrix._values[row]))
+            if row != last:
+                # The matrix moves its last row into the gap
+                moved = int(matrix._values[last])
+                self._unlink(last, moved)
+                self._link(row, moved)
+            matrix.remove_row(row)
+
+    def clear(self):
+        self.matrix.clear()
+        for table in self._tables:
+            table.clear()
+
+    def _candidates(self, value, max_dist):
+        radius = max_dist // CHUNKS
+        masks = _masks_within(radius)
+        found = set()
+        for table, chunk in zip(self._tables, self._chunks(value)):
+            for mask in masks:
+                rows = table.get(chunk ^ mask)
+                if rows:
+                    found |= rows
+        return found
+
+    def search(self, image_hash, max_dist=DUPLICATE_DISTANCE):
+        """All `(distance, item_id)` within `max_dist`, closest first."""
+        value = hash_to_int(image_hash)
+        if value is None:
+            return []
+        rows = np.fromiter(self._candidates(value, max_dist), dtype=np.int64)
+        if not len(rows):
+            return []
+        dists = _popcount(self.matrix._values[rows] ^ np.uint64(value))
+        close = dists <= max_dist
+        ids = self.matrix._ids[rows[close]]
+        return sorted(zip(dists[close].tolist(), ids.tolist()))
+
+    def nearest(self, image_hash, max_dist=DUPLICATE_DISTANCE):
+        """`(item_id, distance)` of the closest match, or `(None, None)`."""
+        matches = self.search(image_hash, max_dist)
+        if not matches:
+            return None, None
+        dist, item_id = matches[0]
+        return item_id, dist
+
+    def closest(self, image_hash, k=1):
+        """Top-k `(item_id, distance)` over the whole catalog (NumPy scan)."""
+        value = hash_to_int(image_hash)
+        if value is None:
+            return []
+        return self.matrix.closest(value, k)
+
+    async def load(self, db):
+        """(Re)build from market_items using an open connection."""
+        self.clear()
+        cursor = await db.execute("SELECT item_id, phash FROM market_items WHERE phash IS NOT NULL")
+        async for item_id, phash in cursor:
+            self.add(item_id, from_db(phash))
@@ -0,0 +1,67 @@
+import time
+
+from utils.lru import LRUCache
+
+
+class TokenBucket:
+    """`burst` tokens, refilled at `rate` tokens per second."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n=1):
+        """Spend `n` tokens; returns 0.0, or the seconds until they'd be available."""
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        return (n - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+class RateLimiter:
+    """Per-key token buckets (e.g. per user), kept for the most recent keys.
+
+    `per_minute=0` disables limiting. A key that falls out of the LRU simply
+    starts again with a full bucket.
+    """
+
+    def __init__(self, per_minute, burst=None, maxsize=4096):
+        self.rate = per_minute / 60.0
+        self.burst = burst if burst is not None else max(1, per_minute)
+        self.enabled = per_minute > 0
+        self._buckets = LRUCache(maxsize)
+        self.allowed = 0
+        self.limited = 0
+
+    def take(self, key):
+        """0.0 if `key` may go ahead, else the seconds it has to wait."""
+        if not self.enabled:
+            return 0.0
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets.put(key, bucket)
+        wait = bucket.take()
+        if wait:
+            self.limited += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "per_minute": self.rate * 60,
+            "burst": self.burst,
+            "tracked": len(self._buckets),
+            "allowed": self.allowed,
+            "limited": self.limited,
+        }
@@ -0,0 +1,167 @@
+import asyncio
+import time
+
+from utils.lru import LRUCache
+
+# Credits paid to the seller per rewarded reaction
+REACTION_REWARD = 100
+# Seconds rewards may sit in memory before they are written (durability window)
+FLUSH_INTERVAL = 5.0
+# Flush early once this many reactions are waiting
+MAX_PENDING = 1000
+# (message, user) pairs remembered as already rewarded
+SEEN_CACHE_SIZE = 65536
+
+
+class ReactionRewards:
+    """Accrues reaction rewards in memory and writes them in batches.
+
+    `add` records one reaction; repeats of the same (message, reactor) pair
+    are dropped, first by an in-memory LRU and for good by the
+    reaction_rewards table (PRIMARY KEY (message_id, user_id)), so
+    un-reacting and re-reacting pays nothing. Every `interval` seconds (or
+    once `max_pending` reactions wait, or on `stop`) one writer operation
+    records the new pairs and credits each (seller, guild) once with the
+    summed amount, so a burst of reactions costs one commit instead of one
+    each. A crash loses at most `interval` seconds of rewards.
+    """
+
+    def __init__(self, bank, amount=REACTION_REWARD, interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.bank = bank
+        self.amount = amount
+        self.interval = interval
+        self.max_pending = max(1, max_pending)
+        # (message_id, user_id) -> (item_id, seller_id, guild_id)
+        self._pending = {}
+        self._seen = LRUCache(SEEN_CACHE_SIZE)
+        self._wake = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self._lock = asyncio.Lock()
+
+        self.accepted = 0
+        self.duplicates = 0
+        self.rewarded = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._stopping = False
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop the timer and write whatever is still pending.
+
+        The loop is woken rather than cancelled, so a flush already in the
+        writer finishes instead of losing its batch.
+        """
+        self._stopping = True
+        self._wake.set()
+        if self._task:
+            try:
+                await self._task
+            except Exception as e:
+                print(f"Reaction reward loop failed: {e}")
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Reaction reward flush failed: {e} ({len(self._pending)} rewards not written)")
+
+    def is_duplicate(self, message_id, user_id):
+        """True if this pair is already pending or known to be rewarded."""
+        key = (message_id, user_id)
+        return key in self._pending or key in self._seen
+
+    def add(self, message_id, user_id, item_id, seller_id, guild_id):
+        """Queue one reaction; returns False if the pair was already rewarded."""
+        key = (message_id, user_id)
+        if self.is_duplicate(message_id, user_id):
+            self.duplicates += 1
+            return False
+        self._pending[key] = (item_id, seller_id, guild_id)
+        self.accepted += 1
+        if len(self._pending) >= self.max_pending:
+            self._wake.set()
+        return True
+
+    def discard(self):
+        """Drop pending rewards and remembered pairs (after a data wipe)."""
+        self._pending.clear()
+        self._seen.clear()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._stopping:
+                # stop() writes the rest itself
+                break
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Reaction reward flush failed: {e}")
+
+    async def flush(self):
+        """Write pending rewards in one writer operation; returns pairs rewarded."""
+        async with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            start = time.perf_counter()
+
+            async def write(db):
+                credits = {}
+                rewarded = []
+                for (message_id, user_id), (item_id, seller_id, guild_id) in batch.items():
+                    cursor = await db.execute(
+                        "INSERT OR IGNORE INTO reaction_rewards (message_id, user_id, item_id) VALUES (?, ?, ?)",
+                        (message_id, user_id, item_id)
+                    )
+                    if cursor.rowcount:
+                        rewarded.append((message_id, user_id))
+                        credits[(seller_id, guild_id)] = credits.get((seller_id, guild_id), 0) + self.amount
+                await self.bank.apply_transfers(
+                    [(seller_id, guild_id, total) for (seller_id, guild_id), total in credits.items()], db_conn=db
+                )
+                return rewarded
+
+            try:
+                rewarded = await self.bank.submit_write(write)
+            except BaseException:
+                # Keep them for the next tick (cancellation included); if the
+                # write did land, the reaction_rewards keys stop a second credit.
+                # Newer reactions win on conflict
+                for key, value in batch.items():
+                    self._pending.setdefault(key, value)
+                self.failed_flushes += 1
+                raise
+            for key in batch:
+                self._seen.put(key, True)
+            self.duplicates += len(batch) - len(rewarded)
+            self.rewarded += len(rewarded)
+            self.flushes += 1
+            self.last_flush_ms = (time.perf_counter() - start) * 1000
+            return len(rewarded)
+
+    def stats(self):
+        return {
+            "pending": len(self._pending),
+            "interval": self.interval,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "rewarded": self.rewarded,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "reactions_per_commit": self.rewarded / self.flushes if self.flushes else 0.0,
+            "last_flush_ms": self.last_flush_ms,
+        }
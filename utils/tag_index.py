@@ -0,0 +1,154 @@
+"""Normalized item -> tag rows (item_tags) and tag-filtered market search.
+
+market_items.tags holds the tagger output as a Python list repr; item_tags
+has one row per (item_id, tag) with lookups in both directions:
+PRIMARY KEY (item_id, tag) and idx_item_tags_tag (tag, item_id).
+"""
+import ast
+import re
+
+# How far to count a tag's rows when picking the most selective one
+SELECTIVITY_PROBE = 5000
+SEARCH_LIMIT = 10
+
+
+_QUOTED = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+
+
+def normalize_tag(tag):
+    """Lowercase with underscores, the tag-stock spelling: "Long Hair" -> "long_hair"."""
+    return "_".join(str(tag).lower().split())
+
+
+def parse_tags(text):
+    """Tags from a market_items.tags value (list repr, or comma separated)."""
+    if not text:
+        return []
+    if text.lstrip().startswith("["):
+        if "\\" in text:
+            # Escapes in the repr: let Python undo them
+            try:
+                tags = ast.literal_eval(text)
+            except (ValueError, SyntaxError):
+                tags = text.strip("[]").split(",")
+        else:
+            # Plain list repr; a regex is ~20x faster than literal_eval on a backfill
+            tags = [single or double for single, double in _QUOTED.findall(text)]
+    else:
+        tags = text.split(",")
+    return list(dict.fromkeys(tag for tag in map(normalize_tag, tags) if tag))
+
+
+async def write_item_tags(db, item_id, tags):
+    """Index one item's tags (no commit)."""
+    await db.executemany(
+        "INSERT OR IGNORE INTO item_tags (item_id, tag) VALUES (?, ?)",
+        [(item_id, normalize_tag(tag)) for tag in tags if normalize_tag(tag)]
+    )
+
+
+async def backfill_item_tags(db, batch=5000):
+    """Rebuild item_tags from market_items.tags (no commit). Returns rows written."""
+    await db.execute("DELETE FROM item_tags")
+    written = 0
+    cursor = await db.execute("SELECT item_id, tags FROM market_items WHERE tags IS NOT NULL")
+    try:
+        while True:
+            rows = await cursor.fetchmany(batch)
+            if not rows:
+                break
+            pairs = [(item_id, tag) for item_id, tags in rows for tag in parse_tags(tags)]
+            await db.executemany("INSERT OR IGNORE INTO item_tags (item_id, tag) VALUES (?, ?)", pairs)
+            written += len(pairs)
+    finally:
+        await cursor.close()
+    return written
+
+
+def parse_query(words):
+    """`!search` words -> filters.
+
+    `a b` = a AND b, `a|b` = a OR b, `grade:S` / `grade:S,A`,
+    `price:1000-5000` / `price:1000-` / `price:-5000`.
+    Returns `{"groups": [[tag, ...], ...], "grades": [...], "min_price", "max_price"}`.
+    """
+    query = {"groups": [], "grades": [], "min_price": None, "max_price": None}
+    for word in words:
+        lowered = word.lower()
+        if lowered.startswith("grade:"):
+            query["grades"] = [g.strip().upper() for g in word[6:].split(",") if g.strip()]
+        elif lowered.startswith("price:"):
+            low, _, high = word[6:].partition("-")
+            try:
+                query["min_price"] = int(low.replace(",", "")) if low else None
+                query["max_price"] = int(high.replace(",", "")) if high else None
+            except ValueError:
+                raise ValueError(f"価格の指定が不正です: {word} (例: price:1000-5000)")
+        else:
+            group = [normalize_tag(t) for t in word.split("|") if normalize_tag(t)]
+            if group:
+                query["groups"].append(group)
+    return query
+
+
+async def _tag_count(db, tag):
+    cursor = await db.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM item_tags WHERE tag = ? LIMIT ?)", (tag, SELECTIVITY_PROBE)
+    )
+    return (await cursor.fetchone())[0]
+
+
+async def search_items(db, groups=(), grades=(), min_price=None, max_price=None, limit=SEARCH_LIMIT):
+    """On-sale items matching every tag group (each group: any of its tags).
+
+    Newest first. With at least one single-tag group the scan is driven by
+    the most selective of those tags on idx_item_tags_tag, walking item_ids
+    downward and checking the rest by primary key; otherwise it walks the
+    on-sale items on idx_market_status. Either way it stops after `limit`
+    matches instead of collecting every candidate.
+    Returns rows of `(item_id, price, aesthetic_score, grade, image_url, tags)`.
+    """
+    groups = [list(dict.fromkeys(g)) for g in groups if g]
+    singles = [g[0] for g in groups if len(g) == 1]
+    driver = None
+    if singles:
+        counts = {tag: await _tag_count(db, tag) for tag in dict.fromkeys(singles)}
+        driver = min(counts, key=counts.get)
+        if counts[driver] == 0:
+            return []
+
+    where, params = [], []
+    if driver is not None:
+        source = "item_tags t JOIN market_items m ON m.item_id = t.item_id"
+        where.append("t.tag = ?")
+        params.append(driver)
+        order = "t.item_id DESC"
+        groups = [g for g in groups if g != [driver]]
+        id_col = "t.item_id"
+    else:
+        source = "market_items m"
+        order = "m.item_id DESC"
+        id_col = "m.item_id"
+
+    for group in groups:
+        marks = ", ".join("?" * len(group))
+        where.append(f"EXISTS (SELECT 1 FROM item_tags x WHERE x.item_id = {id_col} AND x.tag IN ({marks}))")
+        params.extend(group)
+    where.append("m.status = 'on_sale'")
+    if grades:
+        where.append(f"m.grade IN ({', '.join('?' * len(grades))})")
+        params.extend(grades)
+    if min_price is not None:
+        where.append("m.price >= ?")
+        params.append(min_price)
+    if max_price is not None:
+        where.append("m.price <= ?")
+        params.append(max_price)
+
+    sql = (
+        f"SELECT m.item_id, m.price, m.aesthetic_score, m.grade, m.image_url, m.tags FROM {source} "
+        f"WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ?"
+    )
+    params.append(limit)
+    cursor = await db.execute(sql, params)
+    return await cursor.fetchall()